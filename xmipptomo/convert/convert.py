@@ -32,9 +32,15 @@ from pwem.objects import Acquisition, Transform
 from pyworkflow.object import ObjectWrap, String
 import numpy as np
 from collections import OrderedDict
-from xmipp3.base import getLabelPythonType, iterMdRows
+from functools import lru_cache
+from xmipp3.base import getLabelPythonType as _getLabelPythonType, iterMdRows
 from tomo.objects import SubTomogram, Coordinate3D, CTFTomo
 
+@lru_cache(maxsize=None)
+def getLabelPythonType(label):
+    """ Python type of a label, only resolved once per label. """
+    return _getLabelPythonType(label)
+
 def prefixAttribute(attribute):
     return '_xmipp_%s' % attribute
 
@@ -169,6 +175,12 @@ def setOfImagesToMd(imgSet, mdIn, imgToFunc, **kwargs):
     if 'alignType' not in kwargs:
         kwargs['alignType'] = imgSet.getAlignment()
 
+    # Particles without conversion hooks are written column by column
+    if imgToFunc is particleToRow and not kwargs.get('preprocessImageRow') \
+            and not kwargs.get('postprocessImageRow'):
+        setOfParticlesToMdColumns(imgSet, mdIn, **kwargs)
+        return
+
     if 'where' in kwargs:
         where = kwargs['where']
         for img in imgSet.iterItems(where=where):
@@ -183,6 +195,82 @@ def setOfImagesToMd(imgSet, mdIn, imgToFunc, **kwargs):
             imgToFunc(img, imgRow, **kwargs)
             imgRow.writeToMd(mdIn, objId)
 
+def setOfParticlesToMdColumns(imgSet, mdIn, **kwargs):
+    """ Columnar counterpart of setOfImagesToMd with particleToRow.
+    All the values are gathered in a single pass over the set, the
+    transformation matrices are converted to alignment values with one
+    batched call and the metadata is filled column by column.
+    """
+    alignType = kwargs.get('alignType')
+    writeAcquisition = kwargs.get('writeAcquisition', True)
+    where = kwargs.get('where', None)
+    iterator = imgSet.iterItems(where=where) if where else imgSet
+
+    columns = OrderedDict([(emlib.MDL_ITEM_ID, []), (emlib.MDL_IMAGE, [])])
+    matrices, acquisitions, coordinates, enabled = [], [], [], []
+    hasAcquisition = hasCoordinates = hasTransform = hasTomoId = False
+    for img in iterator:
+        columns[emlib.MDL_ITEM_ID].append(img.getObjId())
+        columns[emlib.MDL_IMAGE].append(locationToXmipp(*img.getLocation()))
+
+        if alignType != ALIGN_NONE:
+            # As in alignmentToRow, images without transform do not add the
+            # alignment labels, they only get their default values
+            transform = img.getTransform()
+            hasTransform = hasTransform or transform is not None
+            matrices.append(np.identity(4) if transform is None
+                            else np.array(transform.getMatrix(), dtype=float))
+
+        if writeAcquisition and img.hasAcquisition():
+            hasAcquisition = True
+            acquisition = img.getAcquisition()
+            acquisitions.append([getattr(acquisition, attr).get()
+                                 for attr in ACQUISITION_DICT])
+        else:
+            acquisitions.append(None)
+
+        # As in particleToRow, the enabled flag of the coordinate prevails
+        coord = img.getCoordinate3D()
+        if coord is not None:
+            hasCoordinates = True
+            hasTomoId = hasTomoId or bool(coord.getTomoId())
+            coordinates.append([getattr(coord, attr).get() if hasattr(coord, attr) else 0
+                                for attr in COOR_DICT] + [coord.getTomoId()])
+            enabled.append(coord.isEnabled())
+        else:
+            coordinates.append(None)
+            enabled.append(img.isEnabled())
+
+    if alignType != ALIGN_NONE and hasTransform:
+        columns.update(alignmentToColumns(matrices, alignType))
+
+    if hasAcquisition:
+        for index, label in enumerate(ACQUISITION_DICT.values()):
+            columns[label] = [values[index] if values else 0.0
+                              for values in acquisitions]
+
+    columns[emlib.MDL_ENABLED] = [1 if isEnabled else -1 for isEnabled in enabled]
+
+    if hasCoordinates:
+        for index, label in enumerate(COOR_DICT.values()):
+            columns[label] = [values[index] if values else 0
+                              for values in coordinates]
+        # As in coordinateToRow, the micrograph is only written for coordinates
+        # with a tomoId
+        if hasTomoId:
+            columns[emlib.MDL_MICROGRAPH] = [str(values[-1]) if values and values[-1] else ''
+                                             for values in coordinates]
+
+    # Filling a new metadata column by column and appending it to the input one
+    mdColumns = emlib.MetaData()
+    for _ in columns[emlib.MDL_ITEM_ID]:
+        mdColumns.addObject()
+    if mdColumns.size():
+        for label, values in columns.items():
+            valueType = getLabelPythonType(label)
+            mdColumns.setColumnValues(label, [valueType(value) for value in values])
+    mdIn.unionAll(mdColumns)
+
 def imageToRow(img, imgRow, imgLabel, **kwargs):
     # Provide a hook to be used if something is needed to be
     # done for special cases before converting image to row
@@ -256,7 +344,6 @@ def objectToRow(obj, row, attrDict, extraLabels=[]):
                 print("Value = %s" % value)
                 print("Value type = %s" % valueType)
                 raise e
-            row.setValue(label, valueType(getattr(obj, attr).get()))
 
     attrLabels = attrDict.values()
 
@@ -327,19 +414,69 @@ def alignmentToRow(alignment, alignmentRow, alignType):
         alignmentRow.setValue(emlib.MDL_ANGLE_PSI,  angles[2])
     alignmentRow.setValue(emlib.MDL_FLIP, flip)
 
+def alignmentToColumns(matrices, alignType):
+    """ Columnar counterpart of alignmentToRow. Returns an ordered dictionary
+    from label to the array of values of a (N, 4, 4) matrix stack.
+    """
+    matrices = np.array(matrices, dtype=float).reshape(-1, 4, 4)
+    if alignType == ALIGN_2D:
+        # only flip is meaninfull if 2D case
+        # in that case the 2x2 determinant is negative
+        flip = np.linalg.det(matrices[:, 0:2, 0:2]) < 0
+        matrices[flip, 0, :2] *= -1.
+        matrices[flip, 2, 2] = 1.
+    elif alignType == ALIGN_3D:
+        flip = np.linalg.det(matrices[:, 0:3, 0:3]) < 0
+        matrices[flip, 0, :4] *= -1.
+        matrices[flip, 3, 3] = 1.
+    else:
+        flip = np.linalg.det(matrices[:, 0:3, 0:3]) < 0
+        if np.any(flip):
+            raise Exception("the det of the transformation matrix is "
+                            "negative. This is not a valid transformation "
+                            "matrix for Scipion.")
+    shifts, angles = geometryFromMatrices(matrices, alignType == ALIGN_PROJ)
+
+    columns = OrderedDict([(emlib.MDL_SHIFT_X, shifts[:, 0]),
+                           (emlib.MDL_SHIFT_Y, shifts[:, 1]),
+                           (emlib.MDL_SHIFT_Z, shifts[:, 2])])
+    if alignType == ALIGN_2D:
+        columns[emlib.MDL_ANGLE_PSI] = angles[:, 0] + angles[:, 2]
+    else:
+        columns[emlib.MDL_ANGLE_ROT] = angles[:, 0]
+        columns[emlib.MDL_ANGLE_TILT] = angles[:, 1]
+        columns[emlib.MDL_ANGLE_PSI] = angles[:, 2]
+    columns[emlib.MDL_FLIP] = flip
+    return columns
+
 def acquisitionToRow(acquisition, ctfRow):
     """ Set labels values from acquisition to md row. """
     objectToRow(acquisition, ctfRow, ACQUISITION_DICT)
 
 def geometryFromMatrix(matrix, inverseTransform):
-    from pwem.convert.transformations import (translation_from_matrix,
-                                              euler_from_matrix)
+    shifts, angles = geometryFromMatrices(matrix, inverseTransform)
+    return shifts[0], angles[0]
+
+def geometryFromMatrices(matrices, inverseTransform):
+    """ Batched counterpart of geometryFromMatrix. Returns the (N, 3) shifts
+    and (N, 3) euler angles (rot, tilt, psi) of a (N, 4, 4) matrix stack.
+    """
+    matrices = np.asarray(matrices, dtype=float).reshape(-1, 4, 4)
     if inverseTransform:
-        matrix = np.linalg.inv(matrix)
-        shifts = -translation_from_matrix(matrix)
+        matrices = invertTransformations(matrices)
+        shifts = -matrices[:, :3, 3]
     else:
-        shifts = translation_from_matrix(matrix)
-    angles = -np.rad2deg(euler_from_matrix(matrix, axes='szyz'))
+        shifts = matrices[:, :3, 3].copy()
+
+    # Same decomposition as euler_from_matrix(matrix, axes='szyz'), whose
+    # sign change cancels the one applied by geometryFromMatrix
+    sy = np.hypot(matrices[:, 2, 1], matrices[:, 2, 0])
+    regular = sy > np.finfo(float).eps * 4.0
+    rot = np.where(regular, np.arctan2(matrices[:, 2, 1], matrices[:, 2, 0]),
+                   np.arctan2(-matrices[:, 1, 0], matrices[:, 1, 1]))
+    tilt = np.arctan2(sy, matrices[:, 2, 2])
+    psi = np.where(regular, np.arctan2(matrices[:, 1, 2], -matrices[:, 0, 2]), 0.0)
+    angles = np.rad2deg(np.stack([rot, tilt, psi], axis=1))
     return shifts, angles
 
 def readSetOfSubtomograms(filename, partSet, **kwargs):
@@ -358,12 +495,14 @@ def readSetOfImages(filename, imgSet, rowToFunc, **kwargs):
     if kwargs.get('removeDisabled', True):
         imgMd.removeDisabled()
 
+    # Labels are only checked once for all the rows
+    schema = kwargs.setdefault('schema', MetaDataSchema.fromMd(imgMd))
+
     # If the type of alignment is not sent through the kwargs
     # try to deduced from the metadata labels
     if 'alignType' not in kwargs:
-        imgRow = rowFromMd(imgMd, imgMd.firstObject())
-        if _containsAny(imgRow, ALIGNMENT_DICT):
-            if imgRow.containsLabel(emlib.MDL_ANGLE_TILT):
+        if schema.hasAlignment:
+            if schema.containsLabel(emlib.MDL_ANGLE_TILT):
                 kwargs['alignType'] = ALIGN_PROJ
             else:
                 kwargs['alignType'] = ALIGN_2D
@@ -371,14 +510,144 @@ def readSetOfImages(filename, imgSet, rowToFunc, **kwargs):
             kwargs['alignType'] = ALIGN_NONE
 
     if imgMd.size() > 0:
-        for objId in imgMd:
-            imgRow = rowFromMd(imgMd, objId)
-            img = rowToFunc(imgRow, **kwargs)
-            imgSet.append(img)
+        # Rows without conversion hooks are read from whole columns
+        if kwargs.get('preprocessImageRow') or kwargs.get('postprocessImageRow'):
+            for objId in imgMd:
+                imgRow = rowFromMd(imgMd, objId)
+                img = rowToFunc(imgRow, **kwargs)
+                imgSet.append(img)
+        else:
+            img = readSetOfImagesColumns(imgMd, imgSet, rowToFunc, **kwargs)
 
         imgSet.setHasCTF(img.hasCTF())
         imgSet.setAlignment(kwargs['alignType'])
 
+def readSetOfImagesColumns(imgMd, imgSet, rowToFunc, **kwargs):
+    """ Columnar counterpart of the loop of readSetOfImages.
+    Every label column is read from the metadata at once, all the
+    transformation matrices are computed with a single batched call and
+    the rows are handed to rowToFunc as lightweight views over the columns.
+    Returns the last image appended to imgSet.
+    """
+    columns = OrderedDict((label, imgMd.getColumnValues(label))
+                          for label in imgMd.getActiveLabels())
+    size = imgMd.size()
+    schema = kwargs.get('schema') or MetaDataSchema(columns.keys())
+
+    # Alignment is computed for all rows at once, so it is skipped per row
+    alignType = kwargs.get('alignType')
+    matrices = None
+    if alignType != ALIGN_NONE and schema.hasAlignment:
+        matrices = alignmentColumnsToMatrices(columns, alignType, size)
+    rowKwargs = dict(kwargs, alignType=ALIGN_NONE, schema=schema)
+
+    imgRow = ColumnRow(columns)
+    img = None
+    for index in range(size):
+        imgRow.setIndex(index)
+        img = rowToFunc(imgRow, **rowKwargs)
+        if matrices is not None:
+            img.setTransform(Transform(matrix=matrices[index]))
+        imgSet.append(img)
+
+    return img
+
+class ColumnRow:
+    """ Read-only view of one row of a set of metadata columns, with the
+    same interface used by the row converters as emlib.metadata.Row.
+    """
+    def __init__(self, columns, index=0):
+        self._columns = columns
+        self._index = index
+
+    def setIndex(self, index):
+        self._index = index
+
+    def _getLabel(self, label):
+        return emlib.str2Label(label) if isinstance(label, str) else label
+
+    def containsLabel(self, label):
+        return self._getLabel(label) in self._columns
+
+    def hasLabel(self, label):
+        return self.containsLabel(label)
+
+    def getValue(self, label, default=None):
+        column = self._columns.get(self._getLabel(label))
+        return default if column is None else column[self._index]
+
+    def getValueAsObject(self, label, default=None):
+        """ Same as getValue, but making an Object wrapping. """
+        return ObjectWrap(self.getValue(label, default))
+
+class MetaDataSchema:
+    """ Labels present in a metadata. All the rows of a metadata share the
+    same labels, so they are checked once and the row converters only need
+    to extract values.
+    """
+    def __init__(self, labels):
+        self._labels = set(labels)
+        self.hasAlignment = _containsAny(self, ALIGNMENT_DICT)
+        self.hasAcquisition = _containsAll(self, ACQUISITION_DICT)
+        self.hasCtf = _containsAll(self, CTF_DICT_NORESOLUTION)
+        self.hasCoordinate = _containsAll(self, COOR_DICT)
+
+    @classmethod
+    def fromMd(cls, mdIn):
+        return cls(mdIn.getActiveLabels())
+
+    def containsLabel(self, label):
+        if isinstance(label, str):
+            label = emlib.str2Label(label)
+        return label in self._labels
+
+    def hasLabel(self, label):
+        return self.containsLabel(label)
+
+def alignmentColumnsToMatrices(columns, alignType, size):
+    """ Columnar counterpart of rowToAlignment. Returns the (N, 4, 4)
+    transformation matrices of the alignment label columns.
+    """
+    is2D = alignType == ALIGN_2D
+    inverseTransform = alignType == ALIGN_PROJ
+
+    def getColumn(label):
+        if label in columns:
+            return np.asarray(columns[label], dtype=float)
+        return np.zeros(size)
+
+    flip = getColumn(emlib.MDL_FLIP).astype(bool)
+    shifts = np.zeros((size, 3))
+    angles = np.zeros((size, 3))
+    shifts[:, 0] = getColumn(emlib.MDL_SHIFT_X)
+    shifts[:, 1] = getColumn(emlib.MDL_SHIFT_Y)
+    if not is2D:
+        angles[:, 0] = getColumn(emlib.MDL_ANGLE_ROT)
+        angles[:, 1] = getColumn(emlib.MDL_ANGLE_TILT)
+        shifts[:, 2] = getColumn(emlib.MDL_SHIFT_Z)
+        angles[:, 2] = getColumn(emlib.MDL_ANGLE_PSI)
+        angles[flip, 1] += 180   # tilt + 180
+        angles[flip, 2] *= -1    # - psi, COSS: this is mirroring X
+        shifts[flip, 0] *= -1    # -x
+    else:
+        psi = getColumn(emlib.MDL_ANGLE_PSI)
+        rot = getColumn(emlib.MDL_ANGLE_ROT)
+        if np.any((rot != 0) & (psi != 0)):
+            print("HORROR rot and psi are different from zero in 2D case")
+        angles[:, 0] = psi + rot
+
+    matrices = matrixFromGeometries(shifts, angles, inverseTransform)
+
+    if alignType == ALIGN_2D:
+        matrices[flip, 0, :2] *= -1.  # invert only the first two columns
+        # keep x
+        matrices[flip, 2, 2] = -1.  # set 3D rot
+    elif alignType == ALIGN_3D:
+        matrices[flip, 0, :3] *= -1.  # now, invert first line excluding x
+        matrices[flip, 3, 3] *= -1.
+
+    return matrices
+
 def rowToParticle(partRow, **kwargs):
     return _rowToParticle(partRow, SubTomogram, **kwargs)
 
@@ -390,12 +659,13 @@ def _rowToParticle(partRow, particleClass, **kwargs):
     if postprocessImageRow:
         del kwargs['postprocessImageRow']
 
+    schema = kwargs.get('schema')
     img = rowToImage(partRow, emlib.MDL_IMAGE, particleClass, **kwargs)
-    img.setCoordinate3D(rowToCoordinate(partRow))
+    img.setCoordinate3D(rowToCoordinate(partRow, schema=schema))
     # copy micId if available
     # if not copy micrograph name if available
     try:
-        if partRow.hasLabel(emlib.MDL_MICROGRAPH_ID):
+        if (schema or partRow).hasLabel(emlib.MDL_MICROGRAPH_ID):
             img.setMicId(partRow.getValue(emlib.MDL_MICROGRAPH_ID))
 #        elif partRow.hasLabel(emlib.MDL_MICROGRAPH):
 #            micName = partRow.getValue(emlib.MDL_MICROGRAPH)
@@ -440,30 +710,34 @@ def rowToImage(imgRow, imgLabel, imgClass, **kwargs):
     index, filename = xmippToLocation(imgRow.getValue(imgLabel))
     img.setLocation(index, filename)
 
-    if imgRow.containsLabel(emlib.MDL_REF):
+    # Labels can be checked on the metadata schema instead of on each row
+    schema = kwargs.get('schema')
+    labels = schema or imgRow
+
+    if labels.containsLabel(emlib.MDL_REF):
         img.setClassId(imgRow.getValue(emlib.MDL_REF))
-    elif imgRow.containsLabel(emlib.MDL_REF3D):
+    elif labels.containsLabel(emlib.MDL_REF3D):
         img.setClassId(imgRow.getValue(emlib.MDL_REF3D))
 
     if kwargs.get('readCtf', True):
-        img.setCTF(rowToCtfModel(imgRow))
+        img.setCTF(rowToCtfModel(imgRow, schema=schema))
 
     # alignment is mandatory at this point, it shoud be check
     # and detected defaults if not passed at readSetOf.. level
     alignType = kwargs.get('alignType')
 
     if alignType != ALIGN_NONE:
-        img.setTransform(rowToAlignment(imgRow, alignType))
+        img.setTransform(rowToAlignment(imgRow, alignType, schema=schema))
 
     if kwargs.get('readAcquisition', True):
-        img.setAcquisition(rowToAcquisition(imgRow))
+        img.setAcquisition(rowToAcquisition(imgRow, schema=schema))
 
     if kwargs.get('magnification', None):
         img.getAcquisition().setMagnification(kwargs.get("magnification"))
 
-    setObjId(img, imgRow)
+    setObjId(img, imgRow, schema=schema)
     # Read some extra labels
-    rowToObject(imgRow, img, {}, [])
+    rowToObject(imgRow, img, {}, [], schema=schema)
 
     # Provide a hook to be used if something is needed to be
     # done for special cases before converting image to row
@@ -473,12 +747,12 @@ def rowToImage(imgRow, imgLabel, imgClass, **kwargs):
 
     return img
 
-def rowToCoordinate(coordRow):
+def rowToCoordinate(coordRow, schema=None):
     """ Create a Coordinate from a row of a metadata. """
     # Check that all required labels are present in the row
-    if _containsAll(coordRow, COOR_DICT):
+    if schema.hasCoordinate if schema else _containsAll(coordRow, COOR_DICT):
         coord = Coordinate3D()
-        rowToObject(coordRow, coord, COOR_DICT)
+        rowToObject(coordRow, coord, COOR_DICT, schema=schema)
 
         # Setup the micId if is integer value
         try:
@@ -498,11 +772,12 @@ def xmippToLocation(xmippFilename):
     else:
         return NO_INDEX, str(xmippFilename)
 
-def rowToCtfModel(ctfRow):
+def rowToCtfModel(ctfRow, schema=None):
     """ Create a CTFModel from a row of a metadata. """
+    labels = schema or ctfRow
     # Check if the row has CTF values, this could be called from a xmipp
     # particles metadata
-    if _containsAll(ctfRow, CTF_DICT_NORESOLUTION):
+    if schema.hasCtf if schema else _containsAll(ctfRow, CTF_DICT_NORESOLUTION):
 
         # for compatibility reason ignore resolution and fitQuality
         # Instantiate Scipion CTF Model
@@ -511,18 +786,18 @@ def rowToCtfModel(ctfRow):
         # Case for metadata coming with Xmipp resolution label
         # Populate Scipion CTF from metadata row (using mapping dictionary
         # plus extra labels
-        if ctfRow.hasLabel(md.MDL_CTF_PHASE_SHIFT):
+        if labels.hasLabel(md.MDL_CTF_PHASE_SHIFT):
             ctfModel.setPhaseShift(ctfRow.getValue(md.MDL_CTF_PHASE_SHIFT, 0))
-        if ctfRow.containsLabel(emlib.label2Str(emlib.MDL_CTF_CRIT_MAXFREQ)):
+        if labels.containsLabel(emlib.label2Str(emlib.MDL_CTF_CRIT_MAXFREQ)):
             rowToObject(ctfRow, ctfModel, CTF_DICT,
-                        extraLabels=CTF_EXTRA_LABELS)
+                        extraLabels=CTF_EXTRA_LABELS, schema=schema)
         else:
-            rowToObject(ctfRow, ctfModel, CTF_DICT_NORESOLUTION)
+            rowToObject(ctfRow, ctfModel, CTF_DICT_NORESOLUTION, schema=schema)
 
         # Standarize defocus values
         ctfModel.standardize()
         # Set psd file names
-        setPsdFiles(ctfModel, ctfRow)
+        setPsdFiles(ctfModel, ctfRow, schema=schema)
         # ctfModel.setPhaseShift(0.0)  # for consistency with ctfModel
 
     else:
@@ -530,7 +805,7 @@ def rowToCtfModel(ctfRow):
 
     return ctfModel
 
-def rowToAlignment(alignmentRow, alignType):
+def rowToAlignment(alignmentRow, alignType, schema=None):
     """
     is2D == True-> matrix is 2D (2D images alignment)
             otherwise matrix is 3D (3D volume alignment or projection)
@@ -539,7 +814,7 @@ def rowToAlignment(alignmentRow, alignType):
     is2D = alignType == ALIGN_2D
     inverseTransform = alignType == ALIGN_PROJ
 
-    if _containsAny(alignmentRow, ALIGNMENT_DICT):
+    if schema.hasAlignment if schema else _containsAny(alignmentRow, ALIGNMENT_DICT):
         alignment = Transform()
         angles = np.zeros(3)
         shifts = np.zeros(3)
@@ -593,17 +868,17 @@ def rowToAlignment(alignmentRow, alignType):
 
     return alignment
 
-def rowToAcquisition(acquisitionRow):
+def rowToAcquisition(acquisitionRow, schema=None):
     """ Create an acquisition from a row of a metadata. """
-    if _containsAll(acquisitionRow, ACQUISITION_DICT):
+    if schema.hasAcquisition if schema else _containsAll(acquisitionRow, ACQUISITION_DICT):
         acquisition = Acquisition()
-        rowToObject(acquisitionRow, acquisition, ACQUISITION_DICT)
+        rowToObject(acquisitionRow, acquisition, ACQUISITION_DICT, schema=schema)
     else:
         acquisition = None
 
     return acquisition
 
-def rowToObject(row, obj, attrDict, extraLabels=[]):
+def rowToObject(row, obj, attrDict, extraLabels=[], schema=None):
     """ This function will convert from a Row to an EMObject.
     Params:
         row: the Row instance (input)  -see emlib.metadata.utils.Row()-
@@ -612,6 +887,8 @@ def rowToObject(row, obj, attrDict, extraLabels=[]):
             row MDLabels in Xmipp (values).
         extraLabels: a list with extra labels that could be included
             as _xmipp_labelName
+        schema: optional MetaDataSchema of the metadata of the row, used
+            to check the labels instead of the row
     """
     obj.setEnabled(row.getValue(emlib.MDL_ENABLED, 1) > 0)
 
@@ -625,12 +902,12 @@ def rowToObject(row, obj, attrDict, extraLabels=[]):
     attrLabels = attrDict.values()
 
     for label in extraLabels:
-        if label not in attrLabels and row.hasLabel(label):
+        if label not in attrLabels and (schema or row).hasLabel(label):
             labelStr = emlib.label2Str(label)
             setattr(obj, prefixAttribute(labelStr), row.getValueAsObject(label))
 
-def setObjId(obj, mdRow, label=emlib.MDL_ITEM_ID):
-    if mdRow.containsLabel(label):
+def setObjId(obj, mdRow, label=emlib.MDL_ITEM_ID, schema=None):
+    if (schema or mdRow).containsLabel(label):
         obj.setObjId(mdRow.getValue(label))
     else:
         obj.setObjId(None)
@@ -642,27 +919,69 @@ def _containsAll(row, labels):
     values = labels.values() if isinstance(labels, dict) else labels
     return all(row.containsLabel(l) for l in values)
 
-def setPsdFiles(ctfModel, ctfRow):
+def setPsdFiles(ctfModel, ctfRow, schema=None):
     """ Set the PSD files of CTF estimation related
     to this ctfModel. The values will be read from
     the ctfRow if present.
     """
     for attr, label in CTF_PSD_DICT.items():
-        if ctfRow.containsLabel(label):
+        if (schema or ctfRow).containsLabel(label):
             setattr(ctfModel, attr, String(ctfRow.getValue(label)))
 
-def matrixFromGeometry(shifts, angles, inverseTransform):
-    """ Create the transformation matrix from a given
-    2D shifts in X and Y...and the 3 euler angles.
+def matrixFromGeometries(shifts, angles, inverseTransform):
+    """ Batched counterpart of matrixFromGeometry. Creates the (N, 4, 4)
+    transformation matrices from (N, 3) shifts and (N, 3) euler angles.
     """
-    from pwem.convert import euler_matrix
-    radAngles = -np.deg2rad(angles)
-
-    M = euler_matrix(radAngles[0], radAngles[1], radAngles[2], 'szyz')
+    shifts = np.asarray(shifts, dtype=float).reshape(-1, 3)
+    # Same matrix as euler_matrix(*(-np.deg2rad(angles)), 'szyz'), whose
+    # sign change cancels the one applied by matrixFromGeometry
+    rot, tilt, psi = np.deg2rad(np.asarray(angles, dtype=float).reshape(-1, 3)).T
+    ci, si = np.cos(rot), np.sin(rot)
+    cj, sj = np.cos(tilt), np.sin(tilt)
+    ck, sk = np.cos(psi), np.sin(psi)
+    cc, cs, sc, ss = ci * ck, ci * sk, si * ck, si * sk
+
+    M = np.tile(np.identity(4), (len(rot), 1, 1))
+    M[:, 2, 2] = cj
+    M[:, 2, 1] = sj * si
+    M[:, 2, 0] = sj * ci
+    M[:, 1, 2] = sj * sk
+    M[:, 1, 1] = -cj * ss + cc
+    M[:, 1, 0] = -cj * cs - sc
+    M[:, 0, 2] = -sj * ck
+    M[:, 0, 1] = cj * sc + cs
+    M[:, 0, 0] = cj * cc - ss
     if inverseTransform:
-        M[:3, 3] = -shifts[:3]
-        M = np.linalg.inv(M)
+        M[:, :3, 3] = -shifts
+        M = invertTransformations(M)
     else:
-        M[:3, 3] = shifts[:3]
+        M[:, :3, 3] = shifts
+
+    return M
 
-    return M
\ No newline at end of file
+def invertTransformations(matrices):
+    """ Inverse of a (N, 4, 4) stack of transformation matrices. Rigid
+    transforms are inverted in closed form (R^T, -R^T t) and only the rest,
+    if any, fall back to a general inverse.
+    """
+    matrices = np.asarray(matrices, dtype=float).reshape(-1, 4, 4)
+    rotations = matrices[:, :3, :3]
+    inverse = np.zeros_like(matrices)
+    inverse[:, :3, :3] = np.swapaxes(rotations, 1, 2)
+    inverse[:, :3, 3] = -np.einsum('nji,nj->ni', rotations, matrices[:, :3, 3])
+    inverse[:, 3, 3] = 1.
+
+    # Non orthonormal matrices (scaling, shearing...) need a general inverse
+    rigid = np.all(np.abs(rotations @ inverse[:, :3, :3] - np.identity(3)) < 1e-6,
+                   axis=(1, 2)) & np.all(matrices[:, 3] == [0., 0., 0., 1.], axis=1)
+    if not np.all(rigid):
+        inverse[~rigid] = np.linalg.inv(matrices[~rigid])
+
+    return inverse
+
+def matrixFromGeometry(shifts, angles, inverseTransform):
+    """ Create the transformation matrix from a given
+    2D shifts in X and Y...and the 3 euler angles.
+    """
+    shifts = np.asarray(shifts, dtype=float)[:3]
+    return matrixFromGeometries(shifts, angles, inverseTransform)[0]
@@ -25,6 +25,7 @@
 # **************************************************************************
 
 import os
+import numpy as np
 from pyworkflow import BETA
 import pyworkflow.protocol.params as params
 import pyworkflow.utils.path as path
@@ -65,7 +66,9 @@ class XmippProtApplyTransformationMatrixTS(EMProtocol, ProtTomoBase):
         path.makePath(extraPrefix)
         outputTsFileName = os.path.join(extraPrefix, "%s.mrc" % tsId)
 
-        avgRotAngle, _, _ = utils.calculateRotationAngleAndShiftsFromTM(ts)
+        rotAngles, _, _ = utils.calculateRotationAnglesAndShiftsFromTMStack(utils.getTransformationMatrixStack(ts))
+        # Angles are already folded into (-90, 90], so opposite rotations do not trigger a swap of the axes
+        avgRotAngle = np.mean(rotAngles)
         swap = True if (avgRotAngle > 45 or avgRotAngle < -45) else False
 
         ts.applyTransform(outputTsFileName, swapXY=swap)
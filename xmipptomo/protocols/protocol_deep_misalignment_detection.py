@@ -250,7 +250,7 @@ class XmippProtDeepDetectMisalignment(EMProtocol, ProtTomoBase, XmippProtocol):
         if len(subtomoPathList) != 0:
             self.getOutputSetOfSubtomos()
 
-            subtomoCoordList = utils.retrieveXmipp3dCoordinatesIntoList(coordFilePath, xmdFormat=1)
+            subtomoCoordList = utils.readXmipp3dCoordinates(coordFilePath)
 
             firstPredictionArray, secondPredictionArray = self.readPredictionArrays(outputSubtomoXmdFilePath)
             overallPrediction, predictionAverage = self.readTomoScores(outputTomoXmdFilePath)
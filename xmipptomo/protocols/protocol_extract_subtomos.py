@@ -30,19 +30,18 @@ import glob
 from pwem.emlib import lib
 from pwem.objects import Transform
 from pwem.protocols import EMProtocol
-from pwem import ALIGN_PROJ
 import pwem.emlib.metadata as md
 
 from pyworkflow import BETA
 from pyworkflow import utils as pwutils
 from pyworkflow.protocol.params import PointerParam, FloatParam, IntParam, BooleanParam, EnumParam
 
-from tomo.objects import SetOfTomograms, SetOfSubTomograms, SubTomogram, SetOfCoordinates3D, TomoAcquisition, \
-    MATRIX_CONVERSION
+from tomo.objects import SetOfTomograms, SetOfSubTomograms, SubTomogram, SetOfCoordinates3D, TomoAcquisition
 import tomo.constants as const
 
 from tomo.protocols import ProtTomoBase
-from xmipp3.convert import alignmentToRow
+
+from xmipptomo import utils
 
 COORD_BASE_FN = 'coords'
 
@@ -118,6 +117,7 @@ class XmippProtExtractSubtomos(EMProtocol, ProtTomoBase):
     def _insertAllSteps(self):
 
         tomodict = self.coords.get().getPrecedentsInvolved()
+        self._insertFunctionStep(self.writeMdCoordinatesStep)
         for key in tomodict.keys():
             tom = tomodict[key]
             tsId = tom.getTsId()
@@ -126,36 +126,25 @@ class XmippProtExtractSubtomos(EMProtocol, ProtTomoBase):
 
     # --------------------------- STEPS functions -------------------------------
 
-    def writeMdCoordinates(self, tomo, tomoPath):
+    def writeMdCoordinatesStep(self):
         """
-            Returns the filename of a metadata with the coordinates.
+            Writes the metadata with the coordinates of every tomogram in a single pass over the coordinates.
         """
-        mdCoor = lib.MetaData()
-
-        tsid = tomo.getTsId()
-
-        for item in self.coords.get().iterCoordinates(volume=tomo):
-            coord = item
-            transform = Transform(matrix=item.getMatrix(convention=MATRIX_CONVERSION.XMIPP))
-
-            if coord.getTomoId() == tsid:
-                nRow = md.Row()
-                coord.setVolume(tomo)
-                nRow.setValue(lib.MDL_XCOOR, int(coord.getX(const.BOTTOM_LEFT_CORNER)))
-                nRow.setValue(lib.MDL_YCOOR, int(coord.getY(const.BOTTOM_LEFT_CORNER)))
-                nRow.setValue(lib.MDL_ZCOOR, int(coord.getZ(const.BOTTOM_LEFT_CORNER)))
-                nRow.setValue(lib.MDL_PARTICLE_ID, int(coord.getObjId()))
-
-                alignmentToRow(transform, nRow, ALIGN_PROJ)
-                nRow.addToMd(mdCoor)
-
-                newCoord = item.clone()
-                newCoord.setVolume(coord.getVolume())
+        inTomograms = self.getTomograms()
+        volumes = {}
+        for tom in self.coords.get().getPrecedentsInvolved().values():
+            tomo = inTomograms[{'_tsId': tom.getTsId()}]
+            if tomo is not None:
+                volumes[tomo.getTsId()] = tomo.clone()
 
-        fnCoor = os.path.join(tomoPath, "%s.xmd" % tsid)
-        mdCoor.write(fnCoor)
+        utils.partitionMdCoordinates(self.coords.get(), self.getMdCoordinatesFileName, volumes=volumes,
+                                     idLabel=lib.MDL_PARTICLE_ID)
 
-        return fnCoor
+    def getMdCoordinatesFileName(self, tsId):
+        """
+            Returns the filename of the metadata with the coordinates of a tomogram.
+        """
+        return os.path.join(self._getExtraPath(tsId), "%s.xmd" % tsId)
 
     def getTomograms(self):
         """
@@ -187,13 +176,13 @@ class XmippProtExtractSubtomos(EMProtocol, ProtTomoBase):
             self.warning('Tomogram not found for tsId %s' % tsId)
             return
 
-        # Defining the output folder
+        # Defining the output folder, already created with the coordinates
         tomoPath = self._getExtraPath(tsId)
-        os.mkdir(tomoPath)
+        pwutils.makePath(tomoPath)
 
         tomoFn = tomo.getFileName()
 
-        fnCoords = self.writeMdCoordinates(tomo, tomoPath)
+        fnCoords = self.getMdCoordinatesFileName(tsId)
 
         params = ' --tomogram %s' % tomoFn
         params += ' --coordinates %s' % fnCoords
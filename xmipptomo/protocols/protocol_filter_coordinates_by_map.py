@@ -26,6 +26,10 @@
 # **************************************************************************
 
 import os
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 from pyworkflow import BETA
 from pyworkflow.protocol.params import FloatParam, BooleanParam, PointerParam, EnumParam, LEVEL_ADVANCED
@@ -34,11 +38,10 @@ from tomo import constants
 from tomo.protocols import ProtTomoBase
 from tomo.objects import Coordinate3D
 
-import pyworkflow.utils.path as path
+from pyworkflow.protocol import STEPS_PARALLEL
 from pyworkflow.object import Set, Float
 from pwem.protocols import EMProtocol
 import pwem.emlib as emlib
-import pwem.emlib.metadata as md
 
 from xmipptomo import utils
 
@@ -58,9 +61,13 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
     FILTER_AVERAGE = 1
     FILTER_STD = 2
 
+    ENGINE_XMIPP = 0
+    ENGINE_NUMPY = 1
+
     def __init__(self, **args):
         EMProtocol.__init__(self, **args)
         ProtTomoBase.__init__(self)
+        self.stepsExecutionMode = STEPS_PARALLEL
 
     def _defineParams(self, form):
         form.addSection(label='Input')
@@ -89,6 +96,19 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
                       label="Radius",
                       help='Radius of the ball with center at the coordinate')
 
+        form.addParam('statisticsEngine',
+                      EnumParam,
+                      choices=['Xmipp', 'NumPy'],
+                      default=self.ENGINE_XMIPP,
+                      display=EnumParam.DISPLAY_COMBO,
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Statistics engine",
+                      help='Select the engine that computes the statistics inside the ball of each coordinate:\n'
+                           '_Xmipp_: The statistics are computed by xmipp_tomo_filter_coordinates.\n'
+                           '_NumPy_: The statistics are computed in-process over a memory map of the map. The ball '
+                           'is precomputed once and the coordinates are distributed across as many processes as '
+                           'threads.')
+
         form.addParam('filterOption',
                       EnumParam,
                       choices=['No Filter', 'Average', 'Standard Deviation'],
@@ -120,28 +140,35 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
                       help='Set true if you want to keep values greater than the threshold. And set false'
                            'if the values lesser than the threshold will be discarded')
 
+        form.addParallelSection(threads=4, mpi=0)
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         self.tomos = self.inputCoordinates.get().getPrecedents()
+        # Maps by tomoId, shared by the parallel steps
+        self.mapIndex = utils.SetKeyIndex(self.inputSetOfTomograms.get())
 
+        outputDeps = []
+        sideInfoId = self._insertFunctionStep(self.generateSideInfo, prerequisites=[])
         for tomo in self.inputCoordinates.get().getPrecedents():
             tomoId = tomo.getObjId()
-            self._insertFunctionStep(self.generateSideInfo, tomoId)
-            self._insertFunctionStep(self.calculatingStatisticsStep, tomoId)
-        self._insertFunctionStep(self.createOutputStep)
-        self._insertFunctionStep(self.closeOutputSets)
+            statisticsId = self._insertFunctionStep(self.calculatingStatisticsStep, tomoId, prerequisites=[sideInfoId])
+            # Output steps append to the same set, so they are chained
+            outputDeps.append(self._insertFunctionStep(self.createOutputStep, tomoId,
+                                                       prerequisites=[statisticsId] + outputDeps[-1:]))
+        self._insertFunctionStep(self.closeOutputSets, prerequisites=outputDeps)
 
     # --------------------------- STEPS functions ----------------------------
-    def generateSideInfo(self, tomoId):
-        """ Generates side information and input files to feed the Xmipp filter coordinates algorithm """
-
-        extraPrefix = self._getExtraPath(str(tomoId))
-        path.makePath(extraPrefix)
+    def generateSideInfo(self):
+        """ Generates side information and input files to feed the Xmipp filter coordinates algorithm. The input
+        coordinates of all the tomograms are written in a single pass over the set """
 
-        utils.writeOutputCoordinates3dXmdFile(self.inputCoordinates.get(),
-                                              os.path.join(self._getExtraPath(str(tomoId)),
-                                                           METADATA_INPUT_COORDINATES + XMD_EXT),
-                                              tomoId)
+        utils.partitionMdCoordinates(self.inputCoordinates.get(),
+                                     lambda tomoId: self._getExtraPath(str(tomoId),
+                                                                       METADATA_INPUT_COORDINATES + XMD_EXT),
+                                     volumes={tomo.getObjId(): tomo.clone() for tomo in self.tomos},
+                                     keyGetter=lambda coord: coord.getVolId(),
+                                     idLabel=None, withAlignment=False, asInteger=False)
 
     def calculatingStatisticsStep(self, tomId):
         """ Given a tomogram and a set of coordinates, a ball around is considered and
@@ -151,6 +178,10 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
         fnOut = METADATA_COORDINATES_STATS + str(tomId) + XMD_EXT
         fnInCoord = self._getExtraPath(os.path.join(str(tomId), METADATA_INPUT_COORDINATES + XMD_EXT))
 
+        if self.statisticsEngine.get() == self.ENGINE_NUMPY:
+            self.calculateStatisticsNumpy(tomId, fnInCoord, self._getExtraPath(os.path.join(str(tomId), fnOut)))
+            return
+
         params = ' --inTomo %s' % self.retrieveMap(tomId).getFileName()
         params += ' --coordinates %s' % fnInCoord
         params += ' --radius %f' % self.radius.get()
@@ -158,62 +189,80 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
 
         self.runJob('xmipp_tomo_filter_coordinates', params)
 
-    def createOutputStep(self):
-        """ Generates a Xmipp metadata file (.xmd) containing the statistical information associated to
-        the each coordinate with information extracted from the resolution map. """
-
-        self.getOutputSetOfCoordinates3D()
-
-        outputMdFile = self._getExtraPath(OUTPUT_XMD_COORS)
-
-        for tomo in self.tomos:
-            tomoId = tomo.getObjId()
-            inputMdFileName = METADATA_COORDINATES_STATS + str(tomoId) + XMD_EXT
-            inputMdFile = self._getExtraPath(os.path.join(str(tomoId), inputMdFileName))
-
-            mdCoor = md.MetaData()
-
-            tom_fn = self.retrieveMap(tomoId).getFileName()
-            x_pos, y_pos, z_pos, avg, std = utils.readXmdStatisticsFile(inputMdFile)
-
-            for i in range(len(x_pos)):
-                avg_i = avg[i]
-                std_i = std[i]
-
-                if (self.filterOption == self.NO_FILTER) or \
-                   (not self.thresholdDirection.get() and self.filterOption == self.FILTER_AVERAGE and self.averageFilter.get() > avg_i) or \
-                   (self.thresholdDirection.get() and self.filterOption == self.FILTER_AVERAGE and self.averageFilter.get() < avg_i) or \
-                   (not self.thresholdDirection.get() and self.filterOption == self.FILTER_STD and self.stdFilter.get() > std_i) or \
-                   (self.thresholdDirection.get() and self.filterOption == self.FILTER_STD and self.stdFilter.get() < std_i):
-
-                    # Fill metadata
-                    mdRow = md.Row()
-                    mdRow.setValue(emlib.MDL_IMAGE, tom_fn)
-                    mdRow.setValue(emlib.MDL_AVG, avg_i)
-                    mdRow.setValue(emlib.MDL_STDDEV, std_i)
-                    mdRow.setValue(emlib.MDL_XCOOR, x_pos[i])
-                    mdRow.setValue(emlib.MDL_YCOOR, y_pos[i])
-                    mdRow.setValue(emlib.MDL_ZCOOR, z_pos[i])
-                    mdRow.writeToMd(mdCoor, mdCoor.addObject())
+    def calculateStatisticsNumpy(self, tomId, fnInCoord, fnOut):
+        """ Computes the statistics of the map inside the ball of each coordinate in-process, splitting the
+        coordinates in chunks that are computed in parallel, and writes them as xmipp_tomo_filter_coordinates does. """
+        coords = utils.readXmdColumns(fnInCoord, labels=['xcoor', 'ycoor', 'zcoor'])
+        positions = np.column_stack([coords['xcoor'], coords['ycoor'], coords['zcoor']]).reshape(-1, 3)
+        fnMap = self.retrieveMap(tomId).getFileName()
+
+        # Tomograms are already computed in parallel steps, so the threads are shared among them
+        threads = max(1, self.numberOfThreads.get() // max(1, self.tomos.getSize()))
+        nWorkers = max(1, min(threads, len(positions)))
+        chunks = np.array_split(positions, nWorkers)
+        if nWorkers == 1:
+            results = [utils.ballStatistics(fnMap, positions, self.radius.get())]
+        else:
+            # Workers are spawned, as forking inside a parallel step thread may deadlock
+            spawnContext = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=nWorkers, mp_context=spawnContext) as executor:
+                results = list(executor.map(utils.ballStatistics, [fnMap] * nWorkers, chunks,
+                                            [self.radius.get()] * nWorkers))
 
-                    # Create output object
-                    newCoord3D = Coordinate3D()
-                    newCoord3D.setVolume(tomo)
-                    newCoord3D.setX(x_pos[i], constants.BOTTOM_LEFT_CORNER)
-                    newCoord3D.setY(y_pos[i], constants.BOTTOM_LEFT_CORNER)
-                    newCoord3D.setZ(z_pos[i], constants.BOTTOM_LEFT_CORNER)
+        avg = np.concatenate([chunkAvg for chunkAvg, _ in results])
+        std = np.concatenate([chunkStd for _, chunkStd in results])
+        utils.writeXmdStatisticsFile(fnOut, positions, avg, std)
 
-                    newCoord3D._resAvg = Float(avg_i)
-                    newCoord3D._resStd = Float(std_i)
+    def createOutputStep(self, tomoId):
+        """ Generates a Xmipp metadata file (.xmd) containing the statistical information associated to
+        the each coordinate of a tomogram with information extracted from the resolution map, and appends the
+        coordinates that pass the filter to the output set. """
 
-                    newCoord3D.setVolId(tomoId)
-                    self.outputSetOfCoordinates3D.append(newCoord3D)
-                    self.outputSetOfCoordinates3D.update(newCoord3D)
+        self.getOutputSetOfCoordinates3D()
+        tomo = self.tomos[tomoId]
+        inputMdFileName = METADATA_COORDINATES_STATS + str(tomoId) + XMD_EXT
+        inputMdFile = self._getExtraPath(os.path.join(str(tomoId), inputMdFileName))
 
-            mdCoor.write(outputMdFile)
+        tom_fn = self.retrieveMap(tomoId).getFileName()
+        x_pos, y_pos, z_pos, avg, std = utils.readXmdStatisticsFile(inputMdFile)
 
-            self.outputSetOfCoordinates3D.write()
-            self._store()
+        # Selecting the coordinates that pass the filter, all at once
+        if self.filterOption.get() == self.NO_FILTER:
+            keep = np.ones(len(x_pos), dtype=bool)
+        else:
+            values, threshold = (avg, self.averageFilter.get()) if self.filterOption.get() == self.FILTER_AVERAGE \
+                else (std, self.stdFilter.get())
+            keep = values > threshold if self.thresholdDirection.get() else values < threshold
+
+        x_pos, y_pos, z_pos, avg, std = (np.asarray(column)[keep] for column in (x_pos, y_pos, z_pos, avg, std))
+
+        utils.writeXmdBlock(self._getExtraPath(str(tomoId), OUTPUT_XMD_COORS),
+                            OrderedDict([(emlib.MDL_IMAGE, np.full(len(avg), tom_fn, dtype=object)),
+                                         (emlib.MDL_AVG, avg),
+                                         (emlib.MDL_STDDEV, std),
+                                         (emlib.MDL_XCOOR, x_pos.astype(int)),
+                                         (emlib.MDL_YCOOR, y_pos.astype(int)),
+                                         (emlib.MDL_ZCOOR, z_pos.astype(int))]))
+
+        # Create output objects. Coordinates are appended always in the same order, so those already appended by a
+        # previous interrupted run of this step are skipped
+        nAppended = sum(1 for _ in self.outputSetOfCoordinates3D.iterItems(where='_volId=%d' % tomoId))
+        columns = (x_pos.tolist(), y_pos.tolist(), z_pos.tolist(), avg.tolist(), std.tolist())
+        for x, y, z, avg_i, std_i in list(zip(*columns))[nAppended:]:
+            newCoord3D = Coordinate3D()
+            newCoord3D.setVolume(tomo)
+            newCoord3D.setX(x, constants.BOTTOM_LEFT_CORNER)
+            newCoord3D.setY(y, constants.BOTTOM_LEFT_CORNER)
+            newCoord3D.setZ(z, constants.BOTTOM_LEFT_CORNER)
+
+            newCoord3D._resAvg = Float(avg_i)
+            newCoord3D._resStd = Float(std_i)
+
+            newCoord3D.setVolId(tomoId)
+            self.outputSetOfCoordinates3D.append(newCoord3D)
+
+        self.outputSetOfCoordinates3D.write()
+        self._store()
 
     def closeOutputSets(self):
         if hasattr(self, "outputSetOfCoordinates3D"):
@@ -225,15 +274,12 @@ class XmippProtFilterCoordinatesByMap(EMProtocol, ProtTomoBase):
     def retrieveMap(self, tomoId):
         """ This method return a the given mask/resolution map from the input set given the correspondent tomoId. """
 
-        found = False
+        tomo = self.mapIndex.get(tomoId)
 
-        for tomo in self.inputSetOfTomograms.get():
-            if tomo.getObjId() == tomoId:
-                found = True
-                return tomo
+        if tomo is None:
+            raise Exception("Not map found in input set with tomoId with value %s" % tomoId)
 
-        if not found:
-            raise Exception("Not map found in input set with tomoId with value" + tomoId)
+        return tomo
 
     def getOutputSetOfCoordinates3D(self):
         if hasattr(self, "outputSetOfCoordinates3D"):
@@ -189,22 +189,24 @@ class XmippProtPeakHighContrast(EMProtocol, ProtTomoBase):
 
         outputSetOfCoordinates3D = self.getOutputSetOfCoordinates3Ds()
 
-        coordList = utils.retrieveXmipp3dCoordinatesIntoList(outputFilePath)
-
-        if not coordList:
+        nCoordinates = 0
+        for coordinates in utils.iterXmipp3dCoordinates(outputFilePath):
+            nCoordinates += len(coordinates)
+
+            for x, y, z in coordinates.tolist():
+                newCoord3D = Coordinate3D()
+                newCoord3D.setVolume(vol)
+                newCoord3D.setX(x, constants.BOTTOM_LEFT_CORNER)
+                newCoord3D.setY(y, constants.BOTTOM_LEFT_CORNER)
+                newCoord3D.setZ(z, constants.BOTTOM_LEFT_CORNER)
+
+                newCoord3D.setVolId(volObjId)
+                outputSetOfCoordinates3D.append(newCoord3D)
+                outputSetOfCoordinates3D.update(newCoord3D)
+
+        if not nCoordinates:
             print("WARNING: no coordinates picked in tomogram " + volFileName)
 
-        for element in coordList:
-            newCoord3D = Coordinate3D()
-            newCoord3D.setVolume(vol)
-            newCoord3D.setX(element[0], constants.BOTTOM_LEFT_CORNER)
-            newCoord3D.setY(element[1], constants.BOTTOM_LEFT_CORNER)
-            newCoord3D.setZ(element[2], constants.BOTTOM_LEFT_CORNER)
-
-            newCoord3D.setVolId(volObjId)
-            outputSetOfCoordinates3D.append(newCoord3D)
-            outputSetOfCoordinates3D.update(newCoord3D)
-
         outputSetOfCoordinates3D.write()
         self._store()
 
@@ -27,30 +27,46 @@
 # **************************************************************************
 
 # General imports
-import os, math
-from typing import Tuple, Union, Dict
+import os
+import threading
+import zipfile
+from typing import Tuple, Union, Dict, List
+import numpy as np
 from emtable import Table
 
 # Scipion em imports
 from pwem.protocols import EMProtocol
-from pwem.objects import SetOfParticles, CTFModel, Float, Volume
-from pwem.emlib import MetaData, metadata, MDL_CTF_PHASE_SHIFT, MDL_CTF_DEFOCUSU
-from pwem.emlib import MDL_CTF_DEFOCUSV, MDL_CTF_DEFOCUS_ANGLE, MDL_ANGLE_TILT
+from pwem.objects import SetOfParticles, Volume
+from pwem.emlib import MetaData, MDL_CTF_PHASE_SHIFT, MDL_CTF_DEFOCUSU, MDL_IMAGE, MDL_PARTICLE_ID
+from pwem.emlib import MDL_CTF_DEFOCUSV, MDL_CTF_DEFOCUS_ANGLE, MDL_ANGLE_TILT, MDL_ANGLE_ROT, MDL_ANGLE_PSI
+from pwem.emlib import MDL_SHIFT_X, MDL_SHIFT_Y, MDL_ENABLED, lib
+from pwem.emlib.image import ImageHandler
+from pwem.emlib.metadata import iterRows
+from pwem.constants import ALIGN_PROJ
 from pyworkflow import BETA
+from pyworkflow.object import Set
 from pyworkflow.protocol import params
-from pyworkflow.utils import Message
+from pyworkflow.utils import Message, cleanPath
 
 # External plugin imports
 from tomo.protocols import ProtTomoBase
-from tomo.objects import SubTomogram, Coordinate3D, TiltSeries, TomoAcquisition, SetOfSubTomograms
-from xmipp3.convert import readSetOfParticles
+from tomo.objects import SubTomogram, Coordinate3D, TomoAcquisition, SetOfSubTomograms
+from xmipp3.convert import rowToParticle
 
 # Plugin imports
-from ..utils import calculateRotationAngleAndShiftsFromTM
+from ..utils import calculateRotationAnglesAndShiftsFromTMStack, getTiltImageMatrix, projectVolumeFourier, mrcMemmap
 
 # Protocol output variable name
 OUTPUTATTRIBUTE = 'outputSetOfParticles'
 
+def projectSubtomogram(subtomogramFile: str, rot: np.ndarray, tilt: np.ndarray, psi: np.ndarray,
+                       pad: int, maxFreq: float, order: int) -> np.ndarray:
+    """
+    This function returns the projections of the given subtomogram file along all the given directions.
+    """
+    volume = ImageHandler().read(subtomogramFile).getData()
+    return projectVolumeFourier(volume, rot, tilt, psi, pad=pad, maxFreq=maxFreq, order=order)
+
 class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
     """Extracts proyections from subtomograms"""
 
@@ -69,12 +85,20 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
     INTERPOLATION_BSPLINE = 0
     INTERPOLATION_NEAREST = 1
     INTERPOLATION_LINEAR = 2
+    ENGINE_XMIPP = 0
+    ENGINE_NUMPY = 1
 
     # Emtable star file column names (temporary)
     COLUMN_ANGLE_PSI = 'anglePsi'
     COLUMN_ANGLE_ROT = 'angleRot'
     COLUMN_ANGLE_TILT = 'angleTilt'
 
+    # Defocus index keys
+    DEFOCUS_INDEX_TILT = 'tiltAngles'
+    DEFOCUS_INDEX_DEFOCUSU = 'defocusU'
+    DEFOCUS_INDEX_DEFOCUSV = 'defocusV'
+    DEFOCUS_INDEX_SAMPLING = 'samplingRate'
+
     # --------------------------- Class constructor --------------------------------------------
     def __init__(self, **args):
         # Calling parent class constructor
@@ -85,6 +109,9 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         # https://scipion-em.github.io/docs/release-3.0.0/docs/developer/parallelization.html
         self.stepsExecutionMode = params.STEPS_PARALLEL
 
+        # The angle dictionary is shared by the parallel steps
+        self._angleDictLock = threading.Lock()
+
     # --------------------------- DEFINE param functions ------------------------
     def _defineParams(self, form):
         # Defining parallel arguments
@@ -102,12 +129,25 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
                         help='This flag must be put if the defocus increases or decreases along the z-axis. This is required to set the local CTF.')
         form.addParam('cleanTmps', params.BooleanParam, default=True, label='Clean temporary files: ', expertLevel=params.LEVEL_ADVANCED,
                         help='Clean temporary files after finishing the execution.\nThis is useful to reduce unnecessary disk usage.')
+        form.addParam('projectionEngine', params.EnumParam, display=params.EnumParam.DISPLAY_COMBO, default=self.ENGINE_XMIPP,
+                        choices=['Xmipp', 'NumPy'], label="Projection engine: ", expertLevel=params.LEVEL_ADVANCED,
+                        help='Select the engine that will generate the projections:\n\n'
+                            '*Xmipp*: Projections are generated by xmipp_phantom_project.\n'
+                            '*NumPy*: Projections are generated in-process by means of the Fourier central slice theorem. '
+                            'The Fourier transform of each subtomogram is computed once and reused for all the angles, and the chunks '
+                            'of subtomograms are projected in parallel steps. No Xmipp binaries nor temporary files are needed.')
         form.addParam('transformMethod', params.EnumParam, display=params.EnumParam.DISPLAY_COMBO, default=self.METHOD_FOURIER,
+                        condition=f'projectionEngine=={self.ENGINE_XMIPP}',
                         choices=['Fourier', 'Real space', 'Shears'], label="Transform method: ", expertLevel=params.LEVEL_ADVANCED,
                         help='Select the algorithm that will be used to obtain the projections.')
+        form.addParam('subtomosPerStep', params.IntParam, default=50, label='Subtomograms per step: ', expertLevel=params.LEVEL_ADVANCED,
+                        help='Number of subtomograms projected within each step of the protocol. The projections of all the subtomograms '
+                            'of a step are stored in a single stack and a single metadata file.\n'
+                            'Bigger values reduce the number of steps and output files, while smaller values allow a finer parallelization.')
         
         # Parameter group for fourier transform method
-        fourierGroup = form.addGroup('Fourier parameters', condition=f"transformMethod=={self.METHOD_FOURIER}", expertLevel=params.LEVEL_ADVANCED)
+        fourierGroup = form.addGroup('Fourier parameters', condition=f"transformMethod=={self.METHOD_FOURIER} or projectionEngine=={self.ENGINE_NUMPY}",
+                                     expertLevel=params.LEVEL_ADVANCED)
         fourierGroup.addParam('pad', params.IntParam, default=2, label="Pad: ", help="Controls the padding factor.")
         fourierGroup.addParam('maxfreq', params.FloatParam, default=0.25, label="Maximum frequency: ",
                                 help="Maximum frequency for the pixels.\nBy default, pixels with frequency more than 0.25 are not considered.")
@@ -138,44 +178,55 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         # Defining list of function ids to be waited by the createOutput function
         paramDeps = []
 
-        if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES:
-            # Obtaining list of angle tilts and rots per Tilt Series
-            angles = self.getAngleDictionary()
-
-            # Generating a metadata angle file and a param file for each Tilt Series
-            for tsId in angles:
-                # Getting metadata angle file path
-                angleFile = self.getAngleFileAbsolutePath(tsId)
-
-                # Generating metadata angle file with Tilt Series's data
-                angTable = Table(columns=[self.COLUMN_ANGLE_PSI, self.COLUMN_ANGLE_ROT, self.COLUMN_ANGLE_TILT])
-                for values in angles[tsId]:
-                    angTable.addRow(
-                        0.0,                            # anglePsi
-                        values[self.COLUMN_ANGLE_ROT],  # angleRot
-                        values[self.COLUMN_ANGLE_TILT]  # angleTilt
-                    )
-                angTable.write(angleFile, tableName='projectionAngles')
-                
-                # Generating param file
-                paramDeps.append(self._insertFunctionStep(self.generateParamFile, tsId))
+        # Obtaining list of angle tilts and rots per Tilt Series before any step runs, for both engines
+        angles = self.getAngleDictionary()
+
+        # Param and angle files are only needed by xmipp_phantom_project
+        if self.projectionEngine.get() == self.ENGINE_XMIPP:
+            if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES:
+                # Generating a metadata angle file and a param file for each Tilt Series
+                for tsId in angles:
+                    # Getting metadata angle file path
+                    angleFile = self.getAngleFileAbsolutePath(tsId)
+
+                    # Generating metadata angle file with Tilt Series's data
+                    angTable = Table(columns=[self.COLUMN_ANGLE_PSI, self.COLUMN_ANGLE_ROT, self.COLUMN_ANGLE_TILT])
+                    for angleRot, angleTilt in zip(angles[tsId][self.COLUMN_ANGLE_ROT], angles[tsId][self.COLUMN_ANGLE_TILT]):
+                        angTable.addRow(
+                            0.0,                # anglePsi
+                            float(angleRot),    # angleRot
+                            float(angleTilt)    # angleTilt
+                        )
+                    angTable.write(angleFile, tableName='projectionAngles')
+            
+                    # Generating param file
+                    paramDeps.append(self._insertFunctionStep(self.generateParamFile, tsId))
 
-        else:
-            # If type of generation is not from Tilt Series, generate single param file
-            paramDeps.append(self._insertFunctionStep(self.generateParamFile))
-        
-        # Generating projections for each subtomogram
+            else:
+                # If type of generation is not from Tilt Series, generate single param file
+                paramDeps.append(self._insertFunctionStep(self.generateParamFile))
+
+        # Generating projections for each chunk of subtomograms sharing param file
         generationDeps = []
-        for subtomogram in self.inputSubtomograms.get():
-            tsId = '' if self.tiltTypeGeneration.get() != self.TYPE_TILT_SERIES or len([ts for ts in self.tiltRangeTS.get()]) == 1 else subtomogram.getCoordinate3D().getTomoId()
-            generationDeps.append(self._insertFunctionStep(self.generateSubtomogramProjections, subtomogram.getFileName(), tsId, prerequisites=paramDeps))
+        for chunkId, (tsId, subtomograms) in enumerate(self.getSubtomogramChunks()):
+            if self.projectionEngine.get() == self.ENGINE_XMIPP:
+                generationDeps.append(self._insertFunctionStep(self.generateChunkProjections, chunkId, tsId, subtomograms, prerequisites=paramDeps))
+            else:
+                generationDeps.append(self._insertFunctionStep(self.generateChunkProjectionsNumpy, chunkId, tsId, subtomograms, prerequisites=paramDeps))
         
         # Conditionally removing temporary files
-        if self.cleanTmps.get():
-            self._insertFunctionStep(self.removeTempFiles, prerequisites=generationDeps)
+        closeDeps = []
+        if self.cleanTmps.get() and self.projectionEngine.get() == self.ENGINE_XMIPP:
+            closeDeps.append(self._insertFunctionStep(self.removeTempFiles, prerequisites=generationDeps))
         
-        # Create output
-        self._insertFunctionStep(self.createOutputStep, prerequisites=generationDeps)
+        # Appending the particles of each chunk to the output as soon as its projections are ready
+        # Output steps are chained so only one of them writes into the output set at a time
+        outputDeps = []
+        for chunkId, generationDep in enumerate(generationDeps):
+            outputDeps.append(self._insertFunctionStep(self.createOutputStep, chunkId, prerequisites=[generationDep] + outputDeps[-1:]))
+
+        # Closing the output set
+        self._insertFunctionStep(self.closeOutputStep, prerequisites=outputDeps + closeDeps)
 
     # --------------------------- STEPS functions --------------------------------------------
     def generateParamFile(self, tsId: str=''):
@@ -209,6 +260,85 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         with open(self.getXmippParamPath(tsId=tsId), "w") as paramFile:
             paramFile.write(content)
 
+    def generateChunkProjections(self, chunkId: int, tsId: str, subtomograms: List[List]):
+        """
+        This function generates the projections for a chunk of subtomograms that share the same param file.
+        The projections of the whole chunk are stored in a single stack described by a single metadata file.
+        Each element of the subtomogram list is a pair [subtomogram id, subtomogram file].
+        """
+        # Projecting every subtomogram of the chunk
+        for _, subtomogramFile in subtomograms:
+            self.generateSubtomogramProjections(subtomogramFile, tsId)
+
+        # Reading the metadata of each subtomogram's projections
+        subtomogramMds = [MetaData(self.getProjectionMetadataAbsolutePath(subtomogramFile)) for _, subtomogramFile in subtomograms]
+
+        # Creating the chunk stack with the known number of projections
+        chunkStack = self.getChunkProjectionPath(chunkId)
+        dimensions = self.getSubtomogramDimensions().split(' ')
+        lib.createEmptyFile(chunkStack, int(dimensions[0]), int(dimensions[1]), 1, sum(mdSub.size() for mdSub in subtomogramMds))
+
+        # Moving every projection to the chunk stack, filled in place through a memory map, and merging the metadata files
+        ih = ImageHandler()
+        stack = mrcMemmap(chunkStack)
+        mdChunk = MetaData()
+        index = 1
+        for (subtomogramId, subtomogramFile), mdSub in zip(subtomograms, subtomogramMds):
+            newLocations = []
+            for location in mdSub.getColumnValues(MDL_IMAGE):
+                stack[index - 1] = np.squeeze(ih.read(location).getData())
+                newLocations.append('%06d@%s' % (index, chunkStack))
+                index += 1
+            mdSub.setColumnValues(MDL_IMAGE, newLocations)
+            mdSub.setColumnValues(MDL_PARTICLE_ID, [subtomogramId] * mdSub.size())
+            mdChunk.unionAll(mdSub)
+
+            # Removing the subtomogram's own projection files
+            cleanPath(self.getProjectionAbsolutePath(subtomogramFile), self.getProjectionMetadataAbsolutePath(subtomogramFile))
+
+        stack.flush()
+        del stack
+        mdChunk.write(self.getChunkMetadataPath(chunkId))
+
+    def generateChunkProjectionsNumpy(self, chunkId: int, tsId: str, subtomograms: List[List]):
+        """
+        This function generates in-process the projections for a chunk of subtomograms that share the same angles.
+        Chunks are projected in parallel steps and the projections of the whole chunk are stored in a single stack,
+        filled through a memory map, described by a single metadata file.
+        Each element of the subtomogram list is a pair [subtomogram id, subtomogram file].
+        """
+        # Obtaining projection angles and interpolation order
+        rot, tilt, psi = self.getProjectionAngles(tsId)
+        nAngles = len(tilt)
+        order = {self.INTERPOLATION_BSPLINE: 3, self.INTERPOLATION_NEAREST: 0, self.INTERPOLATION_LINEAR: 1}[self.interp.get()]
+
+        # Creating the chunk stack with the known number of projections
+        chunkStack = self.getChunkProjectionPath(chunkId)
+        dimensions = self.getSubtomogramDimensions().split(' ')
+        lib.createEmptyFile(chunkStack, int(dimensions[0]), int(dimensions[1]), 1, nAngles * len(subtomograms))
+
+        # Projecting the subtomograms and writing the projections in place
+        stack = mrcMemmap(chunkStack)
+        for subtomogramIndex, (_, subtomogramFile) in enumerate(subtomograms):
+            stack[subtomogramIndex * nAngles:(subtomogramIndex + 1) * nAngles] = \
+                projectSubtomogram(subtomogramFile, rot, tilt, psi, self.pad.get(), self.maxfreq.get(), order)
+        stack.flush()
+        del stack
+
+        # Writing the chunk metadata, column by column
+        mdChunk = MetaData()
+        for _ in range(nAngles * len(subtomograms)):
+            mdChunk.addObject()
+        mdChunk.setColumnValues(MDL_IMAGE, ['%06d@%s' % (index, chunkStack) for index in range(1, nAngles * len(subtomograms) + 1)])
+        mdChunk.setColumnValues(MDL_ENABLED, [1] * mdChunk.size())
+        mdChunk.setColumnValues(MDL_ANGLE_ROT, np.tile(rot, len(subtomograms)).tolist())
+        mdChunk.setColumnValues(MDL_ANGLE_TILT, np.tile(tilt, len(subtomograms)).tolist())
+        mdChunk.setColumnValues(MDL_ANGLE_PSI, np.tile(psi, len(subtomograms)).tolist())
+        mdChunk.setColumnValues(MDL_SHIFT_X, [0.0] * mdChunk.size())
+        mdChunk.setColumnValues(MDL_SHIFT_Y, [0.0] * mdChunk.size())
+        mdChunk.setColumnValues(MDL_PARTICLE_ID, [subtomogramId for subtomogramId, _ in subtomograms for _ in range(nAngles)])
+        mdChunk.write(self.getChunkMetadataPath(chunkId))
+
     def generateSubtomogramProjections(self, subtomogram: Union[SubTomogram, Volume, str], tsId: str=''):
         """
         This function generates the projection for a given input subtomogram.
@@ -244,60 +374,62 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         # Removing items
         self.runJob('rm -f', ' '.join(removeList))
 
-    def createOutputStep(self):
+    def createOutputStep(self, chunkId: int):
         """
-        This function generates the outputs of the protocol.
+        This function appends the projections of the given chunk to the output set of particles.
+        CTF values are computed in memory and the chunk metadata file is written only once.
         """
-        # Extracting input
-        inputSubtomograms = self.inputSubtomograms.get()
-
-        # Creating empty set of particles and setting sampling rate, alignment, and dimensions
-        outputSetOfParticles = self._createSetOfParticles()
-        outputSetOfParticles.setSamplingRate(inputSubtomograms.getSamplingRate())
-        outputSetOfParticles.setAlignmentProj()
-        dimensions = self.getSubtomogramDimensions().split(' ')
-        outputSetOfParticles.setDim((int(dimensions[0]), int(dimensions[1]), 1))
-
-        # Setting acquisition info
-        acquisition = TomoAcquisition()
-        acquisition.copyInfo(inputSubtomograms.getAcquisition())
-        outputSetOfParticles.setAcquisition(acquisition)
-
-
-        # Getting input element list
-        inputList = [subtomogram.getFileName() for subtomogram in inputSubtomograms]
-
-        # Adding projections of each subtomogram as a particle each
-        for subtomogram in inputList:
-            # Setting CTF for every output particle
-            mdCtf = MetaData(self.getProjectionMetadataAbsolutePath(subtomogram))
-            for row in metadata.iterRows(mdCtf):
-                # If CTF does not exist or has been corrected, set some values to 0
-                row.setValue(MDL_CTF_PHASE_SHIFT, 0.0)
-                if self.hasCtfCorrected:
-                    row.setValue(MDL_CTF_DEFOCUSU, 0.0)
-                    row.setValue(MDL_CTF_DEFOCUSV, 0.0)
-                    row.setValue(MDL_CTF_DEFOCUS_ANGLE, 0.0)
-                else:
-                    # Calculate subtomogram coordinates on the Tilt Series
-                    defU, defV = self.getCorrectedDefocus(row.getValue(MDL_ANGLE_TILT), subtomogram.getCoordinate3D())
-                    row.setValue(MDL_CTF_DEFOCUSU, defU)
-                    row.setValue(MDL_CTF_DEFOCUSV, defV)
-                    row.setValue(MDL_CTF_DEFOCUS_ANGLE, 0.0)
-                
-                # Add metadata row to file
-                row.writeToMd(mdCtf, row.getObjId())
-            
-            # Write metadata file with modified info
-            mdCtf.write(self.getProjectionMetadataAbsolutePath(subtomogram))
+        # Reading the chunk metadata file
+        chunkMetadataFile = self.getChunkMetadataPath(chunkId)
+        mdCtf = MetaData(chunkMetadataFile)
+        mdCtf.removeDisabled()
+        zeros = [0.0] * mdCtf.size()
 
-            # Add particles to set from metadata file
-            readSetOfParticles(self.getProjectionMetadataAbsolutePath(subtomogram), outputSetOfParticles)
-        
-        # Defining the ouput with summary and source relation
+        # Setting CTF for every output particle, all rows of the metadata at once
+        # If CTF does not exist or has been corrected, set some values to 0
+        mdCtf.setColumnValues(MDL_CTF_PHASE_SHIFT, zeros)
+        mdCtf.setColumnValues(MDL_CTF_DEFOCUS_ANGLE, zeros)
+        if self.hasCtfCorrected:
+            mdCtf.setColumnValues(MDL_CTF_DEFOCUSU, zeros)
+            mdCtf.setColumnValues(MDL_CTF_DEFOCUSV, zeros)
+        else:
+            # Calculate subtomogram defocus on the Tilt Series for every projection angle
+            inputSubtomograms = self.inputSubtomograms.get()
+            subtomogramIds = np.asarray(mdCtf.getColumnValues(MDL_PARTICLE_ID))
+            tiltAngles = np.asarray(mdCtf.getColumnValues(MDL_ANGLE_TILT), dtype=float)
+            defU, defV = np.zeros(len(tiltAngles)), np.zeros(len(tiltAngles))
+            for subtomogramId in np.unique(subtomogramIds):
+                rows = subtomogramIds == subtomogramId
+                coordinates = inputSubtomograms[int(subtomogramId)].getCoordinate3D().clone()
+                defU[rows], defV[rows] = self.getCorrectedDefocus(tiltAngles[rows], coordinates)
+            mdCtf.setColumnValues(MDL_CTF_DEFOCUSU, defU.tolist())
+            mdCtf.setColumnValues(MDL_CTF_DEFOCUSV, defV.tolist())
+
+        # Write metadata file with modified info
+        mdCtf.write(chunkMetadataFile)
+
+        # Adding the projections of the chunk as a particle each, straight from the in-memory metadata
+        # Projections already appended by a previous interrupted run of this step are skipped
+        outputSetOfParticles = self.getOutputSetOfParticles()
+        chunkStack = self.getChunkProjectionPath(chunkId)
+        appendedIndexes = {particle.getIndex() for particle in
+                           outputSetOfParticles.iterItems(where="_filename='%s'" % chunkStack)}
+        for row in iterRows(mdCtf):
+            particle = rowToParticle(row, alignType=ALIGN_PROJ)
+            if particle.getIndex() not in appendedIndexes:
+                outputSetOfParticles.append(particle)
+        outputSetOfParticles.write()
+        self._store(outputSetOfParticles)
+
+    def closeOutputStep(self):
+        """
+        This function closes the output set of particles once every chunk has been added.
+        """
+        outputSetOfParticles = self.getOutputSetOfParticles()
+        outputSetOfParticles.setStreamState(Set.STREAM_CLOSED)
         outputSetOfParticles.setObjComment(self.getSummary(outputSetOfParticles))
-        self._defineOutputs(outputSetOfParticles=outputSetOfParticles)
-        self._defineSourceRelation(self.inputSubtomograms, outputSetOfParticles)
+        outputSetOfParticles.write()
+        self._store(outputSetOfParticles)
 
     # --------------------------- INFO functions --------------------------------------------
     def _validate(self):
@@ -310,6 +442,14 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         if self.tiltTypeGeneration.get() == self.TYPE_N_SAMPLES and (self.tiltRangeNSamples.get() != None) and self.tiltRangeNSamples.get() < 1:
             errors.append('The number of samples cannot be less than 1.')
         
+        # Checking if the padding factor of the NumPy engine is at least 1
+        if self.projectionEngine.get() == self.ENGINE_NUMPY and self.pad.get() < 1:
+            errors.append('The padding factor must be 1 or greater.')
+
+        # Checking if the number of subtomograms per step is greater than 0
+        if self.subtomosPerStep.get() is not None and self.subtomosPerStep.get() < 1:
+            errors.append('The number of subtomograms per step must be greater than 0.')
+
         # Checking if the step is greater than 0
         if self.tiltTypeGeneration.get() == self.TYPE_STEP and (self.tiltRangeStep.get() != None) and self.tiltRangeStep.get() <= 0:
             errors.append('The step must be greater than 0.')
@@ -333,14 +473,14 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         error = ''
 
         # Checking if input projectable set can be related to Tilt Series when TS is selected as angle extraction method
-        if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES and len([ts for ts in self.tiltRangeTS.get()]) > 1:
+        if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES and self.tiltRangeTS.get().getSize() > 1:
             # Checking if input subtomograms are of class SetOfSubTomograms (SetOfVolumes can't have a Coordinate3D to link them to a TiltSeries)
             if not isinstance(self.inputSubtomograms.get(), SetOfSubTomograms):
                 error = 'Input subtomograms are not of a real set of subtomograms.\n'
             # Checking if input subtomograms do have a Coordinate3D and such Coordinate3D has a tomoId that matches a tsId
             else:
                 # Getting list of Tilt Series ids
-                tsIdList = [ts.getTsId() for ts in self.tiltRangeTS.get()]
+                tsIdList = set(self.tiltRangeTS.get().getUniqueValues('_tsId'))
 
                 for subtomogram in self.inputSubtomograms.get():
                     if not subtomogram.getCoordinate3D():
@@ -421,12 +561,99 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         """
         return os.path.splitext(self.getProjectionAbsolutePath(subtomogram))[0] + '.xmd'
     
+    def getChunkProjectionPath(self, chunkId: int) -> str:
+        """
+        This function returns the full path of the projection stack of a given chunk of subtomograms.
+        """
+        return os.path.abspath(self._getExtraPath(f'projections_{chunkId:06d}.mrcs'))
+
+    def getChunkMetadataPath(self, chunkId: int) -> str:
+        """
+        This function returns the full path of the metadata file of a given chunk of subtomograms.
+        """
+        return os.path.splitext(self.getChunkProjectionPath(chunkId))[0] + '.xmd'
+
+    def getSubtomogramChunks(self) -> List[Tuple[str, List[List]]]:
+        """
+        This function returns the list of chunks the input subtomograms are projected in.
+        Each chunk is a tuple containing the tsId of the param file shared by all of its subtomograms
+        and the list of pairs [subtomogram id, subtomogram file] of those subtomograms.
+        """
+        # Subtomograms are only linked to their own Tilt Series if there is more than one to choose from
+        linkToTiltSeries = self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES and self.tiltRangeTS.get().getSize() > 1
+
+        # Grouping subtomograms by the param file used to project them
+        groups = {}
+        for subtomogram in self.inputSubtomograms.get():
+            tsId = subtomogram.getCoordinate3D().getTomoId() if linkToTiltSeries else ''
+            groups.setdefault(tsId, []).append([subtomogram.getObjId(), subtomogram.getFileName()])
+
+        # Splitting each group in chunks of the requested size
+        chunkSize = self.subtomosPerStep.get()
+        return [(tsId, group[start:start + chunkSize]) for tsId, group in groups.items() for start in range(0, len(group), chunkSize)]
+
     def getAngleFileAbsolutePath(self, tsId: str) -> str:
         """
         This function returns the full path of a given tilt series's metadata angle file.
         """
         return os.path.abspath(self._getExtraPath(f'{tsId}.xmd'))
 
+    def getAngleDictionaryPath(self) -> str:
+        """
+        This function returns the path of the file where the angles of every Tilt Series are stored.
+        """
+        return self._getExtraPath('projectionAngles.npz')
+
+    def getAngleDictionaryKey(self) -> str:
+        """
+        This function returns a key identifying the input Tilt Series: the modification time of their set file
+        and the tsId and number of tilt images of each of them.
+        """
+        tiltSeries = self.tiltRangeTS.get()
+        fileName = tiltSeries.getFileName()
+        modificationTime = os.path.getmtime(fileName) if os.path.exists(fileName) else 0
+        return ' '.join(['%f' % modificationTime] + ['%s:%d' % (ts.getTsId(), ts.getSize()) for ts in tiltSeries])
+
+    def readAngleDictionary(self, inputKey: str) -> Union[Dict, None]:
+        """
+        This function returns the angle dictionary stored in the extra folder, or None if there is none,
+        it cannot be read or it does not come from the given input key.
+        """
+        angleFile = self.getAngleDictionaryPath()
+        if not os.path.exists(angleFile):
+            return None
+        try:
+            with np.load(angleFile) as angleData:
+                if 'inputKey' not in angleData.files or str(angleData['inputKey']) != inputKey:
+                    return None
+                # Angles of all Tilt Series are stored concatenated, with the start of each Tilt Series in the offset array
+                angleDict = {}
+                offsets, rot, tilt = angleData['offsets'], angleData['rot'], angleData['tilt']
+                for index, tsId in enumerate(angleData['tsIds']):
+                    tsSlice = slice(offsets[index], offsets[index + 1])
+                    angleDict[str(tsId)] = {self.COLUMN_ANGLE_ROT: rot[tsSlice], self.COLUMN_ANGLE_TILT: tilt[tsSlice]}
+                return angleDict
+        except (zipfile.BadZipFile, ValueError, OSError, KeyError, EOFError):
+            # A damaged file is computed again
+            return None
+
+    def writeAngleDictionary(self, angleDict: Dict, inputKey: str):
+        """
+        This function stores the angle dictionary as a compact array file, together with the key of the input it comes from.
+        The file is written with a temporary name and then renamed, so it is never read half written.
+        """
+        angleFile = self.getAngleDictionaryPath()
+        os.makedirs(os.path.dirname(angleFile), exist_ok=True)
+        tmpFile = '%s.%d.tmp' % (angleFile, os.getpid())
+        with open(tmpFile, 'wb') as f:
+            np.savez(f,
+                     inputKey=np.array(inputKey),
+                     tsIds=np.array(list(angleDict.keys()), dtype=str),
+                     rot=np.concatenate([angles[self.COLUMN_ANGLE_ROT] for angles in angleDict.values()] + [np.empty(0)]),
+                     tilt=np.concatenate([angles[self.COLUMN_ANGLE_TILT] for angles in angleDict.values()] + [np.empty(0)]),
+                     offsets=np.cumsum([0] + [len(angles[self.COLUMN_ANGLE_TILT]) for angles in angleDict.values()]))
+        os.replace(tmpFile, angleFile)
+
     def getStepValue(self) -> float:
         """
         This function translates the provided sample generation input to number of samples for Xmipp phantom project.
@@ -437,6 +664,20 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
             # Converting step to number of samples
             return ((self.tiltRangeStart.get() % 360) - (self.tiltRangeEnd.get() % 360)) / self.tiltRangeStep.get()
     
+    def getProjectionAngles(self, tsId: str='') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        This function returns the rot, tilt and psi angles the subtomograms linked to the given Tilt Series id are projected on.
+        Tilt ranges are sampled the same way xmipp_phantom_project does.
+        """
+        if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES:
+            angleDict = self.getAngleDictionary()
+            angles = angleDict[tsId] if tsId else next(iter(angleDict.values()))
+            rot, tilt = angles[self.COLUMN_ANGLE_ROT], angles[self.COLUMN_ANGLE_TILT]
+        else:
+            tilt = np.linspace(self.tiltRangeStart.get(), self.tiltRangeEnd.get(), max(1, int(round(abs(self.getStepValue())))))
+            rot = np.zeros(len(tilt))
+        return rot, tilt, np.zeros(len(tilt))
+
     def getMethodValue(self) -> str:
         """
         This function returns the string value associated to the form value provided by the user regarding transform method.
@@ -486,6 +727,35 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         """
         return os.path.join(os.path.dirname(self.getXmippParamPath()), 'reference.xmd')
     
+    def getOutputSetOfParticles(self) -> SetOfParticles:
+        """
+        This function returns the output set of particles, creating it in open stream state if it does not exist yet.
+        """
+        if hasattr(self, OUTPUTATTRIBUTE):
+            getattr(self, OUTPUTATTRIBUTE).enableAppend()
+        else:
+            # Extracting input
+            inputSubtomograms = self.inputSubtomograms.get()
+
+            # Creating empty set of particles and setting sampling rate, alignment, and dimensions
+            outputSetOfParticles = self._createSetOfParticles()
+            outputSetOfParticles.setSamplingRate(inputSubtomograms.getSamplingRate())
+            outputSetOfParticles.setAlignmentProj()
+            outputSetOfParticles.setHasCTF(True)
+            dimensions = self.getSubtomogramDimensions().split(' ')
+            outputSetOfParticles.setDim((int(dimensions[0]), int(dimensions[1]), 1))
+
+            # Setting acquisition info
+            acquisition = TomoAcquisition()
+            acquisition.copyInfo(inputSubtomograms.getAcquisition())
+            outputSetOfParticles.setAcquisition(acquisition)
+
+            # Defining the output in open stream state, so particles can be consumed while they are produced
+            outputSetOfParticles.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(**{OUTPUTATTRIBUTE: outputSetOfParticles})
+            self._defineSourceRelation(self.inputSubtomograms, outputSetOfParticles)
+        return getattr(self, OUTPUTATTRIBUTE)
+
     def getSummary(self, setOfParticles: SetOfParticles) -> str:
         """
         Returns the summary of a given set of particles.
@@ -493,74 +763,100 @@ class XmippProtProjectSubtomograms(EMProtocol, ProtTomoBase):
         """
         return "Number of projections generated: {}".format(setOfParticles.getSize())
 
-    def getCorrectedDefocus(self, tiltAngle: Float, coordinates: Coordinate3D) -> Tuple[Float, Float]:
+    def getCorrectedDefocus(self, tiltAngles: np.ndarray, coordinates: Coordinate3D) -> Tuple[np.ndarray, np.ndarray]:
         """
-        This function returns the corrected defocusU and defocusV given a tilt angle and
-        the coordinates of a subtomogram.
+        This function returns the corrected defocusU and defocusV given an array of tilt angles and
+        the coordinates of a subtomogram. Both outputs are arrays with one value per tilt angle.
         """
-        # Converting tilt angle to radians (received in degrees)
-        radiansTiltAngle = math.radians(tiltAngle)
-        
+        # Obtaining the defocus index of the Tilt Series the subtomogram comes from
+        tsIndex = self.getDefocusIndex()[coordinates.getTomoId()]
+
+        # Obtaining closest CTF to each tilt angle from current Tilt Series
+        tiltAngles = np.asarray(tiltAngles, dtype=float)
+        closest = self.getClosestTiltIndex(tsIndex[self.DEFOCUS_INDEX_TILT], tiltAngles)
+
         # Calculating defocus direction
         defocusDir = -1 if self.defocusDir.get() else 1
 
-        for ctf in self.inputCTF.get():
-            # From the input set of CTFs, get the Tilt Series of each CTF
-            ts = ctf.getTiltSeries()
-
-            # If the Tilt Series id matches the id of the tomogram where the
-            # subtomogram containing the given coordinates comes from, correct
-            # the defocus of the closest CTF to tilt angle from current Tilt Series
-            if (ts.getTsId() == coordinates.getTomoId()):
-                # Obtaining closest CTF to tilt angle from current Tilt Series
-                closestCTF = self.getClosestCTF(ts, tiltAngle)
-
-                # Obtain CTF's defocus
-                defocusU, defocusV = closestCTF.getDefocusU(), closestCTF.getDefocusV()
-                
-                # Obtain and return corrected defocus
-                generalDefocus = coordinates.getX() * math.sin(radiansTiltAngle) * ts.getSamplingRate()
-                correctedDefU = defocusU + defocusDir * generalDefocus
-                correctedDefV = defocusV + defocusDir * generalDefocus
-                return correctedDefU, correctedDefV
-
-    def getClosestCTF(self, tiltSeries: TiltSeries, tiltAngle: Float) -> CTFModel:
-        """
-        This function returns the Tilt Image's CTF inside a given
-        Tilt Series which is closest to the given tilt angle.
-        """
-        # Initial distance
-        distance = 360
-
-        # Find , 
-        for tiltImage in tiltSeries:
-            # Obtaining difference in tilt between given angle and tilt image angle
-            tiltDistance = abs(tiltAngle - tiltImage.getTiltAngle())
-
-            # If tilt difference is less than current distance, update distance and
-            # keep current image's CTF as current closest CTF
-            if tiltDistance < distance:
-                distance = tiltDistance
-                outputCTF = tiltImage.getCTF()
-        
-        # Returning closest CTF
-        return outputCTF
+        # Obtain and return corrected defocus (tilt angles received in degrees)
+        generalDefocus = coordinates.getX() * np.sin(np.radians(tiltAngles)) * tsIndex[self.DEFOCUS_INDEX_SAMPLING]
+        correctedDefU = tsIndex[self.DEFOCUS_INDEX_DEFOCUSU][closest] + defocusDir * generalDefocus
+        correctedDefV = tsIndex[self.DEFOCUS_INDEX_DEFOCUSV][closest] + defocusDir * generalDefocus
+        return correctedDefU, correctedDefV
+
+    def getDefocusIndex(self) -> Dict:
+        """
+        This function returns a dictionary that contains, for each Tilt Series of the input CTF,
+        the tilt angles of its images sorted in ascending order, their defocusU and defocusV,
+        and the sampling rate of the Tilt Series.
+        The index is only built once per run.
+        """
+        if getattr(self, '_defocusIndex', None) is None:
+            defocusIndex = {}
+            for ctf in self.inputCTF.get():
+                # From the input set of CTFs, get the Tilt Series of each CTF
+                ts = ctf.getTiltSeries()
+
+                # Storing tilt angle and defocus of the CTF of every tilt image
+                tiltAngles, defocusU, defocusV = [], [], []
+                for tiltImage in ts:
+                    tiltCTF = tiltImage.getCTF()
+                    tiltAngles.append(tiltImage.getTiltAngle())
+                    defocusU.append(tiltCTF.getDefocusU())
+                    defocusV.append(tiltCTF.getDefocusV())
+
+                # Sorting by tilt angle so the closest one can be found with a binary search
+                order = np.argsort(tiltAngles, kind='stable')
+                defocusIndex[ts.getTsId()] = {
+                    self.DEFOCUS_INDEX_TILT: np.asarray(tiltAngles, dtype=float)[order],
+                    self.DEFOCUS_INDEX_DEFOCUSU: np.asarray(defocusU, dtype=float)[order],
+                    self.DEFOCUS_INDEX_DEFOCUSV: np.asarray(defocusV, dtype=float)[order],
+                    self.DEFOCUS_INDEX_SAMPLING: ts.getSamplingRate()
+                }
+            self._defocusIndex = defocusIndex
+
+        return self._defocusIndex
+
+    @staticmethod
+    def getClosestTiltIndex(sortedTiltAngles: np.ndarray, tiltAngles: np.ndarray) -> np.ndarray:
+        """
+        This function returns, for each of the given tilt angles, the position inside
+        the ascending sorted tilt angle array of the closest tilt angle.
+        In case of a draw, the smallest tilt angle is chosen.
+        """
+        # Position of the first sorted tilt angle that is not smaller than each given angle
+        right = np.clip(np.searchsorted(sortedTiltAngles, tiltAngles), 1, len(sortedTiltAngles) - 1)
+        left = np.maximum(right - 1, 0)
+
+        # Keeping the closest of both neighbours
+        useRight = np.abs(sortedTiltAngles[right] - tiltAngles) < np.abs(tiltAngles - sortedTiltAngles[left])
+        return np.where(useRight, right, left)
     
     def getAngleDictionary(self) -> Dict:
         """
-        This function returs a dictionary containing all the angles of each Tilt Series of the input set
-        """
-        # Initializing empty dictionary
-        angleDict = {}
-        
-        if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES:
-            for ts in self.tiltRangeTS.get():
-                tsId = ts.getTsId()
-                # Adding angle list to dictionary
-                angleDict[tsId] = []
-                for ti in ts:
-                    # Add each angle tilt and rotation to the list
-                    angleDict[tsId].append({self.COLUMN_ANGLE_ROT: calculateRotationAngleAndShiftsFromTM(ti)[0], self.COLUMN_ANGLE_TILT: ti.getTiltAngle()})
+        This function returs a dictionary containing, for each Tilt Series of the input set,
+        the arrays of rotation and tilt angles of its tilt images.
+        The dictionary is computed only once and stored in the extra folder, so it is reused by every step
+        and is not recomputed when the protocol is continued, unless the input Tilt Series have changed.
+        """
+        with self._angleDictLock:
+            if getattr(self, '_angleDict', None) is None:
+                angleDict = {}
+                if self.tiltTypeGeneration.get() == self.TYPE_TILT_SERIES:
+                    inputKey = self.getAngleDictionaryKey()
+                    angleDict = self.readAngleDictionary(inputKey)
+                    if angleDict is None:
+                        angleDict = {}
+                        for ts in self.tiltRangeTS.get():
+                            # Adding the angle tilt and rotation of every tilt image to the dictionary
+                            matrices, tilt = [], []
+                            for ti in ts:
+                                matrices.append(getTiltImageMatrix(ti))
+                                tilt.append(ti.getTiltAngle())
+                            angleDict[ts.getTsId()] = {self.COLUMN_ANGLE_ROT: calculateRotationAnglesAndShiftsFromTMStack(matrices)[0],
+                                                       self.COLUMN_ANGLE_TILT: np.asarray(tilt, dtype=float)}
+                        self.writeAngleDictionary(angleDict, inputKey)
+                self._angleDict = angleDict
 
         # Returning result dictionary
-        return angleDict
+        return self._angleDict
@@ -24,13 +24,18 @@
 # *
 # **************************************************************************
 
+import glob
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy.spatial import cKDTree
 
 from pyworkflow import BETA
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
-from pyworkflow.object import Float
+from pyworkflow.object import Float, Set
 
 from pwem.emlib.image import ImageHandler
 import pwem.emlib.metadata as md
@@ -43,7 +48,33 @@ from tomo.protocols import ProtTomoPicking
 from tomo.utils import extractVesicles, initDictVesicles
 import tomo.constants as const
 
-from xmipptomo import Plugin
+from xmipptomo import Plugin, __version__
+from xmipptomo.utils import projectTomogram, fileSha256
+
+OUTLIERS_NEIGHBOURS = 10
+ZSCORE_GLOBAL = 0
+ZSCORE_VESICLE = 1
+CLEANER_MODEL = ('deepMicrographCleaner', 'defaultModel.keras')
+CARBON_CACHE_DIR = 'CarbonMaskCache'
+
+
+def vesicleNeighbourDistances(vesicles, k=OUTLIERS_NEIGHBOURS, workers=1):
+    '''Mean distance from every point of each vesicle to its k-1 closest neighbours
+    (the point itself is the first neighbour). A single KD-tree query is done per vesicle'''
+    distances = []
+    for vesicle in vesicles:
+        vesicle = np.asarray(vesicle, dtype=float)
+        distance, _ = cKDTree(vesicle).query(vesicle, k=k, workers=workers)
+        distances.append(np.mean(distance[:, 1:], axis=1))
+    return distances
+
+
+def zScores(distribution):
+    '''Absolute Z-Score of a distribution. A constant distribution gets a null score'''
+    std = np.std(distribution)
+    if std == 0:
+        return np.zeros(len(distribution))
+    return np.abs((distribution - np.mean(distribution)) / std)
 
 
 class XmippProtScoreCoordinates(ProtTomoPicking):
@@ -53,6 +84,10 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
     _label = 'score/filter coordinates'
     _devStatus = BETA
 
+    def __init__(self, **args):
+        ProtTomoPicking.__init__(self, **args)
+        self.stepsExecutionMode = params.STEPS_PARALLEL
+
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addHidden(params.USE_GPU, params.BooleanParam, default=True,
@@ -74,6 +109,12 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
                             'filter out unwanted coordinates based on a threshold')
         form.addParam('outliers', params.BooleanParam, default=True,
                       label="Score outluiers?")
+        form.addParam('outliersZScore', params.EnumParam, choices=['global', 'per vesicle'],
+                      default=ZSCORE_GLOBAL, display=params.EnumParam.DISPLAY_HLIST,
+                      condition='outliers == True', expertLevel=params.LEVEL_ADVANCED,
+                      label='Outliers Z-Score scope',
+                      help='Compute the Z-Score of the neighbour distances with respect to all the '
+                           'coordinates (global) or only with respect to the coordinates of the same vesicle')
         form.addParam('outliersThreshold', params.FloatParam, default=1,
                       label="Outliers distance threshold", condition='outliers == True and filter == 1',
                       help='Z-Score value from 0 to infinite. Only coordinates with a Z-Score smaller than '
@@ -84,19 +125,48 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
                       label="Carbon distance threshold", condition='carbon == True and filter == 1',
                       help='Score value between 0 and 1. Only coordinates with a score larger than or equal '
                            'to the threshold will be kept in the output')
+        form.addParam('projectionSlab', params.IntParam, default=0,
+                      condition='carbon == True', expertLevel=params.LEVEL_ADVANCED,
+                      label='Projection slab thickness (px)',
+                      help='Thickness of the Z slab, centered at the median height of the coordinates, that is '
+                           'projected to detect the carbon. If 0, the whole tomogram is projected')
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      condition='carbon == True', expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached carbon masks?',
+                      help='Predicted carbon masks and carbon scores are cached in the project, indexed by the '
+                           'content of the tomogram, the coordinates, the box size and the cleaner model. If the '
+                           'same data were already scored by other run, the cleaner is not executed again, so '
+                           'changing the carbon threshold only needs to read the cached scores.\n'
+                           'The cache is stored in the %s folder of the project, outside the runs, so it is '
+                           'kept when runs are deleted. It can be safely removed at any time to free '
+                           'disk space' % CARBON_CACHE_DIR)
+        form.addParallelSection(threads=4, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        pwutils.makePath(self._getExtraPath('inputCoords'))
-        pwutils.makePath(self._getExtraPath('outputCoords'))
         coordinates = self.inputCoordinates.get()
         self.tomos = coordinates.getPrecedents()
-        self._insertFunctionStep('computeParams', coordinates)
+        self.carbonCacheDirs = {}
+        paramsId = self._insertFunctionStep('computeParams', coordinates, prerequisites=[])
+        scoreDeps = [paramsId]
         if self.outliers.get():
-            self._insertFunctionStep('detectOutliers')
-        if self.carbon.get():
-            self._insertFunctionStep('detectCarbonCloseness', coordinates)
-        self._insertFunctionStep('createOutputStep', coordinates)
+            scoreDeps = [self._insertFunctionStep('detectOutliers', prerequisites=[paramsId])]
+        cleanerDeps = []
+        outputDeps = []
+        for tomo in coordinates.getPrecedentsInvolved().values():
+            tomoId = tomo.getObjId()
+            tomoDeps = list(scoreDeps)
+            if self.carbon.get():
+                projectId = self._insertFunctionStep('projectTomoStep', tomoId, coordinates, prerequisites=[])
+                # Several GPU inferences at the same time would compete for the same devices
+                previousDeps = cleanerDeps[-1:] if self.useGpu.get() else []
+                cleanerDeps.append(self._insertFunctionStep('detectCarbonCloseness', tomoId, coordinates,
+                                                            prerequisites=[projectId] + previousDeps))
+                tomoDeps.append(cleanerDeps[-1])
+            # Output steps append to the same set, so they are chained
+            outputDeps.append(self._insertFunctionStep('createOutputStep', tomoId, coordinates,
+                                                       prerequisites=tomoDeps + outputDeps[-1:]))
+        self._insertFunctionStep('closeOutputSetStep', prerequisites=scoreDeps + outputDeps)
 
     def computeParams(self, coordinates):
         self.tomo_vesicles, self.tomoNames = initDictVesicles(coordinates)
@@ -104,114 +174,224 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
             self.tomo_vesicles = extractVesicles(coordinates, self.tomo_vesicles, tomoName)
 
     def detectOutliers(self):
-        self.scoreOutliers = {}
-        self.scoreOutliers = []
-        distribution = []
-        for tomoName in self.tomoNames:
-            for idv, vesicle in enumerate(self.tomo_vesicles[tomoName]['vesicles']):
-                tree = cKDTree(vesicle)
-                for idp, point in enumerate(vesicle):
-                    distance, _ = tree.query(point, k=10)
-                    distribution.append(np.mean(distance[1:]))
-                    self.scoreOutliers.append([self.tomo_vesicles[tomoName]['ids'][idv][idp], 0])
-
-        distribution = np.asarray(distribution)
-        z_scores = np.abs((distribution - np.mean(distribution)) / np.std(distribution))
-        for idn in range(len(self.scoreOutliers)):
-            self.scoreOutliers[idn][1] = z_scores[idn]
-
-    def detectCarbonCloseness(self, coordinates):
-        pwutils.makePath(self._getExtraPath('carbonMask'))
-        self.scoreCarbon = []
-        for tomoName in self.tomoNames:
-            idt = self.tomo_vesicles[tomoName]["volId"]
-            tomo = self.tomos[idt].clone()
-            projFile = self.projectTomo(tomo)
-            inputTomoPathMetadataFname = self._getTmpPath("inputTomo.xmd")
-            tomo_md = createMetaDataFromPattern(projFile)
-            tomo_md.write(inputTomoPathMetadataFname)
-            coordList = self.generateCoordList(tomo, coordinates)
-            self.writeTomoCoordinates(tomo, coordList, self._getTomoPos(projFile))
-            args = '-i %s -c %s -o %s -b %d --predictedMaskDir %s' \
-                   % (inputTomoPathMetadataFname, self._getExtraPath('inputCoords'),
-                      self._getExtraPath('outputCoords'), coordinates.getBoxSize(),
-                      self._getExtraPath('carbonMask'))
-
-            if self.useGpu.get():
-                gpu_list = ','.join([str(elem) for elem in self.getGpuList()])
-                args += " -g %s" % gpu_list
-            else:
-                args += " -g -1"
-
-            self.runJob('xmipp_deep_micrograph_cleaner', args, env=Plugin.getTensorFlowEnviron())
-            baseName = pwutils.removeBaseExt(projFile)
-            outFile = self._getExtraPath('outputCoords', baseName + ".pos")
-            posMd = readPosCoordinates(outFile)
-            posMd.addLabel(md.MDL_ITEM_ID)
-            for objId in posMd:
-                if posMd.getValue(md.MDL_ENABLED, objId) == 0:
-                    posMd.setValue(md.MDL_ENABLED, 1, objId)
-                coord = rowToCoordinate(rowFromMd(posMd, objId))
-                self.scoreCarbon.append([posMd.getValue(md.MDL_ITEM_ID, objId),
-                                         coord._xmipp_goodRegionScore.get()])
-            pwutils.cleanPath(projFile)
-
-    def createOutputStep(self, coordinates):
-        outSet = self._createSetOfCoordinates3D(coordinates)
-        outSet.setPrecedents(coordinates.getPrecedents())
-        outSet.setBoxSize(coordinates.getBoxSize())
-        outSet.setSamplingRate(coordinates.getSamplingRate())
-        scoreCarbon = dict(self.scoreCarbon) if self.carbon.get() else None
-        scoreOutliers = dict(self.scoreOutliers) if self.outliers.get() else None
-
-        for coord in coordinates.iterCoordinates():
+        threads = max(1, self.numberOfThreads.get())
+        nWorkers = max(1, min(threads, len(self.tomoNames)))
+        treeWorkers = max(1, threads // nWorkers)
+        vesiclesList = [self.tomo_vesicles[tomoName]['vesicles'] for tomoName in self.tomoNames]
+        # Threads instead of forked processes, as this runs inside a parallel step thread. The KD-tree
+        # queries release the GIL
+        with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+            tomoDistances = list(executor.map(vesicleNeighbourDistances, vesiclesList,
+                                              [OUTLIERS_NEIGHBOURS] * len(vesiclesList),
+                                              [treeWorkers] * len(vesiclesList)))
+
+        ids = []
+        distributions = []
+        for tomoName, distances in zip(self.tomoNames, tomoDistances):
+            ids.extend(np.asarray(vesicleIds) for vesicleIds in self.tomo_vesicles[tomoName]['ids'])
+            distributions.extend(distances)
+
+        if not ids:
+            self.writeScores(self._getOutliersScoresFile(), [], [])
+            return
+        if self.outliersZScore.get() == ZSCORE_VESICLE:
+            z_scores = np.concatenate([zScores(distribution) for distribution in distributions])
+        else:
+            z_scores = zScores(np.concatenate(distributions))
+        self.writeScores(self._getOutliersScoresFile(), np.concatenate(ids), z_scores)
+
+    def projectTomoStep(self, tomoId, coordinates):
+        for folder in ['inputCoords', 'outputCoords', 'carbonMask']:
+            pwutils.makePath(self._getTomoCarbonPath(tomoId, folder))
+        tomo = self.tomos[tomoId].clone()
+        coordList = self.generateCoordList(tomo, coordinates)
+        if self.isCarbonCached(tomoId, coordinates, coordList):
+            self.info("Cached carbon scores found for %s, the cleaner will not be executed" % tomo.getFileName())
+            return
+        projFile = self.projectTomo(tomo, coordList)
+        tomo_md = createMetaDataFromPattern(projFile)
+        tomo_md.write(self._getTomoCarbonPath(tomoId, 'inputTomo.xmd'))
+        self.writeTomoCoordinates(tomo, coordList, self._getTomoPos(projFile))
+
+    def detectCarbonCloseness(self, tomoId, coordinates):
+        tomo = self.tomos[tomoId]
+        projFile = self._getProjectionFile(tomo)
+        baseName = pwutils.removeBaseExt(projFile)
+        outFile = self._getTomoCarbonPath(tomoId, 'outputCoords', baseName + ".pos")
+        if self.isCarbonCached(tomoId, coordinates):
+            self.restoreCarbonCache(tomoId, coordinates, outFile)
+        else:
+            self.runCleaner(tomoId, coordinates)
+            if self.useCache.get():
+                self.storeCarbonCache(tomoId, coordinates, outFile)
+        posMd = readPosCoordinates(outFile)
+        posMd.addLabel(md.MDL_ITEM_ID)
+        ids, scores = [], []
+        for objId in posMd:
+            if posMd.getValue(md.MDL_ENABLED, objId) == 0:
+                posMd.setValue(md.MDL_ENABLED, 1, objId)
+            coord = rowToCoordinate(rowFromMd(posMd, objId))
+            ids.append(posMd.getValue(md.MDL_ITEM_ID, objId))
+            scores.append(coord._xmipp_goodRegionScore.get())
+        self.writeScores(self._getTomoCarbonPath(tomoId, 'carbonScores.npz'), ids, scores)
+        pwutils.cleanPath(projFile)
+
+    def runCleaner(self, tomoId, coordinates):
+        args = '-i %s -c %s -o %s -b %d --predictedMaskDir %s' \
+               % (self._getTomoCarbonPath(tomoId, 'inputTomo.xmd'), self._getTomoCarbonPath(tomoId, 'inputCoords'),
+                  self._getTomoCarbonPath(tomoId, 'outputCoords'), coordinates.getBoxSize(),
+                  self._getTomoCarbonPath(tomoId, 'carbonMask'))
+
+        if self.useGpu.get():
+            gpu_list = ','.join([str(elem) for elem in self.getGpuList()])
+            args += " -g %s" % gpu_list
+        else:
+            args += " -g -1"
+
+        self.runJob('xmipp_deep_micrograph_cleaner', args, env=Plugin.getTensorFlowEnviron())
+
+    def createOutputStep(self, tomoId, coordinates):
+        if self.filter.get() and not self.outliers.get() and not self.carbon.get():
+            print("All scoring modes are disabled. Exting")
+            return
+        # Scores are read from the files written by the scoring steps, as they may have run before the protocol
+        # was continued
+        scoreOutliers = self.readScores(self._getOutliersScoresFile()) if self.outliers.get() else {}
+        scoreCarbon = self.readScores(self._getTomoCarbonPath(tomoId, 'carbonScores.npz')) if self.carbon.get() else {}
+        outSet = self.getOutputSetOfCoordinates(coordinates)
+        for coord in coordinates.iterCoordinates(volume=self.tomos[tomoId]):
+            objId = coord.getObjId()
+            scoreCoordOutlier = scoreOutliers.get(objId) if self.outliers.get() else None
+            scoreCoordCarbon = scoreCarbon.get(objId) if self.carbon.get() else None
+            if self.filter.get():
+                if self.outliers.get() and not self.outliersThreshold.get() >= scoreCoordOutlier:
+                    continue
+                if self.carbon.get() and not scoreCoordCarbon >= self.carbonThreshold.get():
+                    continue
             newCoord = coord.clone()
             newCoord.setVolume(coord.getVolume())
-            scoreCoordOutlier = scoreOutliers[coord.getObjId()] if scoreOutliers else None
-            scoreCoordCarbon = scoreCarbon[coord.getObjId()] if scoreCarbon else None
-            if self.filter.get():
-                if self.outliers.get() and not self.carbon.get():
-                    if self.outliersThreshold.get() >= scoreCoordOutlier:
-                        newCoord.outlierScore = Float(scoreCoordOutlier)
-                        outSet.append(newCoord)
-                elif not self.outliers.get() and self.carbon.get():
-                    if scoreCoordCarbon >= self.carbonThreshold.get():
-                        newCoord.carbonScore = Float(scoreCoordCarbon)
-                        outSet.append(newCoord)
-                elif self.outliers.get() and self.carbon.get():
-                    if self.outliersThreshold.get() >= scoreCoordOutlier and \
-                       scoreCoordCarbon >= self.carbonThreshold.get():
-                        newCoord.outlierScore = Float(scoreCoordOutlier)
-                        newCoord.carbonScore = Float(scoreCoordCarbon)
-                        outSet.append(newCoord)
-                else:
-                    print("All scoring modes are disabled. Exting")
-                    break
-            else:
-                if self.outliers.get():
-                    newCoord.outlierScore = Float(scoreCoordOutlier)
-                if self.carbon.get():
-                    newCoord.carbonScore = Float(scoreCoordCarbon)
-                outSet.append(newCoord)
-        self._defineOutputs(outputCoordinates=outSet)
-        self._defineSourceRelation(coordinates, outSet)
+            if self.outliers.get():
+                newCoord.outlierScore = Float(scoreCoordOutlier)
+            if self.carbon.get():
+                newCoord.carbonScore = Float(scoreCoordCarbon)
+            outSet.append(newCoord)
+        outSet.write()
+        self._store()
 
+    def closeOutputSetStep(self):
+        if hasattr(self, "outputCoordinates"):
+            self.outputCoordinates.setStreamState(Set.STREAM_CLOSED)
+            self._store()
+
+    def getOutputSetOfCoordinates(self, coordinates):
+        if hasattr(self, "outputCoordinates"):
+            self.outputCoordinates.enableAppend()
+        else:
+            outSet = self._createSetOfCoordinates3D(coordinates)
+            outSet.setPrecedents(coordinates.getPrecedents())
+            outSet.setBoxSize(coordinates.getBoxSize())
+            outSet.setSamplingRate(coordinates.getSamplingRate())
+            outSet.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(outputCoordinates=outSet)
+            self._defineSourceRelation(coordinates, outSet)
+        return self.outputCoordinates
 
     # --------------------------- UTILS functions ----------------------
-    def projectTomo(self, tomo):
-        outFile = pwutils.removeBaseExt(tomo.getFileName()) + '_projected.mrc'
+    def projectTomo(self, tomo, coordList=None):
+        outFile = self._getProjectionFile(tomo)
         ih = ImageHandler()
         outProjection = ih.createImage()
-        tomoData = np.squeeze(ih.read(tomo.getFileName()).getData())
-        projection = np.sum(tomoData, axis=0)
+        projection = projectTomogram(tomo.getFileName(), zRange=self.getProjectionRange(coordList))
         outProjection.setData(projection)
-        ih.write(outProjection, self._getExtraPath(outFile))
-        return self._getExtraPath(outFile)
+        ih.write(outProjection, outFile)
+        return outFile
+
+    def getCarbonCacheDir(self, tomoId, coordinates, coordList=None):
+        '''Cache folder of the carbon detection of a tomogram. Its name is a digest of the tomogram content,
+        the coordinates, the box size, the projected slab and the cleaner model'''
+        if tomoId not in self.carbonCacheDirs:
+            tomo = self.tomos[tomoId]
+            if coordList is None:
+                coordList = self.generateCoordList(tomo, coordinates)
+            key = hashlib.sha256()
+            key.update(fileSha256(tomo.getFileName()).encode())
+            key.update(('%d %s %s' % (coordinates.getBoxSize(), self.getProjectionRange(coordList),
+                                      self.getCleanerModelKey())).encode())
+            for coord in coordList:
+                key.update(('%d %d %d %d' % ((coord.getObjId(),) +
+                                             tuple(coord.getPosition(const.BOTTOM_LEFT_CORNER)))).encode())
+            projectPath = os.path.dirname(os.path.dirname(os.path.abspath(self.getWorkingDir())))
+            self.carbonCacheDirs[tomoId] = os.path.join(projectPath, CARBON_CACHE_DIR, key.hexdigest())
+        return self.carbonCacheDirs[tomoId]
+
+    def getCleanerModelKey(self):
+        '''Identity of the cleaner model: the digest of the model file or, if it cannot be found, the plugin version'''
+        if getattr(self, '_cleanerModelKey', None) is None:
+            modelFile = Plugin.getModel(*CLEANER_MODEL, doRaise=False)
+            if os.path.exists(modelFile):
+                self._cleanerModelKey = '%s %s' % (modelFile, fileSha256(modelFile))
+            else:
+                self._cleanerModelKey = 'xmipptomo %s' % __version__
+        return self._cleanerModelKey
+
+    def isCarbonCached(self, tomoId, coordinates, coordList=None):
+        return self.useCache.get() and \
+               os.path.exists(os.path.join(self.getCarbonCacheDir(tomoId, coordinates, coordList), 'scores.pos'))
+
+    def storeCarbonCache(self, tomoId, coordinates, posFile):
+        '''Copy the scored coordinates and the predicted masks of a tomogram to the cache. The entry is written in
+        a temporary folder and renamed, so concurrent runs never see it half written'''
+        cacheDir = self.getCarbonCacheDir(tomoId, coordinates)
+        if os.path.exists(cacheDir):
+            return
+        tmpDir = '%s.%d.tmp' % (cacheDir, os.getpid())
+        pwutils.makePath(os.path.join(tmpDir, 'carbonMask'))
+        pwutils.copyFile(posFile, os.path.join(tmpDir, 'scores.pos'))
+        for maskFile in glob.glob(self._getTomoCarbonPath(tomoId, 'carbonMask', '*')):
+            pwutils.copyFile(maskFile, os.path.join(tmpDir, 'carbonMask', os.path.basename(maskFile)))
+        try:
+            os.rename(tmpDir, cacheDir)
+        except OSError:
+            pwutils.cleanPath(tmpDir)
+
+    def restoreCarbonCache(self, tomoId, coordinates, posFile):
+        cacheDir = self.getCarbonCacheDir(tomoId, coordinates)
+        pwutils.copyFile(os.path.join(cacheDir, 'scores.pos'), posFile)
+        for maskFile in glob.glob(os.path.join(cacheDir, 'carbonMask', '*')):
+            pwutils.copyFile(maskFile, self._getTomoCarbonPath(tomoId, 'carbonMask', os.path.basename(maskFile)))
+
+    def writeScores(self, fileName, ids, scores):
+        '''Store the scores of the coordinates with the given ids'''
+        np.savez(fileName, ids=np.asarray(ids, dtype=int), scores=np.asarray(scores, dtype=float))
+
+    def readScores(self, fileName):
+        '''Dictionary from coordinate id to score, as stored by writeScores'''
+        with np.load(fileName) as data:
+            return dict(zip(data['ids'].tolist(), data['scores'].tolist()))
+
+    def _getOutliersScoresFile(self):
+        return self._getExtraPath('outliersScores.npz')
+
+    def _getTomoCarbonPath(self, tomoId, *paths):
+        '''Working folder of the carbon detection of a given tomogram'''
+        return self._getExtraPath('carbon_tomo%d' % tomoId, *paths)
+
+    def _getProjectionFile(self, tomo):
+        return self._getTomoCarbonPath(tomo.getObjId(),
+                                       pwutils.removeBaseExt(tomo.getFileName()) + '_projected.mrc')
+
+    def getProjectionRange(self, coordList):
+        '''Z range of the slab to be projected, centered at the median height of the coordinates'''
+        slab = self.projectionSlab.get()
+        if not slab or not coordList:
+            return None
+        zCenter = int(np.median([coord.getPosition(const.BOTTOM_LEFT_CORNER)[2] for coord in coordList]))
+        return zCenter - slab // 2, zCenter - slab // 2 + slab
 
     def _getTomoPos(self, fileName):
         """ Return the corresponding .pos file for a given tomogram. """
         baseName = pwutils.removeBaseExt(fileName)
-        return self._getExtraPath('inputCoords', baseName + ".pos")
+        return os.path.join(os.path.dirname(fileName), 'inputCoords', baseName + ".pos")
 
     def writeTomoCoordinates(self, tomo, coordList, outputFn, isManual=True,
                              getPosFunc=None):
@@ -252,6 +432,8 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
             filter = True
         if self.outliers.get():
             methodsMsgs.append("*Score Outliers*: True")
+            methodsMsgs.append("    * Z-Score scope: %s" % ('per vesicle' if self.outliersZScore.get() == ZSCORE_VESICLE
+                                                            else 'global'))
             if filter:
                 methodsMsgs.append("    * Outlier threshold: %.2f" % self.outliersThreshold.get())
         else:
@@ -260,6 +442,8 @@ class XmippProtScoreCoordinates(ProtTomoPicking):
             methodsMsgs.append("*Score Carbon Closeness*: True")
             if filter:
                 methodsMsgs.append("    * Carbon threshold: %.2f" % self.carbonThreshold.get())
+            if self.useCache.get():
+                methodsMsgs.append("    * Cached carbon masks reused when available")
         else:
             methodsMsgs.append("*Score Carbon Closeness*: False")
         return methodsMsgs
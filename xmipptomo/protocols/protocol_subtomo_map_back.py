@@ -29,21 +29,18 @@ import enum
 import os
 
 from pwem.emlib import lib
-import pwem.emlib.metadata as md
 from pwem.emlib.image import ImageHandler
-from pwem.objects import Transform
 from pwem.protocols import EMProtocol
 
 from pyworkflow import BETA
 from pyworkflow.protocol import STEPS_PARALLEL
-from pyworkflow.protocol.params import PointerParam, EnumParam, BooleanParam, FloatParam
+from pyworkflow.protocol.params import PointerParam, EnumParam, BooleanParam, FloatParam, LEVEL_ADVANCED
 from pyworkflow.utils import createLink
 
 from tomo.objects import Tomogram, SetOfCoordinates3D, SetOfSubTomograms, SetOfClassesSubTomograms, ClassSubTomogram, \
-    MATRIX_CONVERSION, SetOfTomograms
+    SetOfTomograms
 from tomo.protocols import ProtTomoBase
-from xmipp3.convert import alignmentToRow
-import tomo.constants as const
+from xmipptomo import utils
 
 REFERENCE = 'Reference'
 
@@ -56,6 +53,12 @@ class PAINTING_TYPES:
     BINARIZE=3
 
 
+# Map back engines
+class MAPBACK_ENGINES:
+    XMIPP=0
+    NUMPY=1
+
+
 class MapBackOutputs(enum.Enum):
     tomograms = SetOfTomograms
 
@@ -112,11 +115,27 @@ class XmippProtSubtomoMapBack(EMProtocol, ProtTomoBase):
                       help="threshold applied to tomogram", condition="paintingType == %s or paintingType == %s" % (PAINTING_TYPES.AVERAGE, PAINTING_TYPES.BINARIZE))
         form.addParam('constant', FloatParam, default=2, label='Multiplier',
                       help="constant to multiply the reference", condition="paintingType == %s or paintingType == %s" % (PAINTING_TYPES.COPY, PAINTING_TYPES.HIGHLIGHT))
+        form.addParam('mapBackEngine', EnumParam,
+                      choices=['Xmipp', 'NumPy'], default=MAPBACK_ENGINES.XMIPP,
+                      display=EnumParam.DISPLAY_HLIST, expertLevel=LEVEL_ADVANCED,
+                      label='Map back engine',
+                      help='*Xmipp*: the reference is painted by xmipp_tomo_map_back.\n*NumPy*: the reference is '
+                           'painted in-process into a memory map of the output tomogram. Each orientation of the '
+                           'reference is computed only once and the reference is scaled while it is rotated.')
+        form.addParam('angularStep', FloatParam, default=0, expertLevel=LEVEL_ADVANCED,
+                      condition='mapBackEngine == %d' % MAPBACK_ENGINES.NUMPY,
+                      label='Angular step (degrees)',
+                      help='If greater than 0, the orientations of the references are rounded to multiples of this '
+                           'step, so similar orientations share the same rotated reference and are only computed '
+                           'once. This is an approximation: for a reference of radius R pixels, a step of S degrees '
+                           'may displace its edge up to R * S * pi / 360 pixels (0.4 pixels for R=100 and S=0.5). '
+                           'If 0, the exact orientations are used, as the Xmipp engine does.')
 
         form.addParallelSection(threads=4, mpi=1)
     # --------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
         prepRefId = self._insertFunctionStep(self.prepareReference, self.invertContrast.get())
+        coordsId = self._insertFunctionStep(self.writeGeometryStep, prerequisites=[])
 
 
         mapBacksStepIds=[]
@@ -126,7 +145,7 @@ class XmippProtSubtomoMapBack(EMProtocol, ProtTomoBase):
                                      self.paintingType.get(),
                                      self.removeBackground.get(),
                                      self.threshold.get(),
-                                     prerequisites=prepRefId)
+                                     prerequisites=[prepRefId, coordsId])
 
             mapBacksStepIds.append(mapBackStepId)
 
@@ -249,24 +268,43 @@ class XmippProtSubtomoMapBack(EMProtocol, ProtTomoBase):
         else:
             return self.inputTomograms.get()[{Tomogram.TS_ID_FIELD:tsId}]
 
+    def writeGeometryStep(self):
+        """ Writes the geometry files of all the tomograms in a single pass over the input coordinates"""
+        volumes = {}
+        scaleFactors = {}
+        for tomo in self._getTomogramsInvolved().values():
+            tsId = tomo.getTsId()
+            volumes[tsId] = self.getTomogram(tsId).clone()
+            scaleFactors[tsId] = self.getScaleFactor(volumes[tsId])
+
+        utils.partitionMdCoordinates(self._getInput(), self.getGeometryFileName, volumes=volumes,
+                                     scaleFactor=scaleFactors)
+
+    def getGeometryFileName(self, tsId):
+        return self._getExtraPath("geometry%s.xmd" % tsId)
+
+    def getScaleFactor(self, tomo):
+        """ Returns the ratio between the sampling rate of the input coordinates and the one of the tomogram"""
+        input = self._getInput()
+        usingSubtomograms = isinstance(input, SetOfSubTomograms)
+        inputSR = input.getCoordinates3D().getSamplingRate() if usingSubtomograms else input.getSamplingRate()
+        return inputSR / tomo.getSamplingRate()
+
     def runMapBack(self, tsId, paintingType, removeBackground, threshold):
 
         tomo = self.getTomogram(tsId)
         self.debug("TomoInvolved: %s" % tomo)
 
+        if self.mapBackEngine.get() == MAPBACK_ENGINES.NUMPY:
+            self.runMapBackNumpy(tomo)
+            return
+
         # Removing background
         self.removeTomogramBackground(tomo)
 
-        input = self._getInput()
-        # Using subtomograms
-        usingSubtomograms = isinstance(input, SetOfSubTomograms)
-
-        inputSR=input.getCoordinates3D().getSamplingRate() if usingSubtomograms else input.getSamplingRate()
-        tomoSR = tomo.getSamplingRate()
-        scaleFactor = inputSR/tomoSR
+        scaleFactor = self.getScaleFactor(tomo)
         self.info("Coordinates have to be multiplied by %s due to the sampling rate ratio"
                   " between the coordinates and the tomograms used." % scaleFactor)
-        mdGeometry = lib.MetaData()
 
         ref = self.getFinalRefName()
 
@@ -278,29 +316,7 @@ class XmippProtSubtomoMapBack(EMProtocol, ProtTomoBase):
             self.runJob("xmipp_image_operate", " -i %s  --mult %d -o %s" %
                         (initialref, self.constant.get(), ref))
 
-
-        where = "_coordinate._tomoId='%s'" if usingSubtomograms else "_tomoId='%s'"
-        where = where % tsId
-
-        for coord in input.iterCoordinates(volume=tomo):
-            self.debug("Mapping back %s" % coord)
-            transform = Transform(matrix=coord.getMatrix(convention=MATRIX_CONVERSION.XMIPP))
-
-            nRow = md.Row()
-            nRow.setValue(lib.MDL_ITEM_ID, int(coord.getObjId()))
-            nRow.setValue(lib.MDL_XCOOR, int(coord.getX(const.BOTTOM_LEFT_CORNER)*scaleFactor))
-            nRow.setValue(lib.MDL_YCOOR, int(coord.getY(const.BOTTOM_LEFT_CORNER)*scaleFactor))
-            nRow.setValue(lib.MDL_ZCOOR, int(coord.getZ(const.BOTTOM_LEFT_CORNER)*scaleFactor))
-            # Compute inverse matrix
-            #A = subtomo.getTransform().getMatrix()
-            #subtomo.getTransform().setMatrix(np.linalg.inv(A))
-            # Convert transform matrix to Euler Angles (rot, tilt, psi)
-            from pwem import ALIGN_PROJ
-            alignmentToRow(transform, nRow, ALIGN_PROJ)
-            nRow.addToMd(mdGeometry)
-
-        fnGeometry = self._getExtraPath("geometry%s.xmd" % tsId)
-        mdGeometry.write(fnGeometry)
+        self.debug("Mapping back the coordinates of %s" % tsId)
 
         if scaleFactor != 1:
             args = "-i %s -o %s --scale %d" % (ref, ref, scaleFactor)
@@ -317,10 +333,32 @@ class XmippProtSubtomoMapBack(EMProtocol, ProtTomoBase):
 
         tomogram = self.getFinalTomoName(tomo)
         args = " -i %s -o %s --geom %s --ref %s --method %s" % (tomogram, tomogram,
-                                                                self._getExtraPath("geometry%s.xmd" % tsId),
+                                                                self.getGeometryFileName(tsId),
                                                                 ref, painting)
         self.runJob("xmipp_tomo_map_back", args)
 
+    def runMapBackNumpy(self, tomo):
+        """ Paints the reference into the tomogram in-process, with a single write of the output tomogram"""
+        tsId = tomo.getTsId()
+        fnTomo = self.getFinalTomoName(tomo)
+        if self.removeBackground.get() and self.paintingType.get() in [PAINTING_TYPES.COPY, PAINTING_TYPES.BINARIZE]:
+            x, y, z = tomo.getDimensions()
+            lib.createEmptyFile(fnTomo, x, y, z, 1)
+        else:
+            ImageHandler().convert(tomo, fnTomo, dataType=lib.DT_FLOAT)
+
+        methods = {PAINTING_TYPES.COPY: 'copy',
+                   PAINTING_TYPES.AVERAGE: 'avg',
+                   PAINTING_TYPES.HIGHLIGHT: 'highlight',
+                   PAINTING_TYPES.BINARIZE: 'copy_binary'}
+        painted = utils.mapBackReference(fnTomo, self.getFinalRefName(), self.getGeometryFileName(tsId),
+                                         method=methods[self.paintingType.get()],
+                                         threshold=self.threshold.get(),
+                                         constant=self.constant.get(),
+                                         scale=self.getScaleFactor(tomo),
+                                         angularStep=self.angularStep.get() or None)
+        self.info("%d references mapped back into %s" % (painted, fnTomo))
+
     def createOutput(self):
 
         inputTomos = self._getTomogramsInvolved()
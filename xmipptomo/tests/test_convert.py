@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:    Federico P. de Isidro-Gomez
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from pwem import emlib
+from pwem.constants import ALIGN_NONE
+from pwem.convert import euler_matrix
+from pwem.convert.transformations import euler_from_matrix, translation_from_matrix
+from pyworkflow.tests import BaseTest
+
+from xmipptomo.convert import (matrixFromGeometries, geometryFromMatrices, invertTransformations,
+                               matrixFromGeometry, geometryFromMatrix, readSetOfImagesColumns, rowFromMd,
+                               rowToParticle)
+
+
+class TestXmipptomoConvertGeometry(BaseTest):
+    """This class checks that the batched geometry conversions match the transform by transform conversion."""
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.shifts = rng.normal(scale=10.0, size=(50, 3))
+        cls.angles = rng.uniform(-180.0, 180.0, size=(50, 3))
+
+    @staticmethod
+    def _scalarMatrix(shifts, angles, inverseTransform):
+        """ Transform matrix obtained through the scalar euler_matrix path. """
+        radAngles = -np.deg2rad(angles)
+        M = euler_matrix(radAngles[0], radAngles[1], radAngles[2], 'szyz')
+        if inverseTransform:
+            M[:3, 3] = -shifts[:3]
+            M = np.linalg.inv(M)
+        else:
+            M[:3, 3] = shifts[:3]
+        return M
+
+    @staticmethod
+    def _scalarGeometry(matrix, inverseTransform):
+        """ Shifts and angles obtained through the scalar euler_from_matrix path. """
+        if inverseTransform:
+            matrix = np.linalg.inv(matrix)
+            shifts = -translation_from_matrix(matrix)
+        else:
+            shifts = translation_from_matrix(matrix)
+        return shifts, -np.rad2deg(euler_from_matrix(matrix, axes='szyz'))
+
+    def test_matrixFromGeometries(self):
+        for inverseTransform in (True, False):
+            matrices = matrixFromGeometries(self.shifts, self.angles, inverseTransform)
+            for index, matrix in enumerate(matrices):
+                expected = self._scalarMatrix(self.shifts[index], self.angles[index], inverseTransform)
+                np.testing.assert_allclose(matrix, expected, atol=1e-9)
+                np.testing.assert_allclose(matrixFromGeometry(self.shifts[index], self.angles[index], inverseTransform),
+                                           expected, atol=1e-9)
+
+    def test_geometryFromMatrices(self):
+        for inverseTransform in (True, False):
+            matrices = matrixFromGeometries(self.shifts, self.angles, inverseTransform)
+            shifts, angles = geometryFromMatrices(matrices, inverseTransform)
+            for index, matrix in enumerate(matrices):
+                expectedShifts, expectedAngles = self._scalarGeometry(matrix, inverseTransform)
+                np.testing.assert_allclose(shifts[index], expectedShifts, atol=1e-9)
+                np.testing.assert_allclose(angles[index], expectedAngles, atol=1e-9)
+                scalarShifts, scalarAngles = geometryFromMatrix(matrix, inverseTransform)
+                np.testing.assert_allclose(scalarShifts, expectedShifts, atol=1e-9)
+                np.testing.assert_allclose(scalarAngles, expectedAngles, atol=1e-9)
+
+    def test_invertTransformations(self):
+        matrices = matrixFromGeometries(self.shifts, self.angles, False)
+        # Scaled matrices are not rigid and must fall back to the general inverse
+        matrices[:10, :3, :3] *= 2.0
+        np.testing.assert_allclose(invertTransformations(matrices), np.linalg.inv(matrices), atol=1e-9)
+
+
+class TestXmipptomoConvertColumns(BaseTest):
+    """This class checks that reading a metadata by columns matches reading it row by row."""
+
+    def test_readSetOfImagesColumnsCtfExtraLabels(self):
+        imgMd = emlib.MetaData()
+        for index in range(3):
+            objId = imgMd.addObject()
+            imgMd.setValue(emlib.MDL_ITEM_ID, index + 1, objId)
+            imgMd.setValue(emlib.MDL_IMAGE, '%d@particles.mrcs' % (index + 1), objId)
+            imgMd.setValue(emlib.MDL_CTF_DEFOCUSU, 10000.0 + index, objId)
+            imgMd.setValue(emlib.MDL_CTF_DEFOCUSV, 12000.0 + index, objId)
+            imgMd.setValue(emlib.MDL_CTF_DEFOCUS_ANGLE, 30.0 + index, objId)
+            imgMd.setValue(emlib.MDL_CTF_CRIT_MAXFREQ, 5.0 + index, objId)
+            imgMd.setValue(emlib.MDL_CTF_CRIT_FITTINGSCORE, 0.5, objId)
+            imgMd.setValue(emlib.MDL_CTF_K, 1.5 + index, objId)
+            imgMd.setValue(emlib.MDL_CTF_Q0, 0.1, objId)
+            imgMd.setValue(emlib.MDL_CTF_CS, 2.7, objId)
+            imgMd.setValue(emlib.MDL_CTF_VOLTAGE, 300.0, objId)
+
+        particles = []
+        readSetOfImagesColumns(imgMd, particles, rowToParticle, alignType=ALIGN_NONE)
+        expectedParticles = [rowToParticle(rowFromMd(imgMd, objId), alignType=ALIGN_NONE) for objId in imgMd]
+
+        self.assertEqual(len(particles), len(expectedParticles))
+        for particle, expected in zip(particles, expectedParticles):
+            self.assertEqual(particle.getObjId(), expected.getObjId())
+            self.assertEqual(particle.getLocation(), expected.getLocation())
+            ctf, expectedCtf = particle.getCTF(), expected.getCTF()
+            self.assertAlmostEqual(ctf.getDefocusU(), expectedCtf.getDefocusU())
+            self.assertAlmostEqual(ctf.getResolution(), expectedCtf.getResolution())
+            self.assertAlmostEqual(ctf._xmipp_ctfK.get(), expectedCtf._xmipp_ctfK.get())
+            self.assertAlmostEqual(particle.getAcquisition().getVoltage(), expected.getAcquisition().getVoltage())
@@ -26,9 +26,10 @@
 
 # General imports
 import os
+import numpy as np
 
 # Scipion em imports
-from pyworkflow.tests import setupTestProject
+from pyworkflow.tests import BaseTest, setupTestProject
 
 # External plugin imports
 from tomo.protocols import ProtImportSubTomograms
@@ -102,4 +103,21 @@ class TestXmippProtProjectSubtomograms(TestXmippProtExtractSubtomosProts):
         """This function runs XmippProtProjectSubtomograms using the output of XmippExtractSubtomos as input."""
         self._runXmippProjectSubtomograms()
         # Last test calls cleaning function so it does not count as a separate test
-        removeTmpElements(self.tmpElements)
\ No newline at end of file
+        removeTmpElements(self.tmpElements)
+
+class TestXmippProtProjectSubtomogramsDefocus(BaseTest):
+    """This class checks the closest tilt angle lookup used to correct the defocus of each projection."""
+    def test_getClosestTiltIndex(self):
+        sortedTiltAngles = np.array([-60.0, -30.0, -3.0, 0.0, 3.0, 30.0, 60.0])
+        # Unsorted angles below, above, inside and exactly between or at the sorted tilt angles
+        tiltAngles = np.array([45.0, -90.0, 90.0, -1.5, 1.5, 0.0, -45.0, 60.0, -60.0, 16.5, 2.9, -16.5, 7.0])
+
+        closest = XmippProtProjectSubtomograms.getClosestTiltIndex(sortedTiltAngles, tiltAngles)
+
+        # A brute force argmin keeps the first, so the smallest, of the tied tilt angles
+        expected = [np.argmin(np.abs(sortedTiltAngles - tiltAngle)) for tiltAngle in tiltAngles]
+        np.testing.assert_array_equal(closest, expected)
+
+        # A single tilt angle is the closest one to any angle
+        np.testing.assert_array_equal(XmippProtProjectSubtomograms.getClosestTiltIndex(np.array([10.0]), tiltAngles),
+                                      np.zeros(len(tiltAngles)))
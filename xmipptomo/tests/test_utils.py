@@ -0,0 +1,515 @@
+# **************************************************************************
+# *
+# * Authors:    Federico P. de Isidro-Gomez
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+
+from pwem.emlib import lib
+from pwem.emlib.image import ImageHandler
+from pyworkflow.tests import BaseTest
+from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage, SetOfTomograms, Tomogram
+
+from xmipptomo.utils import (calculateRotationAnglesAndShiftsFromTMStack, readXmdColumns, coordinatesToColumns,
+                             readXmipp3dCoordinates, iterXmipp3dCoordinates, ballOffsets, ballStatistics,
+                             writeXmdBlock, partitionMdCoordinates, projectTomogram, mapBackReference,
+                             eulerAnglesToMatrices, projectVolumeFourier, mrcMemmap, xmdToTiltSeries,
+                             SetKeyIndex)
+
+
+class TestXmipptomoUtilsTransformations(BaseTest):
+    """This class checks the batched decomposition of tilt image transformation matrices."""
+
+    def test_calculateRotationAnglesAndShiftsFromTMStack(self):
+        angles = np.radians([0, 10, 89, 91, 170, 180, -10, -91, -170, 135.5])
+        matrices = np.tile(np.identity(3), (len(angles), 1, 1))
+        matrices[:, 0, 0] = np.cos(angles)
+        matrices[:, 1, 0] = np.sin(angles)
+        matrices[:, 0, 2] = np.arange(len(angles))
+        matrices[:, 1, 2] = -np.arange(len(angles))
+
+        rotationAngles, sxs, sys = calculateRotationAnglesAndShiftsFromTMStack(matrices)
+
+        # Same range as the arctangent of the sine over the cosine, as expected by the callers
+        expected = [math.degrees(math.atan(matrix[1, 0] / matrix[0, 0])) for matrix in matrices]
+        np.testing.assert_allclose(rotationAngles, expected, atol=1e-9)
+        np.testing.assert_allclose(sxs, np.arange(len(angles)))
+        np.testing.assert_allclose(sys, -np.arange(len(angles)))
+
+        # A null cosine does not break the calculation
+        rotationAngles, _, _ = calculateRotationAnglesAndShiftsFromTMStack(np.array([[[0, -1, 0], [1, 0, 0], [0, 0, 1]]]))
+        np.testing.assert_allclose(rotationAngles, [90])
+
+
+
+class TestXmipptomoUtilsProjection(BaseTest):
+    """This class checks the Fourier projection of volumes against a real space projection."""
+
+    @staticmethod
+    def _blobsVolume(size):
+        """ Smooth volume made of gaussian blobs around the center of the box. """
+        z, y, x = np.indices((size,) * 3) - size // 2
+        volume = np.zeros((size,) * 3)
+        for (dz, dy, dx), sigma, weight in [((0, 0, 0), 2.0, 1), ((3, -2, 1), 1.5, 0.7), ((-2, 4, -3), 1.5, 0.5)]:
+            volume += weight * np.exp(-((z - dz) ** 2 + (y - dy) ** 2 + (x - dx) ** 2) / (2 * sigma ** 2))
+        return volume.astype(np.float32)
+
+    @staticmethod
+    def _realSpaceProjection(volume, rot, tilt, psi):
+        """ Volume rotated by the Euler matrix and summed along z. """
+        center = np.array(volume.shape) // 2
+        z, y, x = np.indices(volume.shape).reshape(3, -1) - center[:, None]
+        rotated = eulerAnglesToMatrices(rot, tilt, psi)[0].T @ np.stack([x, y, z])
+        coords = rotated[::-1] + center[:, None]
+        values = ndimage.map_coordinates(volume, coords, order=1, mode='constant', cval=0.0)
+        return values.reshape(volume.shape).sum(axis=0)
+
+    def test_projectVolumeFourier(self):
+        rot = np.array([0, 30, 10, 120])
+        tilt = np.array([0, 45, 60, -30])
+        psi = np.array([0, 0, 70, 15])
+        # Even and odd box sizes
+        for size in (16, 15):
+            volume = self._blobsVolume(size)
+            projections = projectVolumeFourier(volume, rot, tilt, psi, pad=2, maxFreq=0.5, order=1)
+            self.assertEqual(projections.shape, (len(rot), size, size))
+            for projection, angles in zip(projections, zip(rot, tilt, psi)):
+                expected = self._realSpaceProjection(volume, *angles)
+                # Both interpolations differ slightly, except for the untilted projection
+                np.testing.assert_allclose(projection, expected, atol=0.05 * np.abs(expected).max())
+            expected = volume.sum(axis=0)
+            np.testing.assert_allclose(projections[0], expected, atol=1e-3 * np.abs(expected).max())
+
+
+class TestXmipptomoUtilsXmd(BaseTest):
+    """This class checks the bulk parsing of Xmipp metadata files."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def test_readXmdColumnsCommentAfterLabels(self):
+        fnmd = self.getOutputPath('comment.xmd')
+        with open(fnmd, 'w') as fileHandler:
+            fileHandler.write("# XMIPP_STAR_1 *\n#\ndata_noname\nloop_\n _xcoor\n _image\n#\n\n"
+                              "1 a.mrc\n2 b.mrc\n\ndata_other\nloop_\n _xcoor\n 5\n")
+
+        data = readXmdColumns(fnmd)
+        np.testing.assert_array_equal(data['xcoor'], [1, 2])
+        np.testing.assert_array_equal(data['image'], ['a.mrc', 'b.mrc'])
+        np.testing.assert_array_equal(readXmdColumns(fnmd, blockName='other')['xcoor'], [5])
+
+    def test_readXmdColumnsCacheDir(self):
+        fnmd = self.getOutputPath('cached.xmd')
+        cacheDir = self.getOutputPath('cache')
+        with open(fnmd, 'w') as fileHandler:
+            fileHandler.write("data_noname\nloop_\n _xcoor\n _avg\n1 0.500000\n2 1.500000\n")
+
+        data = readXmdColumns(fnmd, cacheDir=cacheDir)
+        cacheFiles = os.listdir(cacheDir)
+        self.assertEqual(len(cacheFiles), 1)
+        self.assertFalse([fn for fn in os.listdir(self.getOutputPath()) if fn.endswith('.npy')])
+        np.testing.assert_array_equal(data['avg'], [0.5, 1.5])
+
+        # Reading again uses the memory-mapped cache
+        data = readXmdColumns(fnmd, labels=['xcoor'], cacheDir=cacheDir)
+        self.assertIsInstance(data.base, np.memmap)
+        np.testing.assert_array_equal(data['xcoor'], [1, 2])
+
+    def test_readXmdColumnsWriteXmdBlock(self):
+        fnmd = self.getOutputPath('block.xmd')
+        writeXmdBlock(fnmd, OrderedDict([(lib.MDL_ITEM_ID, np.arange(1, 5)),
+                                         (lib.MDL_IMAGE, ['%d@stack.mrcs' % i for i in range(1, 5)]),
+                                         (lib.MDL_AVG, np.linspace(-1, 1, 4)),
+                                         (lib.MDL_ENABLED, np.array([True, False, True, True]))]))
+
+        data = readXmdColumns(fnmd)
+        self.assertEqual(data.dtype.names, ('itemId', 'image', 'avg', 'enabled'))
+        np.testing.assert_array_equal(data['itemId'], [1, 2, 3, 4])
+        np.testing.assert_array_equal(data['image'], ['%d@stack.mrcs' % i for i in range(1, 5)])
+        np.testing.assert_allclose(data['avg'], np.linspace(-1, 1, 4), atol=1e-6)
+        np.testing.assert_array_equal(data['enabled'], [1, 0, 1, 1])
+        self.assertEqual(readXmdColumns(fnmd, labels=['avg', 'itemId']).dtype.names, ('avg', 'itemId'))
+
+        # Empty blocks keep their labels
+        writeXmdBlock(fnmd, OrderedDict([(lib.MDL_XCOOR, []), (lib.MDL_AVG, [])]))
+        data = readXmdColumns(fnmd)
+        self.assertEqual(len(data), 0)
+        self.assertEqual(data.dtype.names, ('xcoor', 'avg'))
+
+    def test_readXmdColumnsListBlock(self):
+        fnmd = self.getOutputPath('list.xmd')
+        with open(fnmd, 'w') as fileHandler:
+            fileHandler.write("# XMIPP_STAR_1 *\n#\ndata_noname\n _samplingRate 2.5\n _image vol.mrc\n\n"
+                              "data_other\n _samplingRate 1\n")
+
+        data = readXmdColumns(fnmd)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data['samplingRate'][0], 2.5)
+        self.assertEqual(data['image'][0], 'vol.mrc')
+
+
+class TestXmipptomoUtilsCoordinates(BaseTest):
+    """This class checks the conversion of coordinates to and from xmd files."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def test_coordinatesToColumns(self):
+        positions = np.array([[1.5, 2.75, 3.25], [10.9, 0.1, 7.0]])
+
+        columns = coordinatesToColumns([4, 5], positions, idLabel=None, scaleFactor=2)
+        self.assertEqual(list(columns), [lib.MDL_XCOOR, lib.MDL_YCOOR, lib.MDL_ZCOOR])
+        np.testing.assert_allclose(columns[lib.MDL_XCOOR], [3, 21.8])
+        np.testing.assert_allclose(columns[lib.MDL_YCOOR], [5.5, 0.2])
+
+        # Integer positions are truncated, as the Xmipp coordinates files expect
+        columns = coordinatesToColumns([4, 5], positions, asInteger=True)
+        np.testing.assert_array_equal(columns[lib.MDL_ITEM_ID], [4, 5])
+        np.testing.assert_array_equal(columns[lib.MDL_XCOOR], [1, 10])
+        self.assertEqual(columns[lib.MDL_ZCOOR].dtype.kind, 'i')
+
+    class _Coordinate:
+        """ Minimal coordinate, with the methods used to write the xmd coordinates files. """
+        def __init__(self, objId, tomoId, position):
+            self._objId, self._tomoId, self._position = objId, tomoId, position
+            self.volume = None
+
+        def getObjId(self):
+            return self._objId
+
+        def getTomoId(self):
+            return self._tomoId
+
+        def setVolume(self, volume):
+            self.volume = volume
+
+        def getX(self, originFunction):
+            return self._position[0]
+
+        def getY(self, originFunction):
+            return self._position[1]
+
+        def getZ(self, originFunction):
+            return self._position[2]
+
+    class _SetOfCoordinates(list):
+        def iterCoordinates(self):
+            return iter(self)
+
+    def test_partitionMdCoordinates(self):
+        rng = np.random.default_rng(0)
+        tomoIds = ['a', 'b', 'a', 'c', 'a', 'b', 'a', 'a', 'c', 'b', 'a']
+        coordinates = self._SetOfCoordinates(self._Coordinate(objId, tomoId, rng.uniform(0, 100, 3))
+                                             for objId, tomoId in enumerate(tomoIds, start=1))
+        volumes = {'a': 'volumeA', 'b': 'volumeB', 'empty': 'volumeEmpty'}
+
+        # Small buffers and a single open file force appending flushes and reopening evicted files
+        fnCoors = partitionMdCoordinates(coordinates, lambda key: self.getOutputPath('partition', '%s.xmd' % key),
+                                         volumes=volumes, withAlignment=False, scaleFactor={'a': 2, 'b': 1},
+                                         maxOpenFiles=1, bufferSize=2)
+
+        self.assertEqual(sorted(fnCoors), ['a', 'b', 'empty'])
+        for key in ('a', 'b'):
+            keyCoordinates = [coord for coord in coordinates if coord.getTomoId() == key]
+            self.assertTrue(all(coord.volume == volumes[key] for coord in keyCoordinates))
+            fnExpected = self.getOutputPath('expected_%s.xmd' % key)
+            writeXmdBlock(fnExpected, coordinatesToColumns([coord.getObjId() for coord in keyCoordinates],
+                                                           [coord._position for coord in keyCoordinates],
+                                                           scaleFactor=2 if key == 'a' else 1, asInteger=True))
+            with open(fnCoors[key]) as fileHandler, open(fnExpected) as expectedHandler:
+                self.assertEqual(fileHandler.read(), expectedHandler.read())
+
+        # Tomograms without coordinates get the header only
+        data = readXmdColumns(fnCoors['empty'])
+        self.assertEqual(len(data), 0)
+        self.assertEqual(data.dtype.names, ('itemId', 'xcoor', 'ycoor', 'zcoor'))
+
+        # Without volumes, every coordinate is written and floats are kept if asked
+        fnCoors = partitionMdCoordinates(coordinates, lambda key: self.getOutputPath('all', '%s.xmd' % key),
+                                         idLabel=None, withAlignment=False, asInteger=False, bufferSize=3)
+        self.assertEqual(sorted(fnCoors), ['a', 'b', 'c'])
+        np.testing.assert_allclose(readXmipp3dCoordinates(fnCoors['c']),
+                                   [coord._position for coord in coordinates if coord.getTomoId() == 'c'], atol=1e-5)
+
+    def test_readXmipp3dCoordinatesMultipleBlocks(self):
+        fnmd = self.getOutputPath('blocks.xmd')
+        with open(fnmd, 'w') as fileHandler:
+            fileHandler.write("# XMIPP_STAR_1 *\n#\ndata_noname\nloop_\n _xcoor\n _ycoor\n _zcoor\n _anglePsi\n"
+                              "1 2 3 10.5\n4 5 6 20.5\n\ndata_other\nloop_\n _image\n a.mrc\n")
+
+        np.testing.assert_array_equal(readXmipp3dCoordinates(fnmd), [[1, 2, 3], [4, 5, 6]])
+        coordinates = readXmipp3dCoordinates(fnmd, withAlignment=True)
+        self.assertEqual(coordinates.shape, (2, 9))
+        np.testing.assert_array_equal(coordinates[:, -1], [10.5, 20.5])
+
+    def test_iterXmipp3dCoordinatesBlankChunks(self):
+        fnmd = self.getOutputPath('blank.xmd')
+        with open(fnmd, 'w') as fileHandler:
+            fileHandler.write("data_noname\nloop_\n _xcoor\n _ycoor\n _zcoor\n1 2 3\n#\n\n#\n4 5 6\n7 8 9\n")
+
+        # Chunks only made of blank and comment lines do not stop the reading
+        chunks = list(iterXmipp3dCoordinates(fnmd, chunkSize=2))
+        np.testing.assert_array_equal(np.concatenate(chunks), [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+
+class TestXmipptomoUtilsVolume(BaseTest):
+    """This class checks the computations on volumes against voxel by voxel ones."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+        rng = np.random.default_rng(0)
+        cls.volume = rng.normal(size=(20, 24, 28)).astype(np.float32)
+        cls.fnVol = cls.getOutputPath('volume.mrc')
+        ih = ImageHandler()
+        image = ih.createImage()
+        image.setData(cls.volume)
+        ih.write(image, cls.fnVol)
+        # x, y, z positions inside the volume, close to its borders and out of it
+        cls.positions = np.array([[14, 12, 10], [0.4, 3, 5], [27, 23, 19], [13.6, 2.2, 18.9], [-10, 5, 5]])
+
+    def _bruteForceStatistics(self, radius):
+        zs, ys, xs = np.indices(self.volume.shape)
+        avg, std = [], []
+        for x, y, z in np.rint(self.positions):
+            values = self.volume[(xs - x) ** 2 + (ys - y) ** 2 + (zs - z) ** 2 <= radius ** 2].astype(float)
+            avg.append(values.mean() if values.size else 0)
+            std.append(values.std() if values.size else 0)
+        return np.array(avg), np.array(std)
+
+    def test_ballOffsets(self):
+        for radius in (0, 1, 2.5, 4):
+            r = int(np.floor(radius))
+            expected = [(z, y, x) for z in range(-r, r + 1) for y in range(-r, r + 1) for x in range(-r, r + 1)
+                        if x ** 2 + y ** 2 + z ** 2 <= radius ** 2]
+            self.assertEqual(sorted(map(tuple, ballOffsets(radius).tolist())), sorted(expected))
+
+    def test_ballStatistics(self):
+        for radius in (1, 3.5):
+            expectedAvg, expectedStd = self._bruteForceStatistics(radius)
+            # Coordinates gathered in batches and computed one by one on their cropped box
+            for maxVoxels in (2 ** 24, 1):
+                avg, std = ballStatistics(self.fnVol, self.positions, radius, maxVoxels=maxVoxels)
+                np.testing.assert_allclose(avg, expectedAvg, atol=1e-6)
+                np.testing.assert_allclose(std, expectedStd, atol=1e-6)
+
+    def test_projectTomogram(self):
+        np.testing.assert_allclose(projectTomogram(self.fnVol), self.volume.sum(axis=0), rtol=1e-5, atol=1e-5)
+        # Slabs smaller than the range and ranges out of the volume
+        np.testing.assert_allclose(projectTomogram(self.fnVol, zRange=(3, 11), slabSize=3),
+                                   self.volume[3:11].sum(axis=0), rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(projectTomogram(self.fnVol, zRange=(-5, 100), slabSize=7),
+                                   self.volume.sum(axis=0), rtol=1e-5, atol=1e-5)
+        self.assertEqual(projectTomogram(self.fnVol).dtype, np.float32)
+
+    def test_mapBackReference(self):
+        # Reference with a cube at its center, which rotations of 90 degrees keep in place
+        reference = np.zeros((9, 9, 9), dtype=np.float32)
+        reference[3:6, 3:6, 3:6] = 1
+        fnRef = self.getOutputPath('reference.mrc')
+        ih = ImageHandler()
+        image = ih.createImage()
+        image.setData(reference)
+        ih.write(image, fnRef)
+
+        # x, y, z positions with x shifts and rot angles, the last one out of the tomogram
+        positions = np.array([[10, 11, 12], [3, 17, 5], [-20, 5, 5]])
+        shifts = [0, 1, 0]
+        rots = [0, 90.2, 0]
+        fnGeometry = self.getOutputPath('geometry.xmd')
+        writeXmdBlock(fnGeometry, OrderedDict([(lib.MDL_XCOOR, positions[:, 0]),
+                                               (lib.MDL_YCOOR, positions[:, 1]),
+                                               (lib.MDL_ZCOOR, positions[:, 2]),
+                                               (lib.MDL_SHIFT_X, np.array(shifts, dtype=float)),
+                                               (lib.MDL_SHIFT_Y, np.zeros(3)),
+                                               (lib.MDL_SHIFT_Z, np.zeros(3)),
+                                               (lib.MDL_ANGLE_ROT, np.array(rots, dtype=float)),
+                                               (lib.MDL_ANGLE_TILT, np.zeros(3)),
+                                               (lib.MDL_ANGLE_PSI, np.zeros(3))]))
+
+        for method in ('copy', 'avg', 'highlight', 'copy_binary'):
+            fnTomo = self.getOutputPath('tomo_%s.mrc' % method)
+            image.setData(self.volume)
+            ih.write(image, fnTomo)
+
+            # Rounding the angles to the angular step makes the rotation exactly 90 degrees
+            painted = mapBackReference(fnTomo, fnRef, fnGeometry, method=method, threshold=0.5, constant=3,
+                                       angularStep=0.5)
+            self.assertEqual(painted, 2)
+
+            # Painting every position voxel by voxel, the reference being moved by the shift
+            expected = self.volume.astype(float)
+            for (x, y, z), shiftX in zip(positions[:2], shifts):
+                values = np.roll(reference, shiftX, axis=2)
+                region = expected[z - 4:z + 5, max(y - 4, 0):y + 5, max(x - 4, 0):x + 5]
+                values = values[:, values.shape[1] - region.shape[1]:, values.shape[2] - region.shape[2]:]
+                if method == 'copy':
+                    region[...] = 3 * values
+                elif method == 'avg':
+                    region[values > 0.5] = np.mean(region[values > 0.5])
+                elif method == 'highlight':
+                    region += 3 * values
+                else:
+                    region[...] = values > 0.5
+
+            np.testing.assert_allclose(np.squeeze(ih.read(fnTomo).getData()), expected, atol=1e-5)
+
+        # By default the exact angles are used
+        fnTomo = self.getOutputPath('tomo_exact.mrc')
+        image.setData(self.volume)
+        ih.write(image, fnTomo)
+        mapBackReference(fnTomo, fnRef, fnGeometry, method='highlight', constant=3)
+        painted = np.squeeze(ih.read(fnTomo).getData()) - self.volume
+        self.assertFalse(np.allclose(painted[1:10, 13:22, 0:8], 3 * np.roll(reference, 1, axis=2)[:, :, 1:], atol=1e-5))
+        self.assertAlmostEqual(painted[1:10, 13:22, 0:8].sum(), 3 * reference.sum(), places=3)
+
+
+class TestXmipptomoUtilsTiltSeries(BaseTest):
+    """This class checks the memory mapped MRC files and the conversion of xmd files to tilt series."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+        cls.ih = ImageHandler()
+
+    def _writeImage(self, data, fnImage):
+        image = self.ih.createImage()
+        image.setData(np.asarray(data, dtype=np.float32))
+        self.ih.write(image, fnImage)
+
+    def test_mrcMemmap(self):
+        data = np.arange(3 * 4 * 5, dtype=np.float32).reshape(3, 4, 5)
+        fnMrc = self.getOutputPath('memmap.mrc')
+        self._writeImage(data, fnMrc)
+
+        stack = mrcMemmap(fnMrc)
+        np.testing.assert_array_equal(stack, data)
+        stack[1] = -1
+        stack.flush()
+        del stack
+        np.testing.assert_array_equal(mrcMemmap(fnMrc, mode='r')[1], -np.ones((4, 5)))
+
+        # Unsupported modes and headers not matching the data are reported
+        with open(fnMrc, 'r+b') as f:
+            f.seek(12)
+            f.write(np.array([4], dtype='<i4').tobytes())
+        with self.assertRaisesRegex(ValueError, 'mode 4'):
+            mrcMemmap(fnMrc)
+        with open(fnMrc, 'r+b') as f:
+            f.seek(12)
+            f.write(np.array([2], dtype='<i4').tobytes())
+            f.truncate(os.path.getsize(fnMrc) - 4)
+        with self.assertRaisesRegex(ValueError, 'does not match'):
+            mrcMemmap(fnMrc)
+
+    def test_xmdToTiltSeries(self):
+        tiltAngles = [-30.0, 0.0, 30.0]
+        rng = np.random.default_rng(0)
+        images = rng.normal(size=(len(tiltAngles), 6, 8)).astype(np.float32)
+
+        # Input tilt series, whose tilt images are copied to the output one
+        inSet = SetOfTiltSeries(filename=self.getOutputPath('inputTiltSeries.sqlite'))
+        inSet.setSamplingRate(1)
+        inTs = TiltSeries(tsId='ts1')
+        inSet.append(inTs)
+        for index, tiltAngle in enumerate(tiltAngles, start=1):
+            tiltImage = TiltImage(location=(index, 'input.mrcs'))
+            tiltImage.setTiltAngle(tiltAngle)
+            tiltImage.setAcquisitionOrder(len(tiltAngles) - index)
+            inTs.append(tiltImage)
+        inSet.update(inTs)
+
+        # One image file per tilt listed in a metadata file, as written by the Xmipp programs
+        odir = self.getOutputPath('xmdToTiltSeries')
+        os.makedirs(odir, exist_ok=True)
+        fnImages = ['image_%d.mrc' % index for index in range(len(tiltAngles))]
+        for image, fnImage in zip(images, fnImages):
+            self._writeImage(image[None], os.path.join(odir, fnImage))
+        fnXmd = os.path.join(odir, 'ts1.xmd')
+        writeXmdBlock(fnXmd, OrderedDict([(lib.MDL_IMAGE, fnImages), (lib.MDL_ANGLE_TILT, np.array(tiltAngles))]))
+
+        outSet = SetOfTiltSeries(filename=self.getOutputPath('outputTiltSeries.sqlite'))
+        outSet.setSamplingRate(2)
+        newTs = xmdToTiltSeries(outSet, inTs, fnXmd, sampling=2, odir=odir, tsid='ts1', suffix='_out')
+        outSet.update(newTs)
+
+        fnStack = os.path.join(odir, 'ts1_out.mrcs')
+        np.testing.assert_allclose(mrcMemmap(fnStack, mode='r'), images)
+        self.assertFalse(any(os.path.exists(os.path.join(odir, fnImage)) for fnImage in fnImages))
+
+        self.assertEqual(newTs.getSamplingRate(), 2)
+        self.assertEqual(newTs.getSize(), len(tiltAngles))
+        for index, (newTi, inTi) in enumerate(zip(newTs.iterItems(orderBy='id'), inTs.iterItems(orderBy='id')),
+                                              start=1):
+            self.assertEqual(newTi.getLocation(), (index, fnStack))
+            self.assertEqual(newTi.getTiltAngle(), inTi.getTiltAngle())
+            self.assertEqual(newTi.getAcquisitionOrder(), inTi.getAcquisitionOrder())
+            self.assertEqual(newTi.getObjId(), inTi.getObjId())
+
+
+class TestXmipptomoUtilsSetKeyIndex(BaseTest):
+    """This class checks the keyed index over the items of a set."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setupTestOutput()
+
+    def test_SetKeyIndex(self):
+        tomograms = SetOfTomograms(filename=self.getOutputPath('tomograms.sqlite'))
+        tomograms.setSamplingRate(1)
+        for tsId in ('ts_a', 'ts_b'):
+            tomogram = Tomogram(location='%s.mrc' % tsId)
+            tomogram.setTsId(tsId)
+            tomograms.append(tomogram)
+        tomograms.write()
+
+        index = SetKeyIndex(tomograms)
+        tsIdIndex = SetKeyIndex(tomograms, keyGetter='getTsId')
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index[2].getFileName(), 'ts_b.mrc')
+        self.assertEqual(tsIdIndex.get('ts_a').getObjId(), 1)
+        self.assertIsNone(tsIdIndex.get('ts_c'))
+        self.assertNotIn(3, index)
+
+        # Items are copies, so they are not changed by later iterations over the set
+        for _ in tomograms:
+            pass
+        self.assertEqual(index[1].getTsId(), 'ts_a')
+        self.assertEqual(index[2].getTsId(), 'ts_b')
+
+        # The index is rebuilt once the set is modified
+        tomogram = Tomogram(location='ts_c.mrc')
+        tomogram.setTsId('ts_c')
+        tomograms.append(tomogram)
+        tomograms.write()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[3].getFileName(), 'ts_c.mrc')
+        self.assertEqual(tsIdIndex['ts_c'].getObjId(), 3)
@@ -28,63 +28,250 @@ This module contains utils functions for xmipp tomo protocols
 """
 
 # General imports
-import math
-import csv
 import os
 import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice, takewhile
+import numpy as np
+from scipy.ndimage import affine_transform
 
 # Scipion em imports
-import emtable
 from pwem import ALIGN_PROJ
-from pwem.objects import Integer, CTFModel, Transform
+from pwem.objects import Integer, CTFModel
 from pwem.emlib import lib
 import pwem.emlib.metadata as md
 from pwem.emlib.image import ImageHandler
 import pyworkflow as pw
 
 # External plugin imports
-from tomo.objects import TiltSeries, TiltImage, SetOfCTFTomoSeries
-from tomo.objects import MATRIX_CONVERSION, TiltSeries, TiltImage
+from tomo.objects import TiltSeries, TiltImage, SetOfCTFTomoSeries, MATRIX_CONVERSION
 from tomo.constants import BOTTOM_LEFT_CORNER
 from xmipp3.convert import alignmentToRow
 
+# Plugin imports
+from .convert import alignmentToColumns, matrixFromGeometries
+
 OUTPUT_TILTSERIES_NAME = "TiltSeries"
+MRC_HEADER_SIZE = 1024
+MRC_EXTENSIONS = ['.mrc', '.mrcs', '.rec', '.st', '.ali']
+MRC_MODE_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+XMD_COORDINATE_LABELS = ['xcoor', 'ycoor', 'zcoor']
+XMD_ALIGNMENT_LABELS = ['shiftX', 'shiftY', 'shiftZ', 'angleRot', 'angleTilt', 'anglePsi']
 OUTPUT_TS_INTERPOLATED_NAME = "InterpolatedTiltSeries"
 
 def calculateRotationAngleAndShiftsFromTM(ti):
     """ This method calculates the rot and shifts of a tilt image from its associated transformation matrix."""
-    transform = ti.getTransform()
-    if transform is None:
-        rotationAngle = 0.0
-        sx = 0.0
-        sy = 0.0
-    else:
-        tm = transform.getMatrix()
-        cosRotationAngle = tm[0][0]
-        sinRotationAngle = tm[1][0]
-        rotationAngle = float(math.degrees(math.atan(sinRotationAngle / cosRotationAngle)))
-        sx = tm[0][2]
-        sy = tm[1][2]
+    rotationAngles, sxs, sys = calculateRotationAnglesAndShiftsFromTMStack(getTiltImageMatrix(ti))
 
-    return rotationAngle, sx, sy
+    return float(rotationAngles[0]), float(sxs[0]), float(sys[0])
 
-def readXmdStatisticsFile(fnmd):
-    xPos = []
-    yPos = []
-    zPos = []
-    avg = []
-    std = []
+def calculateRotationAnglesAndShiftsFromTMStack(matrices):
+    """ This method calculates the rot and shifts of a stack of (N, 3, 3) transformation matrices, returning three
+    arrays of length N. The rotation angle (in degrees) is the arctangent of the sine over the cosine of the angle, so
+    it is defined in (-90, 90]. It is computed with atan2 and folded, so it does not break when the cosine is 0."""
+    matrices = np.asarray(matrices, dtype=float).reshape(-1, 3, 3)
+    rotationAngles = np.degrees(np.arctan2(matrices[:, 1, 0], matrices[:, 0, 0]))
+    rotationAngles = 90 - (90 - rotationAngles) % 180
 
-    table = emtable.Table(fileName=fnmd)
+    return rotationAngles, matrices[:, 0, 2].copy(), matrices[:, 1, 2].copy()
 
-    for row in table.iterRows(fileName='noname@' + fnmd):
-        avg.append(row.get('avg'))
-        std.append(row.get('stddev'))
-        xPos.append(row.get('xcoor'))
-        yPos.append(row.get('ycoor'))
-        zPos.append(row.get('zcoor'))
+def getTiltImageMatrix(ti):
+    """ This method returns a copy of the 3x3 transformation matrix of a tilt image, or the identity if the tilt image
+    has no transform."""
+    transform = ti.getTransform()
 
-    return xPos, yPos, zPos, avg, std
+    return np.identity(3) if transform is None else np.array(transform.getMatrix(), dtype=float)
+
+def getTransformationMatrixStack(ts):
+    """ This method returns the (N, 3, 3) stack of transformation matrices of the N tilt images of a tilt series,
+    reading all of them in a single pass over the tilt series."""
+    return np.array([getTiltImageMatrix(ti) for ti in ts], dtype=float).reshape(-1, 3, 3)
+
+def eulerAnglesToMatrices(rot, tilt, psi):
+    """ This method returns the (N, 3, 3) stack of rotation matrices associated to the given Euler angles (in
+    degrees) following the Xmipp convention. Angles can be given as scalars or arrays of the same length. """
+    rot, tilt, psi = np.broadcast_arrays(*(np.radians(np.atleast_1d(np.asarray(angle, dtype=float)))
+                                           for angle in (rot, tilt, psi)))
+    ca, sa = np.cos(rot), np.sin(rot)
+    cb, sb = np.cos(tilt), np.sin(tilt)
+    cg, sg = np.cos(psi), np.sin(psi)
+    cc, cs, sc, ss = cb * ca, cb * sa, sb * ca, sb * sa
+
+    matrices = np.empty((len(rot), 3, 3))
+    matrices[:, 0, 0] = cg * cc - sg * sa
+    matrices[:, 0, 1] = cg * cs + sg * ca
+    matrices[:, 0, 2] = -cg * sb
+    matrices[:, 1, 0] = -sg * cc - cg * sa
+    matrices[:, 1, 1] = -sg * cs + cg * ca
+    matrices[:, 1, 2] = sg * sb
+    matrices[:, 2, 0] = sc
+    matrices[:, 2, 1] = ss
+    matrices[:, 2, 2] = cb
+
+    return matrices
+
+
+def projectVolumeFourier(volume, rot, tilt, psi=0.0, pad=2, maxFreq=0.25, order=1):
+    """ This method projects a volume along all the given directions (Euler angles in degrees, Xmipp convention)
+    by means of the central slice theorem. The 3D Fourier transform of the padded volume is computed only once and
+    the central slices of all the directions are interpolated in a single call. Frequencies over maxFreq (digital
+    frequency) are discarded. The interpolation order is 0 for nearest neighbour, 1 for linear and 3 for cubic
+    B-spline. It returns a (N, Ydim, Xdim) array containing one projection per direction. """
+    from scipy import ndimage
+
+    zdim, ydim, xdim = volume.shape
+    size = int(max(volume.shape) * pad)
+    center = size // 2
+
+    # Centering the volume in the padded box and computing its Fourier transform (origin at the center)
+    padded = np.zeros((size, size, size), dtype=np.float32)
+    z0, y0, x0 = center - zdim // 2, center - ydim // 2, center - xdim // 2
+    padded[z0:z0 + zdim, y0:y0 + ydim, x0:x0 + xdim] = volume
+    fourier = np.fft.fftshift(np.fft.fftn(np.fft.ifftshift(padded)))
+    fourierParts = [fourier.real, fourier.imag]
+    if order > 1:
+        fourierParts = [ndimage.spline_filter(part, order=order) for part in fourierParts]
+
+    # Frequencies of the central slice inside the maximum frequency
+    ky, kx = np.mgrid[-center:size - center, -center:size - center]
+    inside = kx ** 2 + ky ** 2 <= (maxFreq * size) ** 2
+    kx, ky = kx[inside], ky[inside]
+
+    # Position in the 3D Fourier transform of every central slice frequency, in (z, y, x) order
+    matrices = eulerAnglesToMatrices(rot, tilt, psi)
+    nProjections = len(matrices)
+    freqs = kx[None, :, None] * matrices[:, None, 0, :] + ky[None, :, None] * matrices[:, None, 1, :]
+    coords = freqs[..., ::-1].reshape(-1, 3).T + center
+
+    # Interpolating all the central slices at once
+    values = [ndimage.map_coordinates(part, coords, order=order, mode='constant', cval=0.0, prefilter=False)
+              for part in fourierParts]
+    slices = np.zeros((nProjections, size, size), dtype=complex)
+    slices[:, inside] = (values[0] + 1j * values[1]).reshape(nProjections, -1)
+
+    # Back to real space and cropping to the original dimensions
+    projections = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(slices, axes=(1, 2))), axes=(1, 2)).real
+    y0, x0 = center - ydim // 2, center - xdim // 2
+
+    return projections[:, y0:y0 + ydim, x0:x0 + xdim].astype(np.float32)
+
+
+def readXmdHeader(fnmd, blockName=None):
+    """ This method returns the column labels of a block of a Xmipp metadata file, the number of lines before the
+    values of the block and whether the block is a loop (one row per line) or a list of label/value pairs. If no
+    block name is given, the first block of the file is used. """
+    labels = []
+    isLoop = False
+    inBlock = False
+    with open(fnmd) as fileHandler:
+        for lineNumber, line in enumerate(fileHandler):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                # Blank and comment lines may also appear between the labels and the values
+                continue
+            if line.startswith('data_'):
+                if inBlock:
+                    break
+                inBlock = blockName is None or line[len('data_'):] == blockName
+            elif not inBlock:
+                continue
+            elif line.startswith('loop_'):
+                isLoop = True
+            elif line.startswith('_'):
+                labels.append(line.split()[0][1:])
+                if not isLoop:
+                    return labels, lineNumber, isLoop
+            else:
+                return labels, lineNumber, isLoop
+
+    return labels, None, isLoop
+
+def readXmdColumns(fnmd, labels=None, blockName=None, cacheDir=None):
+    """ This method parses in bulk a block of a Xmipp metadata file and returns it as a structured array with one
+    field per column label. Numeric columns are stored as float64 and the rest as strings. A subset of the columns can
+    be selected with the labels argument.
+    If a cacheDir is given (e.g. the tmp folder of the calling protocol), the parsed array is cached there as a .npy
+    file and opened memory-mapped, so very large files are only parsed once and do not need to fit in memory. The
+    metadata file itself may live in a read only folder or belong to another protocol. """
+    if cacheDir is not None:
+        pathHash = hashlib.md5(os.path.abspath(fnmd).encode()).hexdigest()[:8]
+        cacheFile = os.path.join(cacheDir, '%s_%s.%s.npy' % (os.path.splitext(os.path.basename(fnmd))[0], pathHash,
+                                                             blockName or 'block'))
+        if os.path.exists(cacheFile) and os.path.getmtime(cacheFile) >= os.path.getmtime(fnmd):
+            data = np.load(cacheFile, mmap_mode='r')
+            return data[list(labels)] if labels else data
+
+    allLabels, valuesLine, isLoop = readXmdHeader(fnmd, blockName=blockName)
+    if valuesLine is None:
+        values = np.empty((0, len(allLabels)), dtype=str)
+    elif isLoop:
+        # Values start right after the header and finish with the first empty line or the next block
+        with open(fnmd) as fileHandler:
+            lines = []
+            for lineNumber, line in enumerate(fileHandler):
+                if lineNumber < valuesLine:
+                    continue
+                line = line.strip()
+                if not line or line.startswith('data_'):
+                    break
+                if not line.startswith('#'):
+                    lines.append(line)
+        values = np.array(' '.join(lines).split()).reshape(-1, len(allLabels))
+    else:
+        # List blocks contain one label and its value per line
+        pairs = {}
+        with open(fnmd) as fileHandler:
+            for lineNumber, line in enumerate(fileHandler):
+                if lineNumber < valuesLine:
+                    continue
+                fields = line.split(None, 1)
+                if not fields or not fields[0].startswith('_'):
+                    break
+                pairs[fields[0][1:]] = fields[1].strip() if len(fields) > 1 else ''
+        allLabels = list(pairs.keys())
+        values = np.array([list(pairs.values())], dtype=str).reshape(-1, len(allLabels))
+
+    # Converting each column to its type
+    columns = []
+    for index, label in enumerate(allLabels):
+        column = values[:, index]
+        try:
+            column = column.astype(float)
+        except ValueError:
+            pass
+        columns.append((label, column))
+    data = np.empty(values.shape[0], dtype=[(label, column.dtype) for label, column in columns])
+    for label, column in columns:
+        data[label] = column
+
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        np.save(cacheFile, data)
+        data = np.load(cacheFile, mmap_mode='r')
+
+    return data[list(labels)] if labels else data
+
+def readXmdStatisticsFile(fnmd, cacheDir=None):
+    """ This method returns the x, y and z positions, average and standard deviation of every coordinate of a
+    statistics metadata file as five NumPy arrays, parsed in bulk. See readXmdColumns for the cacheDir argument. """
+    data = readXmdColumns(fnmd, cacheDir=cacheDir)
+
+    return data['xcoor'], data['ycoor'], data['zcoor'], data['avg'], data['stddev']
+
+
+def writeXmdStatisticsFile(fnmd, positions, avg, std):
+    """ This method writes a statistics metadata file, as read by readXmdStatisticsFile, from the (N, 3) x, y, z
+    positions and the average and standard deviation of every coordinate in a single write. Positions are written
+    as given, so coordinates rebuilt from the file are not truncated. """
+    positions = np.asarray(positions).reshape(-1, 3)
+    writeXmdBlock(fnmd, OrderedDict([(lib.MDL_XCOOR, positions[:, 0]),
+                                     (lib.MDL_YCOOR, positions[:, 1]),
+                                     (lib.MDL_ZCOOR, positions[:, 2]),
+                                     (lib.MDL_AVG, np.asarray(avg, dtype=float)),
+                                     (lib.MDL_STDDEV, np.asarray(std, dtype=float))]))
 
 
 def tiltSeriesParticleToXmd(tsParticle):
@@ -102,63 +289,285 @@ def writeOutputCoordinates3dXmdFile(soc, filePath, tomoId=None):
     """ Generates a 3D coordinates xmd file from the set of coordinates associated to a given tomogram (identified by
      its tomo tomoId). If no tomoId is input the xmd output file will contain all the coordinates belonging to the
      set. """
+    ids, positions, _ = getCoordinatesColumns(soc, volume=tomoId, withMatrices=False)
+
+    writeXmdBlock(filePath, coordinatesToColumns(ids, positions, idLabel=None))
+
+
+def getCoordinatesColumns(setOfCoordinates, volume=None, tsId=None, withMatrices=True):
+    """ Extracts in a single pass the ids, the (N, 3) positions (referred to the bottom left corner) and, optionally,
+    the (N, 4, 4) transformation matrices (in Xmipp convention) of the coordinates of the given set, which can be any
+    set providing iterCoordinates. If a volume is given, only its coordinates are extracted and the positions are
+    referred to it. If a tsId is given, only the coordinates with that tomoId are kept.
+    Coordinates are iterated instead of queried straight from the sqlite file because their positions depend on the
+    origin of the volume they are referred to. """
+    ids, positions, matrices = [], [], []
+    for coord in setOfCoordinates.iterCoordinates(volume=volume):
+        if tsId is not None and coord.getTomoId() != tsId:
+            continue
+        if volume is not None and not isinstance(volume, int):
+            coord.setVolume(volume)
+        ids.append(coord.getObjId())
+        positions.append((coord.getX(BOTTOM_LEFT_CORNER), coord.getY(BOTTOM_LEFT_CORNER), coord.getZ(BOTTOM_LEFT_CORNER)))
+        if withMatrices:
+            matrices.append(np.array(coord.getMatrix(convention=MATRIX_CONVERSION.XMIPP), dtype=float))
+
+    return np.asarray(ids, dtype=int), np.asarray(positions, dtype=float).reshape(-1, 3), \
+        np.asarray(matrices, dtype=float).reshape(-1, 4, 4)
+
+
+def writeXmdBlock(fnXmd, columns, blockName='noname'):
+    """ Writes a Xmipp metadata file with a single loop block from an ordered dictionary from Xmipp label to the
+    array of values of that column, in one buffered write. """
+    lines = xmdHeaderLines(columns.keys(), blockName) + xmdRowLines(columns)
+    with open(fnXmd, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def xmdHeaderLines(labels, blockName='noname'):
+    """ Returns the header lines of a Xmipp metadata loop block with the given labels. """
+    lines = ["# XMIPP_STAR_1 *", "#", "data_%s" % blockName, "loop_"]
+    return lines + [" _%s" % lib.label2Str(label) for label in labels]
+
+
+def xmdRowLines(columns):
+    """ Returns the formatted rows of a Xmipp metadata loop block from an ordered dictionary from Xmipp label to the
+    array of values of that column. """
+    formattedColumns = []
+    for values in columns.values():
+        values = np.asarray(values)
+        if values.dtype.kind == 'b':
+            formattedColumns.append(values.astype(int).astype(str))
+        elif values.dtype.kind in 'iu':
+            formattedColumns.append(values.astype(str))
+        elif values.dtype.kind == 'f':
+            formattedColumns.append(np.char.mod('%.6f', values))
+        else:
+            formattedColumns.append(np.array(["'%s'" % value if ' ' in str(value) else str(value) for value in values]))
+
+    return [" " + " ".join(row) for row in zip(*formattedColumns)]
+
+
+def mrcMemmap(fnMrc, mode='r+'):
+    """
+    This function returns a (nz, ny, nx) NumPy memory map over the data of a MRC file or stack, so its images can be
+    read or written in place without reopening the file. Only the usual data modes are supported.
+    """
+    with open(fnMrc, 'rb') as f:
+        header = f.read(MRC_HEADER_SIZE)
+
+    # Machine stamp tells the endianness of the file
+    byteOrder = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, dataMode = np.frombuffer(header, dtype=byteOrder + 'i4', count=4)
+    nsymbt = int(np.frombuffer(header, dtype=byteOrder + 'i4', count=1, offset=92)[0])
+    if dataMode not in MRC_MODE_DTYPES:
+        raise ValueError("MRC mode %d of %s is not supported." % (dataMode, fnMrc))
 
-    xmdHeader = "# XMIPP_STAR_1 *\n" \
-                "#\n" \
-                "data_noname\n" \
-                "loop_\n" \
-                " _xcoor\n" \
-                " _ycoor\n" \
-                " _zcoor\n"
+    # The header must describe the data actually stored in the file
+    dtype = np.dtype(MRC_MODE_DTYPES[dataMode]).newbyteorder(byteOrder)
+    dataSize = int(nx) * int(ny) * int(nz) * dtype.itemsize
+    if os.path.getsize(fnMrc) < MRC_HEADER_SIZE + nsymbt + dataSize:
+        raise ValueError("MRC header of %s (%d x %d x %d, mode %d) does not match its size of %d bytes."
+                         % (fnMrc, nx, ny, nz, dataMode, os.path.getsize(fnMrc)))
 
-    coordinatesInfo = []
-    fieldNames = ['x', 'y', 'z']
+    return np.memmap(fnMrc, dtype=dtype, mode=mode, offset=MRC_HEADER_SIZE + nsymbt,
+                     shape=(int(nz), int(ny), int(nx)))
 
-    for coord in soc.iterCoordinates(tomoId):
-        coordinatesInfo.append([coord.getX(BOTTOM_LEFT_CORNER),
-                                coord.getY(BOTTOM_LEFT_CORNER),
-                                coord.getZ(BOTTOM_LEFT_CORNER)])
 
-    with open(filePath, 'w') as f:
-        f.write(xmdHeader)
-        writer = csv.DictWriter(f, delimiter='\t', fieldnames=fieldNames)
+def readVolume(fnVol):
+    """
+    This function returns the (nz, ny, nx) data of a volume. MRC files are opened as a read only memory map, so only the
+    regions that are accessed are read from disk. Other formats are fully read by the ImageHandler.
+    """
+    fnVol = fnVol.split(':')[0]
+    if os.path.splitext(fnVol)[1].lower() in MRC_EXTENSIONS:
+        return mrcMemmap(fnVol, mode='r')
+    return np.squeeze(ImageHandler().read(fnVol).getData())
+
 
-        for ci in coordinatesInfo:
-            writer.writerow({'x': ci[0],
-                             'y': ci[1],
-                             'z': ci[2]})
+def ballOffsets(radius):
+    """
+    This function returns the (M, 3) integer z, y, x offsets of the voxels inside a ball of the given radius.
+    """
+    r = int(np.floor(radius))
+    grid = np.mgrid[-r:r + 1, -r:r + 1, -r:r + 1].reshape(3, -1).T
+    return grid[np.sum(grid ** 2, axis=1) <= radius ** 2]
+
+
+def ballStatistics(fnVol, positions, radius, maxVoxels=2 ** 24):
+    """
+    This function returns the average and standard deviation of a volume inside a ball of the given radius centered
+    at each of the (N, 3) x, y, z positions (voxel indices). Voxels out of the volume are not considered.
+    The ball offsets are computed once. Small balls are gathered for batches of coordinates at once, bounding the
+    gathered voxels by maxVoxels, while large balls are computed on the cropped box of each coordinate.
+    """
+    vol = readVolume(fnVol)
+    shape = np.array(vol.shape)
+    centers = np.rint(np.asarray(positions, dtype=float)).astype(int).reshape(-1, 3)[:, ::-1]
+    offsets = ballOffsets(radius)
+    avg = np.zeros(len(centers))
+    std = np.zeros(len(centers))
+    if not len(centers):
+        return avg, std
+
+    batchSize = maxVoxels // len(offsets)
+    if batchSize >= 16:
+        for first in range(0, len(centers), batchSize):
+            voxels = centers[first:first + batchSize, None, :] + offsets[None, :, :]
+            inside = np.all((voxels >= 0) & (voxels < shape), axis=2)
+            voxels = np.where(inside[..., None], voxels, 0)
+            values = np.asarray(vol[voxels[..., 0], voxels[..., 1], voxels[..., 2]], dtype=float)
+            counts = np.maximum(np.count_nonzero(inside, axis=1), 1)
+            batchAvg = np.sum(values * inside, axis=1) / counts
+            batchVar = np.sum(((values - batchAvg[:, None]) ** 2) * inside, axis=1) / counts
+            avg[first:first + batchSize] = batchAvg
+            std[first:first + batchSize] = np.sqrt(batchVar)
+    else:
+        r = int(np.floor(radius))
+        ball = np.zeros((2 * r + 1,) * 3, dtype=bool)
+        ball[tuple((offsets + r).T)] = True
+        for i, center in enumerate(centers):
+            low = np.maximum(center - r, 0)
+            high = np.minimum(center + r + 1, shape)
+            if np.any(high <= low):
+                continue
+            mask = ball[tuple(slice(l, h) for l, h in zip(low - center + r, high - center + r))]
+            values = np.asarray(vol[tuple(slice(l, h) for l, h in zip(low, high))], dtype=float)[mask]
+            if values.size:
+                avg[i] = values.mean()
+                std[i] = values.std()
+    return avg, std
+
+
+def mapBackReference(fnTomo, fnRef, fnGeometry, method='copy', threshold=0.5, constant=1, scale=1,
+                     angularStep=None, cacheBytes=2 ** 27):
+    """
+    This function paints a reference into a float32 MRC tomogram at the positions and orientations of a geometry
+    metadata file, as written by writeMdCoordinates, in the same way as xmipp_tomo_map_back. The tomogram is memory
+    mapped and modified in place. Each reference is rotated, shifted and scaled by scale with linear interpolation.
+    The transformed references are kept in an LRU cache of at most cacheBytes bytes, so repeated orientations are only
+    computed once. If an angularStep is given, angles are rounded to it (in degrees) so nearby orientations share the
+    same transformed reference, at the cost of a small displacement of the reference. The methods are:
+        copy: the reference multiplied by constant replaces the tomogram.
+        avg: the tomogram voxels where the reference is above threshold are set to their average.
+        highlight: the reference multiplied by constant is added to the tomogram.
+        copy_binary: the reference binarized with threshold replaces the tomogram.
+    Returns the number of references painted.
+    """
+    tomo = mrcMemmap(fnTomo, mode='r+')
+    ref = np.array(readVolume(fnRef), dtype=np.float32)
+    geometry = readXmdColumns(fnGeometry)
+    if not len(geometry):
+        return 0
+
+    size = np.array(ref.shape)
+    center = size // 2
+    positions = np.column_stack([geometry['zcoor'], geometry['ycoor'], geometry['xcoor']]).astype(int)
+    transforms = np.column_stack([geometry[label] for label in XMD_ALIGNMENT_LABELS])
+    transforms[:, :3] = np.round(transforms[:, :3], 3)
+    if angularStep:
+        transforms[:, 3:] = np.round(transforms[:, 3:] / angularStep) * angularStep
+
+    # All the transformed references have the size of the reference
+    @lru_cache(maxsize=max(1, cacheBytes // ref.nbytes))
+    def transformedReference(transform):
+        # Output voxel r gets the reference at A^-1 r / scale, A being the Xmipp transformation (x, y, z order)
+        A = matrixFromGeometries(transform[:3], transform[3:], False)[0]
+        Rinv = A[:3, :3].T
+        matrix = Rinv[::-1, ::-1] / scale
+        offset = center - matrix @ center - (Rinv @ A[:3, 3])[::-1] / scale
+        return affine_transform(ref, matrix, offset=offset, order=1, mode='constant', cval=0.0)
+
+    painted = 0
+    for position, transform in zip(positions, transforms):
+        low = position - center
+        tomoLow = np.maximum(low, 0)
+        tomoHigh = np.minimum(low + size, tomo.shape)
+        if np.any(tomoHigh <= tomoLow):
+            continue
+        values = transformedReference(tuple(transform))[tuple(slice(l, h) for l, h in
+                                                             zip(tomoLow - low, tomoHigh - low))]
+        region = tomo[tuple(slice(l, h) for l, h in zip(tomoLow, tomoHigh))]
+        if method == 'copy':
+            region[...] = constant * values
+        elif method == 'avg':
+            mask = values > threshold
+            if np.any(mask):
+                region[mask] = np.mean(region[mask])
+        elif method == 'highlight':
+            region += constant * values
+        elif method == 'copy_binary':
+            region[...] = values > threshold
+        else:
+            raise ValueError("Unknown map back method %s." % method)
+        painted += 1
+
+    tomo.flush()
+    return painted
+
+
+def fileSha256(fileName, blockSize=2 ** 24):
+    """
+    This function returns the hexadecimal SHA-256 digest of the content of a file, read in blocks of blockSize bytes.
+    """
+    digest = hashlib.sha256()
+    with open(fileName.split(':')[0], 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def projectTomogram(fnTomo, zRange=None, slabSize=64):
+    """
+    This function returns the sum along Z of a tomogram as a (ny, nx) float32 array. MRC tomograms are memory mapped
+    and accumulated in slabs of slabSize slices, so memory is bounded by the slab instead of the whole volume. The
+    projection can be restricted to the slices in the half open range zRange=(zMin, zMax).
+    """
+    tomo = readVolume(fnTomo)
+    zMin, zMax = (0, tomo.shape[0]) if zRange is None else zRange
+    zMin, zMax = max(0, int(zMin)), min(tomo.shape[0], int(zMax))
+    projection = np.zeros(tomo.shape[1:], dtype=np.float32)
+    for z in range(zMin, zMax, slabSize):
+        projection += np.sum(tomo[z:min(z + slabSize, zMax)], axis=0, dtype=np.float32)
+    return projection
 
 
 def xmdToTiltSeries(outputSetOfTs, inTs, fnXmd, sampling=1, odir='', tsid='defaulttsId', suffix=''):
     """
-    This function takes a metadata files as input and stores the Tilt Series
+    This function takes a metadata files as input and stores the Tilt Series.
+    The output stack is preallocated and filled in a single pass through a memory map.
     """
     mdts = md.MetaData(fnXmd)
-    counter = 1
+    fnImgs = [os.path.join(odir, fnImg) for fnImg in mdts.getColumnValues(lib.MDL_IMAGE)]
 
     ih = ImageHandler()
     newTs = TiltSeries(tsId=tsid)
     newTs.copyInfo(inTs, copyId=True)
+    newTs.setSamplingRate(sampling)
     outputSetOfTs.append(newTs)
     fnStack = os.path.join(odir, tsid + suffix + '.mrcs')
 
-    for objId in mdts:
-        fnImg = os.path.join(odir, mdts.getValue(lib.MDL_IMAGE, objId))
-        mdts.getValue(lib.MDL_ANGLE_TILT, objId)
-
-        originalTi = inTs[counter]
+    # Preallocating the output stack and streaming every image into it
+    if fnImgs:
+        x, y, _, _ = ih.getDimensions(fnImgs[0])
+        lib.createEmptyFile(fnStack, x, y, 1, len(fnImgs))
+        stack = mrcMemmap(fnStack)
+        for index, fnImg in enumerate(fnImgs):
+            stack[index] = ih.read(fnImg).getData()
+        stack.flush()
+        del stack
+        pw.utils.cleanPath(*fnImgs)
+
+    # Creating the tilt images from the input tilt series, read in a single pass
+    for counter, originalTi in enumerate(inTs.iterItems(orderBy='id'), start=1):
+        if counter > len(fnImgs):
+            break
         newTi = TiltImage()
         newTi.copyInfo(originalTi, copyId=True, copyTM=True)
         newTi.setOddEven([])
-
-        newLocation = (counter, fnStack)
-        ih.convert(fnImg, newLocation)
-        pw.utils.cleanPath(fnImg)
-        newTi.setLocation(newLocation)
-
+        newTi.setLocation((counter, fnStack))
         newTs.append(newTi)
-        newTs.setSamplingRate(sampling)
-        counter = counter + 1
+
     return newTs
 
 
@@ -170,48 +579,92 @@ def writeMdTiltSeries(ts, tomoPath, fnXmd=None):
     mdts = lib.MetaData()
     tsid = ts.getTsId()
 
-    for _, item in enumerate(ts):
-
-        transform = item.getTransform()
-        if transform is None:
-            rot = 0
-            sx = 0
-            sy = 0
-        else:
-            rot, sx, sy = calculateRotationAngleAndShiftsFromTM(item)
-
+    # Reading all the tilt images in a single pass
+    fns, tilts, matrices, defocus, halves = [], [], [], [], []
+    hasCtf = False
+    for item in ts:
         tiIndex = item.getLocation()[0]
-        fn = str(tiIndex) + "@" + item.getFileName()
-        nRow = md.Row()
-        nRow.setValue(lib.MDL_IMAGE, fn)
+        fns.append(str(tiIndex) + "@" + item.getFileName())
+        tilts.append(item.getTiltAngle())
+        matrices.append(getTiltImageMatrix(item))
 
         if item.hasCTF():
-            defU = item.getCTF().getDefocusU()
-            defV = item.getCTF().getDefocusV()
-            defAng = item.getCTF().getDefocusAngle()
-            nRow.setValue(lib.MDL_CTF_DEFOCUSU, defU)
-            nRow.setValue(lib.MDL_CTF_DEFOCUSU, defV)
-            nRow.setValue(lib.MDL_CTF_DEFOCUS_ANGLE, defAng)
+            hasCtf = True
+            ctf = item.getCTF()
+            defocus.append((ctf.getDefocusU(), ctf.getDefocusV(), ctf.getDefocusAngle()))
+        else:
+            defocus.append((0.0, 0.0, 0.0))
 
         if ts.hasOddEven():
-            fnOdd = item.getOdd()
-            fnEven = item.getEven()
-            nRow.setValue(lib.MDL_HALF1, fnOdd)
-            nRow.setValue(lib.MDL_HALF2, fnEven)
-        nRow.setValue(lib.MDL_TSID, tsid)
-        tilt = item.getTiltAngle()
-        nRow.setValue(lib.MDL_ANGLE_TILT, tilt)
-        nRow.setValue(lib.MDL_ANGLE_ROT, rot)
-        nRow.setValue(lib.MDL_SHIFT_X, sx)
-        nRow.setValue(lib.MDL_SHIFT_Y, sy)
-        nRow.addToMd(mdts)
-
-        fnts = os.path.join(tomoPath, "%s_ts.xmd" % tsid)
-
+            halves.append((item.getOdd(), item.getEven()))
+
+    # Filling the metadata column by column
+    rot, sx, sy = calculateRotationAnglesAndShiftsFromTMStack(matrices)
+    for _ in fns:
+        mdts.addObject()
+    mdts.setColumnValues(lib.MDL_IMAGE, fns)
+
+    if hasCtf:
+        defocus = np.asarray(defocus, dtype=float)
+        mdts.setColumnValues(lib.MDL_CTF_DEFOCUSU, defocus[:, 0].tolist())
+        mdts.setColumnValues(lib.MDL_CTF_DEFOCUSV, defocus[:, 1].tolist())
+        mdts.setColumnValues(lib.MDL_CTF_DEFOCUS_ANGLE, defocus[:, 2].tolist())
+
+    if halves:
+        mdts.setColumnValues(lib.MDL_HALF1, [fnOdd for fnOdd, _ in halves])
+        mdts.setColumnValues(lib.MDL_HALF2, [fnEven for _, fnEven in halves])
+    mdts.setColumnValues(lib.MDL_TSID, [tsid] * len(fns))
+    mdts.setColumnValues(lib.MDL_ANGLE_TILT, [float(tilt) for tilt in tilts])
+    mdts.setColumnValues(lib.MDL_ANGLE_ROT, rot.tolist())
+    mdts.setColumnValues(lib.MDL_SHIFT_X, sx.tolist())
+    mdts.setColumnValues(lib.MDL_SHIFT_Y, sy.tolist())
+
+    fnts = os.path.join(tomoPath, "%s_ts.xmd" % tsid)
     mdts.write(fnts)
 
     return fnts
 
+class SetKeyIndex:
+    """
+    Keyed index over the items of a set: it maps the value returned by the given getter of each item (tsId, objId...)
+    to a copy of the item, so looking items up does not require scanning the set.
+    The index is built on first use and rebuilt whenever the set changes (different file, size or modification time).
+    It is meant to be kept by the protocol that uses it, and it can be shared by parallel steps.
+    """
+    def __init__(self, inputSet, keyGetter='getObjId'):
+        self._inputSet = inputSet
+        self._keyGetter = keyGetter
+        self._signature = None
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def _getSignature(self):
+        fileName = self._inputSet.getFileName()
+        mTime = os.path.getmtime(fileName) if fileName and os.path.exists(fileName) else None
+        return fileName, self._inputSet.getSize(), mTime
+
+    def _getItems(self):
+        with self._lock:
+            signature = self._getSignature()
+            if signature != self._signature:
+                self._items = {getattr(item, self._keyGetter)(): item.clone() for item in self._inputSet}
+                self._signature = signature
+            return self._items
+
+    def get(self, key, default=None):
+        """ Returns the item with the given key, or default if there is none. """
+        return self._getItems().get(key, default)
+
+    def __getitem__(self, key):
+        return self._getItems()[key]
+
+    def __contains__(self, key):
+        return key in self._getItems()
+
+    def __len__(self):
+        return len(self._getItems())
+
+
 def getCTFfromId(setOfCTFs: SetOfCTFTomoSeries, targetTsId: Integer) -> CTFModel:
     """
     This function returns the CTF from the set with the given target Tilt series id. 
@@ -233,74 +686,164 @@ def removeTmpElements(tmpElements):
                 os.remove(item)
 
 
-def retrieveXmipp3dCoordinatesIntoList(coordFilePath, xmdFormat=0):
-    """ This method takes a xmipp metadata (xmd) 3D coordinates file path and returns a list of tuples containing
-    every coordinate. This method also transform the coordinates into the Scipion convention. This method allows
-    different xmd formats containing coordinates information:
-        format=0: plain coordinates, xmd files only contains (x, y, z) values.
-        format=1: coordinates with alignment information, xmd files contains also shifts and angle values."""
-
-    coorList = []
+def iterXmipp3dCoordinates(coordFilePath, chunkSize=100000, withAlignment=False):
+    """ This method iterates over the 3D coordinates of a xmipp metadata (xmd) file in chunks of at most chunkSize
+    coordinates, so files with millions of coordinates do not need to be fully loaded in memory. Columns are located
+    by their labels in the header of the file. Each chunk is a (N, 3) float array with the x, y and z values, or, if
+    withAlignment is set, a (N, 9) float array that also contains the x, y and z shifts and the rot, tilt and psi
+    angles (missing alignment columns are filled with 0). """
+    labels, valuesLine, _ = readXmdHeader(coordFilePath)
+    columnLabels = XMD_COORDINATE_LABELS + (XMD_ALIGNMENT_LABELS if withAlignment else [])
+    nColumns = len(columnLabels)
+    if valuesLine is None:
+        return
+
+    # Locating the requested columns among the columns of the file
+    usecols = [labels.index(label) for label in columnLabels if label in labels]
+    present = [index for index, label in enumerate(columnLabels) if label in labels]
+    if len(present) < len(XMD_COORDINATE_LABELS) or present[:len(XMD_COORDINATE_LABELS)] != [0, 1, 2]:
+        raise ValueError("%s does not contain the columns %s." % (coordFilePath, ', '.join(XMD_COORDINATE_LABELS)))
 
     with open(coordFilePath) as f:
-        inputLines = f.readlines()
-
-    if xmdFormat == 0:
-        for line in inputLines[7:]:
-            vector = line.split()
-
-            coorList.append([float(vector[0]),
-                             float(vector[1]),
-                             float(vector[2])])
+        # Values finish at the next block of the file, if any
+        lines = takewhile(lambda line: not line.lstrip().startswith('data_'), islice(f, valuesLine, None))
+        while True:
+            rawLines = list(islice(lines, chunkSize))
+            if not rawLines:
+                break
+            # Blank and comment lines are skipped, but they do not finish the values
+            chunkLines = [line for line in rawLines if line.strip() and not line.lstrip().startswith('#')]
+            if not chunkLines:
+                continue
+            values = np.loadtxt(chunkLines, usecols=usecols, ndmin=2, dtype=float)
+            chunk = np.zeros((len(values), nColumns), dtype=float)
+            chunk[:, present] = values
+            yield chunk
+
+
+def readXmipp3dCoordinates(coordFilePath, withAlignment=False):
+    """ This method returns the 3D coordinates of a xmipp metadata (xmd) file as a single array.
+    See iterXmipp3dCoordinates for the shape of the array. """
+    nColumns = len(XMD_COORDINATE_LABELS) + (len(XMD_ALIGNMENT_LABELS) if withAlignment else 0)
+    chunks = list(iterXmipp3dCoordinates(coordFilePath, withAlignment=withAlignment))
+
+    return np.concatenate(chunks) if chunks else np.empty((0, nColumns), dtype=float)
 
-    if xmdFormat == 1:
-        for line in inputLines[15:]:
-            vector = line.split()
 
-            coorList.append([float(vector[-3]),
-                             float(vector[-2]),
-                             float(vector[-1])])
+def retrieveXmipp3dCoordinatesIntoList(coordFilePath, xmdFormat=0):
+    """ This method takes a xmipp metadata (xmd) 3D coordinates file path and returns a list of lists containing
+    the x, y and z values of every coordinate. Columns are located by their labels, so every xmd format is supported
+    and xmdFormat is only kept for compatibility:
+        format=0: plain coordinates, xmd files only contains (x, y, z) values.
+        format=1: coordinates with alignment information, xmd files contains also shifts and angle values."""
 
-    return coorList
+    return readXmipp3dCoordinates(coordFilePath).tolist()
 
 
-def writeMdCoordinates(setOfCoordinates, tomo, fnCoor):
+def coordinatesToColumns(ids, positions, matrices=None, idLabel=lib.MDL_ITEM_ID, scaleFactor=1, asInteger=False):
+    """
+        Returns the ordered dictionary of xmd columns of a coordinates file from the ids, the (N, 3) positions and,
+        optionally, the (N, 4, 4) Xmipp matrices of the coordinates. The ids are only written if idLabel is not None
+        and the positions are multiplied by scaleFactor. Positions are kept as floats unless asInteger is set, in
+        which case they are truncated as int() does.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3) * scaleFactor
+    if asInteger:
+        positions = positions.astype(int)
+    columns = OrderedDict()
+    if idLabel is not None:
+        columns[idLabel] = np.asarray(ids, dtype=int)
+    columns[lib.MDL_XCOOR] = positions[:, 0]
+    columns[lib.MDL_YCOOR] = positions[:, 1]
+    columns[lib.MDL_ZCOOR] = positions[:, 2]
+    if matrices is not None:
+        columns.update(alignmentToColumns(matrices, ALIGN_PROJ))
+    return columns
+
+
+def partitionMdCoordinates(setOfCoordinates, fnGetter, volumes=None, keyGetter=None, idLabel=lib.MDL_ITEM_ID,
+                           scaleFactor=1, withAlignment=True, asInteger=True, maxOpenFiles=64, bufferSize=10000):
+    """
+        Writes in a single pass over the set the xmd coordinates files of all the tomograms, as writeMdCoordinates
+        does for one of them. Coordinates are grouped by keyGetter (tsId by default) and written to fnGetter(key).
+        If a dictionary from key to tomogram is given in volumes, only the coordinates of those tomograms are written,
+        referred to them, and tomograms without coordinates get an empty file. The scaleFactor can also be a
+        dictionary from key to the scale factor of each tomogram. Positions are truncated to integers, as
+        writeMdCoordinates does, unless asInteger is unset.
+        Rows are buffered by tomogram and flushed every bufferSize coordinates, keeping at most maxOpenFiles files
+        open. Returns an ordered dictionary from key to the written file.
+    """
+    keyGetter = keyGetter or (lambda coord: coord.getTomoId())
+    fnCoors = OrderedDict()
+    buffers = {}
+    handles = OrderedDict()
+
+    def getHandle(key):
+        handle = handles.pop(key, None)
+        if handle is None:
+            if len(handles) >= maxOpenFiles:
+                handles.popitem(last=False)[1].close()
+            if key in fnCoors:
+                handle = open(fnCoors[key], 'a')
+            else:
+                fnCoors[key] = fnGetter(key)
+                fnCoorDirectory = os.path.dirname(fnCoors[key])
+                if fnCoorDirectory and not os.path.exists(fnCoorDirectory):
+                    os.makedirs(fnCoorDirectory)
+                handle = open(fnCoors[key], 'w')
+        handles[key] = handle
+        return handle
+
+    def flush(key, ids, positions, matrices):
+        scale = scaleFactor[key] if isinstance(scaleFactor, dict) else scaleFactor
+        columns = coordinatesToColumns(ids, positions, matrices if withAlignment else None, idLabel, scale, asInteger)
+        newFile = key not in fnCoors
+        handle = getHandle(key)
+        lines = xmdHeaderLines(columns.keys()) if newFile else []
+        handle.write("\n".join(lines + xmdRowLines(columns)) + "\n")
+
+    try:
+        for coord in setOfCoordinates.iterCoordinates():
+            key = keyGetter(coord)
+            if volumes is not None:
+                if key not in volumes:
+                    continue
+                coord.setVolume(volumes[key])
+            ids, positions, matrices = buffers.setdefault(key, ([], [], []))
+            ids.append(coord.getObjId())
+            positions.append((coord.getX(BOTTOM_LEFT_CORNER), coord.getY(BOTTOM_LEFT_CORNER),
+                              coord.getZ(BOTTOM_LEFT_CORNER)))
+            if withAlignment:
+                matrices.append(np.array(coord.getMatrix(convention=MATRIX_CONVERSION.XMIPP), dtype=float))
+            if len(ids) >= bufferSize:
+                flush(key, *buffers.pop(key))
+
+        for key in list(buffers):
+            flush(key, *buffers.pop(key))
+
+        # Tomograms without coordinates get a file with the header only
+        for key in (volumes or {}):
+            if key not in fnCoors:
+                labels = coordinatesToColumns([0], np.zeros((1, 3)), np.eye(4)[None] if withAlignment else None,
+                                              idLabel).keys()
+                getHandle(key).write("\n".join(xmdHeaderLines(labels)) + "\n")
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    return fnCoors
+
+
+def writeMdCoordinates(setOfCoordinates, tomo, fnCoor, idLabel=lib.MDL_ITEM_ID, scaleFactor=1):
     """
         Write the xmd file containing the set of coordinates corresponding to the given tomogram at the specified
-        location
+        location. Each coordinate is identified by its id under idLabel and its position is multiplied by scaleFactor.
     """
-    mdCoor = lib.MetaData()
-
-    tsid = tomo.getTsId()
-
-    coordDict = []
-    lines = []
-
     fnCoorDirectory = os.path.dirname(fnCoor)
-    if not os.path.exists(fnCoorDirectory):
+    if fnCoorDirectory and not os.path.exists(fnCoorDirectory):
         os.makedirs(fnCoorDirectory)
 
-    for item in setOfCoordinates.iterCoordinates(volume=tomo):
-        coord = item
-        transform = Transform(matrix=item.getMatrix(convention=MATRIX_CONVERSION.XMIPP))
-
-        if coord.getTomoId() == tsid:
-            nRow = md.Row()
-            nRow.setValue(lib.MDL_ITEM_ID, int(coord.getObjId()))
-            coord.setVolume(tomo)
-
-            nRow.setValue(lib.MDL_XCOOR, int(coord.getX(BOTTOM_LEFT_CORNER)))
-            nRow.setValue(lib.MDL_YCOOR, int(coord.getY(BOTTOM_LEFT_CORNER)))
-            nRow.setValue(lib.MDL_ZCOOR, int(coord.getZ(BOTTOM_LEFT_CORNER)))
-
-            alignmentToRow(transform, nRow, ALIGN_PROJ)
-            nRow.addToMd(mdCoor)
-
-            newCoord = item.clone()
-            newCoord.setVolume(coord.getVolume())
-            coordDict.append(newCoord)
-            lines.append(coordDict)
-
-    mdCoor.write(fnCoor)
+    ids, positions, matrices = getCoordinatesColumns(setOfCoordinates, volume=tomo, tsId=tomo.getTsId())
+    writeXmdBlock(fnCoor, coordinatesToColumns(ids, positions, matrices, idLabel, scaleFactor, asInteger=True))
 
     return fnCoor